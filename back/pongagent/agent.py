@@ -1,14 +1,30 @@
 #!/usr/bin/env python
 import json
+import fcntl
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from multiprocessing import resource_tracker, shared_memory
-import struct
 import pika
+import random
 from random import seed
 from random import randint
-import requests
 import os
+import requests
+import threading
 import time
+import traceback
 import sys
+import freelist
+import metrics
+import status
+try:
+    import numpy
+except ImportError:
+    # Only needed by the solo agents
+    numpy = None
+import upload
+from handoff import Handoff
 
 def remove_shm_from_resource_tracker():
     """Monkey-patch multiprocessing.resource_tracker so SharedMemory won't be tracked
@@ -19,174 +35,505 @@ def remove_shm_from_resource_tracker():
     def fix_register(name, rtype):
         if rtype == "shared_memory":
             return
-        return resource_tracker._resource_tracker.register(self, name, rtype)
+        return resource_tracker._resource_tracker.register(name, rtype)
     resource_tracker.register = fix_register
 
     def fix_unregister(name, rtype):
         if rtype == "shared_memory":
             return
-        return resource_tracker._resource_tracker.unregister(self, name, rtype)
+        return resource_tracker._resource_tracker.unregister(name, rtype)
     resource_tracker.unregister = fix_unregister
 
     if "shared_memory" in resource_tracker._CLEANUP_FUNCS:
         del resource_tracker._CLEANUP_FUNCS["shared_memory"]
 
-if len(sys.argv) < 2:
-    print('Missing agent type')
-    sys.exit(1)
-
-seed(1)
 host = os.getenv('RABBITMQ_HOST', 'localhost')
 pongapihost = os.getenv('PONGAPI_HOST', 'localhost')
-# Have to patch the resource tracker to make shm work properly
-remove_shm_from_resource_tracker()
+pongapiport = int(os.getenv('PONGAPI_PORT', 8000))
+apiUrl = f'http://{pongapihost}:{pongapiport}/pingpong'
+# Optional compression of the uploads (zlib or zstd)
+uploadCompression = os.getenv('UPLOAD_COMPRESSION', '')
+# Partial results are appended to the restapi every CHECKPOINT_ITERATIONS iterations or CHECKPOINT_SECONDS seconds
+checkpointIterations = int(os.getenv('CHECKPOINT_ITERATIONS', 1024*1024))
+checkpointSeconds = float(os.getenv('CHECKPOINT_SECONDS', 30))
+# Number of jobs processed concurrently, each one in its own worker process
+concurrency = int(os.getenv('AGENT_CONCURRENCY', 1))
+# Size class of the jobs consumed by the agent (small, large or all), see PINGPONG_SMALL_JOB_MAX in the restapi
+# Agents of the same role must either all consume all the jobs or be split between small and large ones
+jobSize = os.getenv('AGENT_JOB_SIZE', 'all')
+
+# Prometheus metrics served on http://<agent>:METRICS_PORT/metrics (disabled when 0)
+metricsPort = int(os.getenv('METRICS_PORT', 0))
+# Optional sampling profiler of the jobs, one folded stacks file per job in PROFILE_DIR (disabled when 0)
+profileInterval = float(os.getenv('PROFILE_INTERVAL', 0))
+profileDir = os.getenv('PROFILE_DIR', '/tmp')
+# Seconds between two pushes of the metrics recorded by the worker processes to the agent
+metricsInterval = float(os.getenv('METRICS_INTERVAL', 5))
+
+metrics.counter('r3p_agent_jobs_total', 'Jobs processed by the agent')
+metrics.counter('r3p_agent_iterations_total', 'Iterations generated by the agent')
+metrics.histogram('r3p_agent_handoff_wait_seconds', 'Time spent waiting for the turn')
+metrics.histogram('r3p_agent_iteration_seconds', 'Average time per iteration of a turn')
+metrics.histogram('r3p_agent_upload_seconds', 'Duration of the uploads to the restapi')
+metrics.histogram('r3p_agent_upload_bytes', 'Size of the records uploaded to the restapi', metrics.SIZE_BUCKETS)
+metrics.histogram('r3p_agent_worker_peak_rss_bytes', 'Peak resident memory of the worker process after each job', metrics.MEMORY_BUCKETS)
+
+# Maximum time blocked waiting for the other agent before checking the status again. Handoffs and the end of the job
+# wake the agent up, only the cancel flag is set by the restapi without a signal and is seen at the next check
+WAKE_TIMEOUT = 0.05
+# Number of iterations written by a solo agent between two progress updates
+SOLO_STEP = 1 << 20
+# Number of iterations generated by a shard between two updates of its counter and checkpoint attempts (a few
+# milliseconds), whatever the turn size of the job
+SHARD_STEP = 1 << 12
+# Highest priority of a job, same as the restapi
+MAX_PRIORITY = 9
+
+def print_timings(t1, cpu1, handoff):
+    latency = handoff.latency/handoff.handoffs if handoff.handoffs else 0
+    print("Processing Time=%s Idle Time=%s CPU Time=%s Handoffs=%s Handoff Latency=%s" % (
+        time.time() - t1, handoff.idleTime, time.process_time() - cpu1, handoff.handoffs, latency))
+
+def push_metrics(metricsQueue):
+    """Send the metrics recorded by the worker process to the agent every metricsInterval seconds"""
+    while True:
+        time.sleep(metricsInterval)
+        values = metrics.snapshot()
+        if values:
+            metricsQueue.put(values)
 
-# Todo: do not disable heartbeat and run in a separate thread instead
-connection = pika.BlockingConnection(
-    pika.ConnectionParameters(heartbeat=0, host=host))
-channel = connection.channel()
+def init_worker(metricsQueue=None):
+    seed(1)
+    # Have to patch the resource tracker to make shm work properly
+    remove_shm_from_resource_tracker()
+    # Long jobs show up in the metrics of the agent while they run, not only once they are done
+    if metricsQueue is not None:
+        threading.Thread(target=push_metrics, args=(metricsQueue,), name='metrics', daemon=True).start()
 
-channel.exchange_declare(exchange='pingpongtopic', exchange_type='topic')
+def append_records(jobId, posBuf, colBuf, start, end, kind):
+    """Append the records [start, end) to the job data, kind is checkpoint or final"""
+    t1 = time.perf_counter()
+    upload.append_records(f'{apiUrl}/append/{jobId}/', posBuf, colBuf, start, end, uploadCompression)
+    metrics.observe('r3p_agent_upload_seconds', time.perf_counter() - t1, kind=kind)
+    metrics.observe('r3p_agent_upload_bytes', 6*(end - start), kind=kind)
 
-channelName = sys.argv[1]
-result = channel.queue_declare(channelName)
-queue_name = result.method.queue
+def run_worker(function, *args):
+    """Run a job in a worker process, the metrics it recorded since the last push are sent back with the result"""
+    profiler = None
+    if profileInterval:
+        image = args[-1]
+        profiler = metrics.SamplingProfiler(profileInterval, os.path.join(profileDir, f"{image['jobId']}-{os.getpid()}.folded"))
+        profiler.start()
+    try:
+        function(*args)
+    except:
+        # Dropped, they would be counted with the next job of the worker
+        metrics.snapshot()
+        raise
+    finally:
+        if profiler is not None:
+            profiler.stop()
+    metrics.observe('r3p_agent_worker_peak_rss_bytes', metrics.peak_rss())
+    return metrics.snapshot()
 
-binding_key = 'pingpong'
-channel.queue_bind(
-    exchange='pingpongtopic', queue=queue_name, routing_key=binding_key)
+def attach_status(jobId):
+    """Attach the status segment of a job, returns None if the job does not need to be generated anymore"""
+    try:
+        return status.JobStatus(jobId)
+    except FileNotFoundError:
+        # The SHM is gone (host restart) and the message has been redelivered, rebuild it from the last checkpoint
+        response = requests.post(f'{apiUrl}/restore/{jobId}/')
+        # Deleted or cancelled job
+        if response.status_code in (404, 410):
+            return None
+        response.raise_for_status()
+        if response.json()['finished']:
+            return None
+        return status.JobStatus(jobId)
 
-print(' [*] Waiting for logs. To exit press CTRL+C')
+def stop_job(jobId):
+    """Cancel a job whose message is dropped, the other agents of the job would otherwise wait for it forever"""
+    # Flagged in the SHM first, the restapi may not be reachable
+    try:
+        jobStatus = status.JobStatus(jobId)
+    except FileNotFoundError:
+        pass
+    else:
+        jobStatus.buf[status.CANCEL] = 1
+        jobStatus.close()
+    try:
+        requests.post(f'{apiUrl}/cancel/{jobId}/', timeout=10).raise_for_status()
+    except requests.RequestException as e:
+        print(f"Unable to cancel job {jobId}: {e}")
 
-def callback(ch, method, properties, body):
+def run_job(role, image):
+    """Generate the image of a job as the ping or pong agent, returns once the job is complete"""
     t1 = time.time()
-    # Retrieve parameters from message
-    message = body.decode()
-    image = json.loads(message)
     jobId = image['jobId']
     width = image['width']
     height = image['height']
 
     # Retrieve status
-    shmStatus = shared_memory.SharedMemory(create=False, name=f"{str(jobId)}-status", size=5)
-    statusBuf = shmStatus.buf
-    iteration = struct.unpack('I', statusBuf[0:4])[0]
-    newIteration = iteration + 1
-
-    # Retrieve position and associated masks from SHM
-    bufferSize = height*width*4 #uint32
-    shmPos = shared_memory.SharedMemory(create=False, name=f"{str(jobId)}-pos", size=bufferSize)
+    jobStatus = attach_status(jobId)
+    if jobStatus is None:
+        return
+    statusBuf = jobStatus.buf
+    # Number of consecutive iterations generated per turn
+    turnSize = status.read(statusBuf).turnSize
+
+    # Retrieve positions and colors from SHM
+    # Both are swap-remove free lists: values before the current iteration are the ones already generated,
+    # values after it are the ones still available
+    positionCount = height*width
+    shmPos = shared_memory.SharedMemory(create=False, name=f"{str(jobId)}-pos")
     posBuf = shmPos.buf
-    bitmaskSize = height*width
-    shmPosMask = shared_memory.SharedMemory(create=False, name=f"{str(jobId)}-posMask", size=bitmaskSize)
-    posMaskBuf = shmPosMask.buf
-    # Retrieve colors and associated masks from SHM
-    shmCol = shared_memory.SharedMemory(create=False, name=f"{str(jobId)}-col", size=bufferSize)
+    positions = posBuf.cast('I')
+    colorCount = 256*256*256
+    shmCol = shared_memory.SharedMemory(create=False, name=f"{str(jobId)}-col")
     colBuf = shmCol.buf
-    colmaskSize = 256*256*256
-    shmColMask = shared_memory.SharedMemory(create=False, name=f"{str(jobId)}-colMask", size=colmaskSize)
-    colMaskBuf = shmColMask.buf
+    # Small jobs have a sparse color free list, indexed the same way
+    colors = freelist.color_list(colBuf)
+
+    # Named pipes used to wake up the other agent when handing over the turn
+    handoff = Handoff(jobId, role)
+    cpu1 = time.process_time()
+    # Checkpoints are uploaded in the background, the generated records never move in the buffers
+    checkpoints = []
+    lastCheckpointTime = t1
+
+    # Finished by a previous delivery whose final upload failed (message redelivered), upload what the restapi is
+    # missing. It skips the records already stored and only releases the segments once all of them are.
+    header = status.read(statusBuf)
+    if header.state == status.FINISHED and not header.cancelled:
+        append_records(jobId, posBuf, colBuf, header.checkpoint, positionCount, 'final')
 
     # Loop on the image
-    statusCheck = 0 if sys.argv[1] == 'ping' else 1
-    while newIteration < width*height:
-        # Wait for this agent's turn
-        while statusBuf[4] != statusCheck or statusBuf[4] == 2:
-            # The other agent has finished the last iteration, we can clean up the shmstatus and exit the callback safely
-            # Unless the buffer is locked externally
-            if statusBuf[4] == 2 and statusBuf[5] != 1:
+    statusCheck = 0 if role == 'ping' else 1
+    while True:
+        # Wait for this agent's turn, the state is a single byte it can be read without the seqlock
+        waitStart = time.perf_counter()
+        while statusBuf[status.STATE] != statusCheck or statusBuf[status.CANCEL]:
+            # The other agent has finished the last iteration (or the job is cancelled), we can close the shm and exit
+            # the callback safely. The restapi takes the segments back once all the data is uploaded and the agents detached
+            if status.stopped(statusBuf):
+                for checkpoint in checkpoints:
+                    checkpoint.join()
+                positions.release()
+                colors.release()
                 shmPos.close()
-                shmPosMask.close()
-                shmPos.unlink()
-                shmPosMask.unlink()
                 shmCol.close()
-                shmColMask.close()
-                shmCol.unlink()
-                shmColMask.unlink()
-                shmStatus.close()
-                shmStatus.unlink()
-                t2 = time.time()
-                print("Processing Time=%s" % (t2 - t1))
-                ch.basic_ack(delivery_tag=method.delivery_tag)
+                jobStatus.close()
+                handoff.close()
+                print_timings(t1, cpu1, handoff)
                 return
-            time.sleep(0.00001)
-        iteration = struct.unpack('I', statusBuf[0:4])[0]
-        newIteration = iteration + 1
-        # Arbitrary criteria for now, let's say that for the last 0.001%, we are going to generate a correct position every single time
-        # instead of randomly trying to land on an empty position
-        if newIteration/(height*width) > 0.99999:
-            randomPosition = randint(0, width*height - newIteration)
-            availablePosCounter = 0
-            for i in range(bitmaskSize):
-                if posMaskBuf[i] and randomPosition == availablePosCounter:
-                    randomPosition = i
-                    break
-                availablePosCounter += posMaskBuf[i]
-        else:
-            # Generate random positions until we find an available spot
-            while True:
-                randomPosition = randint(0, width*height - 1)
-                # If the position is available
-                if posMaskBuf[randomPosition]:
-                    break
-        # Mark the position as unavailable
-        posMaskBuf[randomPosition] = 0
-        # Fill the buffer with the new position
-        posBuf[4*iteration:4*iteration+4] = struct.pack("I", randomPosition)
-
-        # Arbitrary criteria for now, let's say that for the last 0.001%, we are going to generate a correct color every single time
-        # instead of randomly trying to land on an empty position
-        if newIteration/colmaskSize > 0.99999:
-            randomColor = randint(0, 256*256*256 - newIteration)
-            availableColCounter = 0
-            for i in range(bitmaskSize):
-                if colMaskBuf[i] and randomColor == availableColCounter:
-                    randomColor = i
-                    break
-                availableColCounter += colMaskBuf[i]
+            # Block until the other agent hands over the turn
+            handoff.wait(WAKE_TIMEOUT)
+        turnTime = time.perf_counter()
+        metrics.observe('r3p_agent_handoff_wait_seconds', turnTime - waitStart, role=role)
+        header = status.read(statusBuf)
+        turnStart = header.iteration
+        newIteration = min(turnStart + turnSize, positionCount)
+        for iteration in range(turnStart, newIteration):
+            # Draw one of the remaining positions and swap it at the current iteration, whatever the fill level
+            randomIndex = randint(iteration, positionCount - 1)
+            positions[iteration], positions[randomIndex] = positions[randomIndex], positions[iteration]
+
+            # Same for the colors
+            randomIndex = randint(iteration, colorCount - 1)
+            colors[iteration], colors[randomIndex] = colors[randomIndex], colors[iteration]
+        if newIteration > turnStart:
+            metrics.observe('r3p_agent_iteration_seconds', (time.perf_counter() - turnTime)/(newIteration - turnStart), role=role)
+            metrics.inc('r3p_agent_iterations_total', newIteration - turnStart, role=role)
+
+        # Checkpoint the records generated since the last checkpoint, the agent on turn owns the checkpoint marker
+        checkpointStart = header.checkpoint
+        checkpointEnd = checkpointStart
+        now = time.time()
+        if newIteration < positionCount and (newIteration - checkpointStart >= checkpointIterations
+                                             or now - lastCheckpointTime >= checkpointSeconds):
+            checkpointEnd = newIteration
+            checkpoint = threading.Thread(target=append_records, args=(
+                jobId, posBuf, colBuf, checkpointStart, newIteration, 'checkpoint'))
+            checkpoint.start()
+            checkpoints.append(checkpoint)
+            lastCheckpointTime = now
+
+        # Now update the iteration and hand the turn over to the other agent, the state is written last
+        # On the last iteration, tag the state as finished straight away to stop the other worker
+        if newIteration == positionCount:
+            nextState = status.FINISHED
         else:
-            # Generate random colors until we find an available spot
-            while True:
-                randomColor = randint(0, 256*256*256 - 1)
-                # If the color is available
-                if colMaskBuf[randomColor] == 1:
-                    break
-        # Mark the color as unavailable
-        colMaskBuf[randomColor] = 0
-        # Fill the buffer with the new color
-        colBuf[4*iteration:4*iteration+4] = struct.pack("I", randomColor)
-
-        # Now update the iteration and tag the status buffer for the other agent
-        statusBuf[0:4] = struct.pack("I", newIteration)
-        statusBuf[4] = 1 if sys.argv[1] == 'ping' else 0
+            nextState = 1 if role == 'ping' else 0
+        status.update_progress(statusBuf, header, newIteration, checkpoint=checkpointEnd, state=nextState)
+        handoff.signal()
         # Used for debug
-        if newIteration%1000 == 0 or newIteration%1000 == 1:
+        if newIteration//1000 != turnStart//1000:
             print(newIteration)
         # Update the api with the final data
-        if newIteration == width*height:
-            # Last iteration, tag the status as 2 to stop the other worker
-            statusBuf[4] = 2
-            positionList = struct.unpack(f'{width*height}I', posBuf)
-            colorList = struct.unpack(f'{width*height}I', colBuf)
-            data = []
-            for i in range(len(positionList)):
-                data.append([positionList[i], colorList[i]])
-            url = f'http://{pongapihost}:8000/pingpong/update/{jobId}/'
-            body = {'iteration': newIteration, 'data': json.dumps(data)}
-            requests.post(url, json = body)
-            t2 = time.time()
-            print("Processing Time=%s" % (t2 - t1))
-            # Close the shm and clear the SHM
+        if newIteration == positionCount:
+            # Append what has not been checkpointed yet, this also marks the job as complete
+            for checkpoint in checkpoints:
+                checkpoint.join()
+            append_records(jobId, posBuf, colBuf, checkpointStart, newIteration, 'final')
+            print_timings(t1, cpu1, handoff)
+            # Close the shm
+            positions.release()
+            colors.release()
             shmPos.close()
-            shmPosMask.close()
             shmCol.close()
-            shmColMask.close()
-            shmStatus.close()
-            # Don't unlink the shms, the other agent will do it when exiting
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            jobStatus.close()
+            handoff.close()
+            # Don't unlink the shms, the restapi recycles them
             return
 
-channel.basic_consume(
-    queue=queue_name, on_message_callback=callback)
+def run_shard(image):
+    """Generate the iterations of one shard of a sharded job
+
+    Iterations are dealt round robin: shard s generates the iterations s, s + N, s + 2N... Its positions and color
+    slots are the ones congruent to s modulo N, so the shards never draw the same value and the SHM free lists are
+    split in N interleaved free lists the shards shuffle in parallel without any synchronisation. The color of a slot
+    is given by a fixed bijection of the 24 bit colors, it is not tied to the position modulo N. The iterations are
+    consecutive up to the first one a shard has not generated yet, the shard getting there checkpoints them.
+    """
+    t1 = time.time()
+    jobId = image['jobId']
+    width = image['width']
+    height = image['height']
+    shard = image['shard']
+
+    jobStatus = attach_status(jobId)
+    if jobStatus is None:
+        return
+    statusBuf = jobStatus.buf
+    shards = status.read(statusBuf).shards
+
+    positionCount = height*width
+    shmPos = shared_memory.SharedMemory(create=False, name=f"{str(jobId)}-pos")
+    posBuf = shmPos.buf
+    positions = posBuf.cast('I')
+    shmCol = shared_memory.SharedMemory(create=False, name=f"{str(jobId)}-col")
+    colBuf = shmCol.buf
+    colors = colBuf.cast('I')
+    # Number of positions of the shard
+    positionShare = len(range(shard, positionCount, shards))
+
+    # Shards must not draw the same random sequence
+    rng = random.Random(f"{jobId}-{shard}")
+    cpu1 = time.process_time()
+    checkpoints = []
+    lastCheckpointTime = t1
+
+    def checkpoint(final):
+        nonlocal lastCheckpointTime
+        # The header is shared by the shards, it is only written under a POSIX record lock on the status file
+        # (independent from the shared flock holding the segments)
+        fcntl.lockf(jobStatus.fd, fcntl.LOCK_EX if final else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        try:
+            header = status.read(statusBuf)
+            checkpointStart = header.checkpoint
+            iteration = min(status.read_iteration(statusBuf, shards), positionCount)
+            if final:
+                # Only the last shard to finish sees all the iterations, it uploads the rest and stops the job
+                # A redelivered shard of a finished job uploads it again, the final upload may have failed
+                if iteration == positionCount and not header.cancelled:
+                    if header.state != status.FINISHED:
+                        status.update_progress(statusBuf, header, iteration, state=status.FINISHED)
+                    for thread in checkpoints:
+                        thread.join()
+                    append_records(jobId, posBuf, colBuf, checkpointStart, iteration, 'final')
+                return
+            now = time.time()
+            if iteration - checkpointStart >= checkpointIterations or now - lastCheckpointTime >= checkpointSeconds:
+                status.update_progress(statusBuf, header, iteration, checkpoint=iteration)
+                thread = threading.Thread(target=append_records, args=(
+                    jobId, posBuf, colBuf, checkpointStart, iteration, 'checkpoint'))
+                thread.start()
+                checkpoints.append(thread)
+                lastCheckpointTime = now
+        finally:
+            fcntl.lockf(jobStatus.fd, fcntl.LOCK_UN)
+
+    # Resume where the shard stopped (restored from a checkpoint)
+    step = status.read_counter(statusBuf, shard)
+    while step < positionShare and not status.stopped(statusBuf):
+        turnTime = time.perf_counter()
+        stepEnd = min(step + SHARD_STEP, positionShare)
+        # Same draws as the ping/pong agents, restricted to the indices of the shard
+        freelist.draw_shard(positions, colors, positionCount, shard, shards, step, stepEnd, rng)
+        metrics.observe('r3p_agent_iteration_seconds', (time.perf_counter() - turnTime)/(stepEnd - step), role='shard')
+        metrics.inc('r3p_agent_iterations_total', stepEnd - step, role='shard')
+        step = stepEnd
+        status.write_counter(statusBuf, shard, step)
+        try:
+            checkpoint(False)
+        except (BlockingIOError, PermissionError):
+            # Another shard is checkpointing
+            pass
+
+    checkpoint(True)
+    for thread in checkpoints:
+        thread.join()
+    print("Shard %s/%s Processing Time=%s CPU Time=%s" % (shard, shards, time.time() - t1, time.process_time() - cpu1))
+    positions.release()
+    colors.release()
+    shmPos.close()
+    shmCol.close()
+    jobStatus.close()
+
+def run_solo(image):
+    """Generate a whole job in a few vectorized steps as the solo agent
+
+    The positions are a random permutation and the colors a random sample of distinct colors, both drawn at once from
+    the seed of the job and written in iteration order. A job restored from a checkpoint draws the same values again
+    and resumes after the stored ones.
+    """
+    t1 = time.time()
+    jobId = image['jobId']
+    width = image['width']
+    height = image['height']
+
+    jobStatus = attach_status(jobId)
+    if jobStatus is None:
+        return
+    statusBuf = jobStatus.buf
+
+    positionCount = height*width
+    colorCount = 256*256*256
+    cpu1 = time.process_time()
+    rng = numpy.random.default_rng(image['seed'])
+    drawnPositions = rng.permutation(positionCount).astype(numpy.uint32)
+    drawnColors = rng.choice(colorCount, positionCount, replace=False).astype(numpy.uint32)
+    metrics.observe('r3p_agent_iteration_seconds', (time.process_time() - cpu1)/positionCount, role='solo')
+
+    shmPos = shared_memory.SharedMemory(create=False, name=f"{str(jobId)}-pos")
+    posBuf = shmPos.buf
+    positions = numpy.ndarray(positionCount, dtype=numpy.uint32, buffer=posBuf)
+    shmCol = shared_memory.SharedMemory(create=False, name=f"{str(jobId)}-col")
+    colBuf = shmCol.buf
+    colors = numpy.ndarray(positionCount, dtype=numpy.uint32, buffer=colBuf)
+    checkpoints = []
+    lastCheckpointTime = t1
+
+    header = status.read(statusBuf)
+    iteration = header.iteration
+    while iteration < positionCount and not header.cancelled:
+        stepEnd = min(iteration + SOLO_STEP, positionCount)
+        positions[iteration:stepEnd] = drawnPositions[iteration:stepEnd]
+        colors[iteration:stepEnd] = drawnColors[iteration:stepEnd]
+        metrics.inc('r3p_agent_iterations_total', stepEnd - iteration, role='solo')
+
+        # Same checkpoints as the ping/pong agents
+        checkpointStart = header.checkpoint
+        checkpointEnd = checkpointStart
+        now = time.time()
+        if stepEnd < positionCount and (stepEnd - checkpointStart >= checkpointIterations
+                                        or now - lastCheckpointTime >= checkpointSeconds):
+            checkpointEnd = stepEnd
+            checkpoint = threading.Thread(target=append_records, args=(
+                jobId, posBuf, colBuf, checkpointStart, stepEnd, 'checkpoint'))
+            checkpoint.start()
+            checkpoints.append(checkpoint)
+            lastCheckpointTime = now
+        if stepEnd == positionCount:
+            status.update_progress(statusBuf, header, stepEnd, checkpoint=checkpointEnd, state=status.FINISHED)
+        else:
+            status.update_progress(statusBuf, header, stepEnd, checkpoint=checkpointEnd)
+        header = status.read(statusBuf)
+        iteration = stepEnd
+
+    for checkpoint in checkpoints:
+        checkpoint.join()
+    if header.checkpoint < positionCount and not header.cancelled:
+        append_records(jobId, posBuf, colBuf, header.checkpoint, positionCount, 'final')
+    print("Solo Processing Time=%s CPU Time=%s" % (time.time() - t1, time.process_time() - cpu1))
+    # The arrays hold the buffers, release them before closing the shm
+    del positions, colors
+    shmPos.close()
+    shmCol.close()
+    jobStatus.close()
+
+def merge_metrics(metricsQueue):
+    """Merge the metrics pushed by the worker processes"""
+    while True:
+        metrics.merge(metricsQueue.get())
+
+def main():
+    if len(sys.argv) < 2:
+        print('Missing agent type')
+        sys.exit(1)
+    role = sys.argv[1]
+    if role == 'solo' and numpy is None:
+        print('The solo agent needs numpy')
+        sys.exit(1)
+    if jobSize not in ('small', 'large', 'all'):
+        print('AGENT_JOB_SIZE must be small, large or all')
+        sys.exit(1)
+
+    # The status segments of the dropped jobs are attached by this process too
+    remove_shm_from_resource_tracker()
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+    channel = connection.channel()
+
+    channel.exchange_declare(exchange='pingpongtopic', exchange_type='topic')
+
+    # One queue per role and size class. The ping and pong queues stay FIFO: both agents of a job must take the jobs
+    # in the same order, a priority job published while one of them is still uploading would pair them on different
+    # jobs waiting for each other forever. The jobs of highest priority are delivered first to the shard/solo agents.
+    arguments = {'x-max-priority': MAX_PRIORITY} if role in ('shard', 'solo') else None
+    result = channel.queue_declare(f'{role}-{jobSize}', arguments=arguments)
+    queue_name = result.method.queue
+
+    # Shard agents get one message per shard of the sharded jobs, solo agents the solo jobs
+    size = '*' if jobSize == 'all' else jobSize
+    binding_key = f'pingpong.{role}.{size}' if role in ('shard', 'solo') else f'pingpong.{size}'
+    channel.queue_bind(
+        exchange='pingpongtopic', queue=queue_name, routing_key=binding_key)
+    # Never hold more jobs than the workers can process
+    channel.basic_qos(prefetch_count=concurrency)
+
+    # Jobs run in worker processes so the connection thread keeps servicing heartbeats
+    context = multiprocessing.get_context('spawn')
+    metricsQueue = context.Queue()
+    workers = ProcessPoolExecutor(max_workers=concurrency, mp_context=context, initializer=init_worker,
+                                  initargs=(metricsQueue,))
+    threading.Thread(target=merge_metrics, args=(metricsQueue,), name='metrics-merge', daemon=True).start()
+
+    if metricsPort:
+        metrics.serve(metricsPort)
+
+    def on_job_done(ch, method, image, future):
+        # Failed twice, the message is dropped and the job stopped
+        if future.exception() is not None and method.redelivered:
+            stop_job(image['jobId'])
+        if future.exception() is None:
+            metrics.merge(future.result())
+        metrics.inc('r3p_agent_jobs_total', role=role, outcome='success' if future.exception() is None else 'failure')
+
+        # Channels are not thread safe, ack from the connection thread
+        def acknowledge():
+            if future.exception() is None:
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+            else:
+                traceback.print_exception(future.exception())
+                # Give the job a second chance on another agent, drop it if it already failed once (stopped above)
+                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=not method.redelivered)
+        connection.add_callback_threadsafe(acknowledge)
+
+    def callback(ch, method, properties, body):
+        image = json.loads(body.decode())
+        if role == 'shard':
+            future = workers.submit(run_worker, run_shard, image)
+        elif role == 'solo':
+            future = workers.submit(run_worker, run_solo, image)
+        else:
+            future = workers.submit(run_worker, run_job, role, image)
+        future.add_done_callback(functools.partial(on_job_done, ch, method, image))
+
+    channel.basic_consume(
+        queue=queue_name, on_message_callback=callback)
+
+    print(' [*] Waiting for logs. To exit press CTRL+C')
+    channel.start_consuming()
 
-channel.start_consuming()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+COLOR_COUNT = 256*256*256
+# Bytes per capacity of a sparse color free list: the value itself and two (index, value) hash slots
+SPARSE_COLOR_BYTES = 20
+_HASH_MULTIPLIER = 2654435761
+# Bijection of the 24 bit colors applied to the color slots drawn by the shards, same as the restapi
+COLOR_MIX_MULTIPLIERS = (0x5BD1E5, 0x2C1B3D)
+_MIX_FIRST, _MIX_SECOND = COLOR_MIX_MULTIPLIERS
+_COLOR_MASK = COLOR_COUNT - 1
+
+def color_list(colBuf):
+    """uint32 view of the color free list of a job, dense or sparse depending on the size of its segment"""
+    if len(colBuf) >= COLOR_COUNT*4:
+        return colBuf.cast('I')
+    return SparseColors(colBuf)
+
+def shard_color(slot):
+    """Color of a color slot drawn by a shard"""
+    slot = (slot*_MIX_FIRST) & _COLOR_MASK
+    slot ^= slot >> 12
+    slot = (slot*_MIX_SECOND) & _COLOR_MASK
+    return slot ^ (slot >> 12)
+
+def draw_shard(positions, colors, positionCount, shard, shards, start, end, rng):
+    """Swap-remove draws of a shard of a sharded job for its iterations [start, end)
+
+    Shard s generates the iterations s, s + N, s + 2N... and only draws from the indices congruent to s modulo N of
+    the free lists: the positions congruent to s and the color slots congruent to s. The slot drawn is stored at the
+    iteration as the color it maps to (shard_color), only the indices after the iteration are read as slots.
+    """
+    positionShare = len(range(shard, positionCount, shards))
+    colorShare = len(range(shard, COLOR_COUNT, shards))
+    for shardIteration in range(start, end):
+        iteration = shard + shardIteration*shards
+        randomIndex = shard + rng.randint(shardIteration, positionShare - 1)*shards
+        positions[iteration], positions[randomIndex] = positions[randomIndex], positions[iteration]
+
+        randomIndex = shard + rng.randint(shardIteration, colorShare - 1)*shards
+        slot = colors[randomIndex]
+        colors[randomIndex] = colors[iteration]
+        colors[iteration] = shard_color(slot)
+
+class SparseColors:
+    """Swap-remove free list of the 2^24 colors of a small job, laid out by the restapi
+
+    The first capacity values are stored densely, so the generated colors are in place for the uploads. Values
+    swapped to the indices beyond the capacity are kept in an open addressing hash table of (index, value) uint32
+    pairs, any other index holds its own value. Index 0 marks an empty slot, it is never beyond the capacity.
+    """
+
+    def __init__(self, colBuf):
+        self.values = colBuf.cast('I')
+        self.capacity = len(self.values)*4//SPARSE_COLOR_BYTES
+        self.head = self.values[:self.capacity]
+        self.table = self.values[self.capacity:]
+        self.slotCount = len(self.table)//2
+        self.shift = 33 - self.slotCount.bit_length()
+
+    def _slot(self, index):
+        # Multiplicative hashing then linear probing, same as the restapi
+        slot = ((index*_HASH_MULTIPLIER) & 0xFFFFFFFF) >> self.shift
+        table = self.table
+        while table[2*slot] != index and table[2*slot] != 0:
+            slot = (slot + 1) % self.slotCount
+        return slot
+
+    def __getitem__(self, index):
+        if index < self.capacity:
+            return self.head[index]
+        slot = self._slot(index)
+        return self.table[2*slot + 1] if self.table[2*slot] == index else index
+
+    def __setitem__(self, index, value):
+        if index < self.capacity:
+            self.head[index] = value
+            return
+        slot = self._slot(index)
+        self.table[2*slot] = index
+        self.table[2*slot + 1] = value
+
+    def release(self):
+        self.head.release()
+        self.table.release()
+        self.values.release()
@@ -0,0 +1,55 @@
+import os
+import select
+import struct
+import time
+
+# The restapi creates one named pipe per agent next to the job SHM segments
+SHM_DIR = '/dev/shm'
+
+def handoff_path(jobId, role):
+    return os.path.join(SHM_DIR, f"{jobId}-{role}-wake")
+
+class Handoff:
+    """Blocking wake-up between the ping and pong agents of a job
+
+    Each agent blocks on its own named pipe until the other agent writes a token in it. Pipes buffer the token so a
+    wake-up sent before the agent starts waiting is not lost. The token is the monotonic time of the handoff, which
+    gives the handoff latency on the waiting side.
+    """
+
+    def __init__(self, jobId, role):
+        peer = 'pong' if role == 'ping' else 'ping'
+        self.paths = (handoff_path(jobId, role), handoff_path(jobId, peer))
+        # Opening a pipe read/write never blocks waiting for the other end
+        self.own = os.open(self.paths[0], os.O_RDWR | os.O_NONBLOCK)
+        self.peer = os.open(self.paths[1], os.O_RDWR | os.O_NONBLOCK)
+        self.idleTime = 0
+        self.latency = 0
+        self.handoffs = 0
+
+    def wait(self, timeout):
+        """Block until the other agent signals or the timeout expires"""
+        t1 = time.monotonic()
+        ready, _, _ = select.select([self.own], [], [], timeout)
+        now = time.monotonic()
+        self.idleTime += now - t1
+        if ready:
+            try:
+                tokens = os.read(self.own, 4096)
+            except BlockingIOError:
+                return
+            if len(tokens) >= 8:
+                self.latency += now - struct.unpack('d', tokens[-8:])[0]
+                self.handoffs += 1
+
+    def signal(self):
+        """Wake up the other agent"""
+        try:
+            os.write(self.peer, struct.pack('d', time.monotonic()))
+        except BlockingIOError:
+            # The pipe is full of pending tokens, the other agent is going to wake up anyway
+            pass
+
+    def close(self):
+        os.close(self.own)
+        os.close(self.peer)
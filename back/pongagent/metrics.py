@@ -0,0 +1,160 @@
+import bisect
+import collections
+import os
+import resource
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Default histogram buckets (seconds)
+TIME_BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1, 10, 100)
+# Default histogram buckets (bytes)
+SIZE_BUCKETS = (1024, 16*1024, 256*1024, 4*1024*1024, 64*1024*1024)
+# Memory histogram buckets (bytes)
+MEMORY_BUCKETS = (64*1024*1024, 256*1024*1024, 1024*1024*1024, 4*1024*1024*1024)
+
+_lock = threading.Lock()
+# name -> (type, help, buckets)
+_metrics = {}
+# (name, labels) -> value for counters, [bucket counts..., +Inf count, sum, count] for histograms
+_values = {}
+
+def _register(name, type, help, buckets=None):
+    _metrics.setdefault(name, (type, help, buckets))
+
+def counter(name, help):
+    _register(name, 'counter', help)
+
+def histogram(name, help, buckets=TIME_BUCKETS):
+    _register(name, 'histogram', help, buckets)
+
+def inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _values[key] = _values.get(key, 0) + value
+
+def observe(name, value, **labels):
+    buckets = _metrics[name][2]
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        values = _values.get(key)
+        if values is None:
+            values = _values[key] = [0]*(len(buckets) + 3)
+        values[bisect.bisect_left(buckets, value)] += 1
+        values[-2] += value
+        values[-1] += 1
+
+def snapshot(reset=True):
+    """Values recorded so far, worker processes send them back to the main process with their result"""
+    with _lock:
+        values = {key: list(value) if isinstance(value, list) else value for key, value in _values.items()}
+        if reset:
+            _values.clear()
+    return values
+
+def merge(values):
+    with _lock:
+        for key, value in values.items():
+            if isinstance(value, list):
+                current = _values.setdefault(key, [0]*len(value))
+                for index, count in enumerate(value):
+                    current[index] += count
+            else:
+                _values[key] = _values.get(key, 0) + value
+
+def peak_rss():
+    """Peak resident memory of the process in bytes"""
+    # ru_maxrss is inherited through fork and exec, VmHWM only covers the memory of this process
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    # Linux reports it in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def _labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+def render():
+    """Prometheus text exposition of the metrics"""
+    lines = []
+    with _lock:
+        values = sorted(_values.items())
+    for name, (type, help, buckets) in sorted(_metrics.items()):
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {type}')
+        for (valueName, labels), value in values:
+            if valueName != name:
+                continue
+            if type != 'histogram':
+                lines.append(f'{name}{_labels(labels)} {value}')
+                continue
+            cumulated = 0
+            for bound, count in zip(list(buckets) + ['+Inf'], value):
+                cumulated += count
+                lines.append(f'{name}_bucket{_labels(labels, [("le", bound)])} {cumulated}')
+            lines.append(f'{name}_sum{_labels(labels)} {value[-2]}')
+            lines.append(f'{name}_count{_labels(labels)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port):
+    """Expose the metrics of the agent on http://0.0.0.0:<port>/metrics in a background thread"""
+    server = ThreadingHTTPServer(('', port), _Handler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+class SamplingProfiler:
+    """Sample the stack of a thread at a fixed interval and write the stacks in the folded format of flame graphs
+
+    Sampling happens in a background thread, the profiled code is not instrumented.
+    """
+
+    def __init__(self, interval, output):
+        self.interval = interval
+        self.output = output
+        self.threadId = threading.get_ident()
+        self.stacks = collections.Counter()
+        self.running = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.running.set()
+        self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while self.running.is_set():
+            frame = sys._current_frames().get(self.threadId)
+            stack = []
+            while frame is not None:
+                stack.append(f'{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running.clear()
+        self.thread.join()
+        with open(self.output, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
@@ -0,0 +1,106 @@
+import fcntl
+import os
+import struct
+import time
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+# Same layout as the restapi jobmemory module
+SHM_DIR = '/dev/shm'
+VERSION = 1
+HEADER_SIZE = 64
+# Header fields: layout version, seqlock sequence, iteration, state (0 = ping, 1 = pong, 2 = finished), cancel flag
+# (set by the restapi), number of shards, iterations per turn, checkpointed iteration, start time, last handoff time, iterations per second since
+# the start and iteration at the start. Sharded jobs have one uint32 iteration counter per shard after the header.
+_FORMAT = '<IIIBBHIIdddI'
+Header = namedtuple('Header', 'version sequence iteration state cancelled shards turnSize checkpoint startTime handoffTime rate startIteration')
+SEQUENCE = 4
+STATE = 12
+FINISHED = 2
+CANCEL = 13
+# Seqlock reads retried every millisecond, a header still being written after that was torn by a writer that died
+SEQLOCK_RETRIES = 100
+_FIELDS = {
+    'iteration': (8, '<I'),
+    'state': (STATE, '<B'),
+    'checkpoint': (20, '<I'),
+    'handoffTime': (32, '<d'),
+    'rate': (40, '<d'),
+}
+
+def read(buf):
+    """Consistent snapshot of the header, retried while a writer is updating it (seqlock)
+
+    A torn header (the writer died while updating it) fails the job, its message is requeued once then dropped and
+    the restapi janitor reclaims the segments.
+    """
+    for retry in range(SEQLOCK_RETRIES):
+        if retry:
+            time.sleep(0.001)
+        sequence = struct.unpack_from('<I', buf, SEQUENCE)[0]
+        if sequence % 2 == 0:
+            header = Header._make(struct.unpack_from(_FORMAT, buf, 0))
+            if struct.unpack_from('<I', buf, SEQUENCE)[0] == sequence:
+                return header
+    raise RuntimeError(f"Torn status header (sequence {sequence})")
+
+def write(buf, **fields):
+    """Update header fields as one consistent change, only one writer at a time (the agent on turn)"""
+    sequence = struct.unpack_from('<I', buf, SEQUENCE)[0]
+    struct.pack_into('<I', buf, SEQUENCE, sequence + 1)
+    for name, value in fields.items():
+        offset, format = _FIELDS[name]
+        struct.pack_into(format, buf, offset, value)
+    struct.pack_into('<I', buf, SEQUENCE, sequence + 2)
+
+def update_progress(buf, header, iteration, **fields):
+    """Write the new iteration with the average rate since the start"""
+    now = time.time()
+    elapsed = now - header.startTime
+    rate = (iteration - header.startIteration)/elapsed if elapsed > 0 else 0
+    write(buf, iteration=iteration, rate=rate, handoffTime=now, **fields)
+
+def stopped(buf):
+    """Whether the job is finished or cancelled, single bytes read without the seqlock"""
+    return buf[STATE] == FINISHED or buf[CANCEL] != 0
+
+def read_counter(buf, shard):
+    return struct.unpack_from('<I', buf, HEADER_SIZE + 4*shard)[0]
+
+def write_counter(buf, shard, value):
+    # Each shard is the only writer of its counter, 4 byte aligned stores are never torn
+    struct.pack_into('<I', buf, HEADER_SIZE + 4*shard, value)
+
+def read_iteration(buf, shards):
+    """Number of consecutive iterations generated by all the shards of a job"""
+    counters = struct.unpack_from(f'<{shards}I', buf, HEADER_SIZE)
+    return min(counter*shards + shard for shard, counter in enumerate(counters))
+
+class JobStatus:
+    """Status segment of a job attached by an agent
+
+    The agent holds a shared lock on the segment file while it uses the job segments: the restapi only recycles
+    them once it can lock the file exclusively. The kernel drops the lock if the agent dies, nothing is left locked.
+    """
+
+    def __init__(self, jobId):
+        self.shm = shared_memory.SharedMemory(create=False, name=f"{jobId}-status")
+        self.fd = os.open(os.path.join(SHM_DIR, f"{jobId}-status"), os.O_RDWR)
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+        self.buf = self.shm.buf
+        # Released while being attached, the other segments may already be recycled
+        if os.fstat(self.fd).st_nlink == 0:
+            self.close()
+            raise FileNotFoundError(f"{jobId}-status")
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        # Closing the file drops the shared lock
+        os.close(self.fd)
+        self.fd = None
+
+    def __del__(self):
+        # Dropped without being closed (failed job), release the lock so the restapi can reclaim the segments
+        if getattr(self, 'fd', None) is not None:
+            os.close(self.fd)
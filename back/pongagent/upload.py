@@ -0,0 +1,77 @@
+import tempfile
+import zlib
+import requests
+
+# Number of pixels packed at once
+UPLOAD_CHUNK = 65536
+# Compressed uploads are spooled to disk past this size
+SPOOL_SIZE = 64*1024*1024
+
+class _SizedBody:
+    """Iterable body with a known length so requests sends a Content-Length instead of a chunked body"""
+
+    def __init__(self, chunks, length):
+        self.chunks = chunks
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+def _compressor(compression):
+    if compression == '':
+        return None
+    if compression == 'zlib':
+        return zlib.compressobj()
+    if compression == 'zstd':
+        # Optional dependency, only needed when the agent is configured to send zstd
+        import zstandard
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError(f"Unsupported compression {compression}")
+
+def iter_records(posBuf, colBuf, start, end):
+    """Yield chunks of packed 24 bit position/color records read straight from the SHM buffers
+
+    Both buffers hold native uint32 values, only the 3 low bytes are kept (little endian hosts only).
+    """
+    for chunkStart in range(start, end, UPLOAD_CHUNK):
+        chunkEnd = min(chunkStart + UPLOAD_CHUNK, end)
+        chunk = bytearray(6*(chunkEnd - chunkStart))
+        for byte in range(3):
+            chunk[byte::6] = posBuf[4*chunkStart + byte:4*chunkEnd:4].tobytes()
+            chunk[3 + byte::6] = colBuf[4*chunkStart + byte:4*chunkEnd:4].tobytes()
+        yield chunk
+
+def post_records(url, posBuf, colBuf, start, end, compression=''):
+    """POST the records [start, end) to the restapi as an application/octet-stream body"""
+    headers = {'Content-Type': 'application/octet-stream'}
+    compressor = _compressor(compression)
+    if compressor is None:
+        # The size is known upfront, stream the chunks as they are packed
+        body = _SizedBody(iter_records(posBuf, colBuf, start, end), 6*(end - start))
+        return requests.post(url, data=body, headers=headers)
+    # The compressed size is unknown, spool the compressed body so it can be sent with a Content-Length
+    headers['Content-Encoding'] = compression
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+        for chunk in iter_records(posBuf, colBuf, start, end):
+            spool.write(compressor.compress(chunk))
+        spool.write(compressor.flush())
+        body = _SizedBody(iter(lambda: spool.read(UPLOAD_CHUNK), b''), spool.tell())
+        spool.seek(0)
+        return requests.post(url, data=body, headers=headers)
+
+def append_records(url, posBuf, colBuf, start, end, compression=''):
+    """Append the records [start, end) to the job data, resending from what the restapi already stored if needed"""
+    while True:
+        response = post_records(f"{url}?offset={start}", posBuf, colBuf, start, end, compression)
+        # A previous append is missing (failed or still in flight), resend from the stored iteration
+        if response.status_code == 409 and response.json()['iteration'] < start:
+            start = response.json()['iteration']
+            continue
+        # The job has been cancelled, the records are not needed anymore
+        if response.status_code == 410:
+            return response
+        response.raise_for_status()
+        return response
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class PingpongapiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'pingpongapi'
+
+    def ready(self):
+        from . import publisher
+        publisher.setup()
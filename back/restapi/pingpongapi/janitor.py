@@ -0,0 +1,122 @@
+import fcntl
+import os
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.db import close_old_connections
+from multiprocessing import shared_memory
+from . import jobmemory, metrics
+from .models import PingpongJob
+
+# Names of the segments of a job in /dev/shm
+SUFFIXES = ('-pos', '-col', '-status', '-ping-wake', '-pong-wake')
+
+_thread = None
+_threadLock = threading.Lock()
+
+def job_segments():
+  """jobId -> last modification time of the segments of each job found in /dev/shm"""
+  jobs = {}
+  for entry in os.scandir(jobmemory.SHM_DIR):
+    for suffix in SUFFIXES:
+      if entry.name.endswith(suffix):
+        jobId = entry.name[:-len(suffix)]
+        try:
+          # Only the segments named after a job, other programs share /dev/shm
+          uuid.UUID(jobId)
+          modified = entry.stat().st_mtime
+        except (ValueError, FileNotFoundError):
+          break
+        jobs[jobId] = max(jobs.get(jobId, 0), modified)
+        break
+  return jobs
+
+def _last_activity(jobId, modified):
+  """Start or last handoff time of a job, the modification time of its segments without a status
+
+  A torn status header has no activity, its segments are reclaimed once no agent is attached.
+  """
+  try:
+    shmStatus = shared_memory.SharedMemory(create=False, name=f"{jobId}-status")
+  except FileNotFoundError:
+    return modified
+  header = jobmemory.read_status(shmStatus.buf)
+  shmStatus.close()
+  if header is None:
+    return 0
+  return max(header['startTime'], header['handoffTime'])
+
+def _attached(jobId):
+  """Whether an agent holds the segments of a job (shared flock on the status file)"""
+  try:
+    fd = os.open(os.path.join(jobmemory.SHM_DIR, f"{jobId}-status"), os.O_RDONLY)
+  except FileNotFoundError:
+    return False
+  try:
+    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    return False
+  except BlockingIOError:
+    return True
+  finally:
+    os.close(fd)
+
+def sweep():
+  """Reclaim the segments of the jobs that do not need them anymore, returns the number of jobs reclaimed
+
+  - finished: all the data is stored (update_job, or a release that never happened)
+  - cancelled: stopped by cancel_job, same as finished
+  - orphan: no job in the database (creation interrupted), once older than a janitor interval
+  - expired: no progress for PINGPONG_SHM_LEASE seconds and no agent attached (agent crashed, message dropped or
+    never consumed). The job keeps its checkpointed data and is restored if an agent picks it up again.
+  """
+  now = time.time()
+  jobs = job_segments()
+  items = {item.jobId: item for item in PingpongJob.objects.filter(pk__in=list(jobs))}
+  reclaimed = 0
+  for jobId, modified in jobs.items():
+    item = items.get(jobId)
+    if item is None:
+      if now - _last_activity(jobId, modified) < settings.PINGPONG_SHM_JANITOR_INTERVAL:
+        continue
+      reason = 'orphan'
+      # The size class of the job is the capacity of its position segment
+      try:
+        width, height = os.stat(os.path.join(jobmemory.SHM_DIR, f"{jobId}-pos")).st_size//4, 1
+      except FileNotFoundError:
+        width, height = 0, 0
+    elif item.storedIteration == item.width*item.height:
+      reason = 'finished'
+      width, height = item.width, item.height
+    elif item.cancelled:
+      reason = 'cancelled'
+      width, height = item.width, item.height
+    elif now - _last_activity(jobId, modified) >= settings.PINGPONG_SHM_LEASE and not _attached(jobId):
+      reason = 'expired'
+      width, height = item.width, item.height
+    else:
+      continue
+    print(f"Reclaiming the SHM segments of the {reason} job {jobId}")
+    jobmemory.manager.release(jobId, width, height)
+    metrics.inc('r3p_api_shm_reclaimed_total', reason=reason)
+    reclaimed += 1
+  return reclaimed
+
+def _run():
+  while True:
+    time.sleep(settings.PINGPONG_SHM_JANITOR_INTERVAL)
+    try:
+      sweep()
+    except Exception as e:
+      print(f"Unable to sweep the SHM segments: {e}")
+    finally:
+      # Not a request thread, nothing else closes its database connection
+      close_old_connections()
+
+def start():
+  """Sweep the SHM segments periodically in a background thread, once per process"""
+  global _thread
+  with _threadLock:
+    if _thread is None:
+      _thread = threading.Thread(target=_run, name='janitor', daemon=True)
+      _thread.start()
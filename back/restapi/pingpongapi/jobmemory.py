@@ -0,0 +1,521 @@
+import fcntl
+import numpy
+import os
+import queue
+import struct
+import threading
+import time
+import uuid
+from django.conf import settings
+from multiprocessing import resource_tracker, shared_memory
+
+# Number of distinct 24 bit colors
+COLOR_COUNT = 256*256*256
+# Directory holding the POSIX shared memory segments
+SHM_DIR = '/dev/shm'
+# Status segment layout, a 64 bytes header (little endian):
+#   - bytes 0-3: layout version
+#   - bytes 4-7: seqlock sequence, odd while the header is being written
+#   - bytes 8-11: current iteration
+#   - byte 12: current state (0 = ping, 1 = pong, 2 = finished)
+#   - byte 13: cancel flag, set to 1 by the restapi to stop the agents of a job
+#   - bytes 14-15: number of shards of a sharded job, 0 for a ping/pong job
+#   - bytes 16-19: number of iterations generated by an agent before handing over to the other one
+#   - bytes 20-23: iteration up to which the data has been checkpointed to the restapi
+#   - bytes 24-31: start time (epoch seconds, double)
+#   - bytes 32-39: last handoff time (epoch seconds, double)
+#   - bytes 40-47: iterations per second since the start (double)
+#   - bytes 48-51: iteration at the start (0, or the checkpoint the job was restored from)
+#   - bytes 64+: sharded jobs only, one uint32 per shard with the number of iterations generated by the shard
+# Agents hold a shared flock on the status file while they use the job segments
+STATUS_VERSION = 1
+STATUS_SIZE = 64
+STATUS_FORMAT = '<IIIBBHIIdddI'
+STATUS_FIELDS = ('version', 'sequence', 'iteration', 'state', 'cancelled', 'shards', 'turnSize', 'checkpoint', 'startTime',
+  'handoffTime', 'rate', 'startIteration')
+STATUS_CANCEL = 13
+# Seqlock reads retried every millisecond, a header still being written after that was torn by a writer that died
+SEQLOCK_RETRIES = 100
+# Maximum number of shards of a sharded job
+MAX_SHARDS = 256
+
+# Segments waiting in the pool are named r3p-pool-<owner>-<uid>, they are renamed to <jobId>-pos/<jobId>-col when
+# handed out. Each process pooling segments holds an exclusive flock on r3p-owner-<owner> while it lives, the
+# processes sharing /dev/shm only remove the pooled segments of the owners that are gone.
+POOL_PREFIX = 'r3p-pool-'
+OWNER_PREFIX = 'r3p-owner-'
+# Smallest position capacity of the pool size classes (64x64)
+MIN_SIZE_CLASS = 4096
+# Seconds between two attempts to recycle the segments of a job still used by an agent
+RELEASE_RETRY = 0.5
+# Sparse color free lists (jobs of at most PINGPONG_SPARSE_COLORS_MAX positions): a capacity of uint32 values stored
+# densely, followed by an open addressing hash table of 2*capacity (index, value) uint32 pairs holding the values
+# swapped to the indices beyond the capacity. Any other index holds its own value. Index 0 marks an empty slot, it is
+# never beyond the capacity. Same layout and hash as the agents.
+SPARSE_COLOR_BYTES = 20
+_HASH_MULTIPLIER = 2654435761
+# The shards of a sharded job draw color slots from interleaved free lists, slot s of a shard is congruent to the shard
+# modulo the number of shards. The color stored at the iteration is the slot mapped through a fixed bijection of the 24
+# bit colors (multiply by an odd constant then xorshift, twice) so the colors are not tied to the positions modulo the
+# number of shards. Same bijection as the agents.
+COLOR_MIX_MULTIPLIERS = (0x5BD1E5, 0x2C1B3D)
+_COLOR_MASK = COLOR_COUNT - 1
+
+def remove_shm_from_resource_tracker():
+    """Monkey-patch multiprocessing.resource_tracker so SharedMemory won't be tracked
+
+    More details at: https://bugs.python.org/issue38119
+    """
+
+    def fix_register(name, rtype):
+        if rtype == "shared_memory":
+            return
+        return resource_tracker._resource_tracker.register(name, rtype)
+    resource_tracker.register = fix_register
+
+    def fix_unregister(name, rtype):
+        if rtype == "shared_memory":
+            return
+        return resource_tracker._resource_tracker.unregister(name, rtype)
+    resource_tracker.unregister = fix_unregister
+
+    if "shared_memory" in resource_tracker._CLEANUP_FUNCS:
+        del resource_tracker._CLEANUP_FUNCS["shared_memory"]
+
+def size_class(positionCount):
+  """Capacity of the position segments able to hold positionCount positions: the next power of two"""
+  return max(MIN_SIZE_CLASS, 1 << (positionCount - 1).bit_length())
+
+def color_capacity(positionCount, shards=0):
+  """Capacity of the color free list of a job, small ping/pong and solo jobs use a sparse free list"""
+  if shards or positionCount > settings.PINGPONG_SPARSE_COLORS_MAX:
+    return COLOR_COUNT
+  return size_class(positionCount)
+
+def segment_bytes(key):
+  """Size of the pos/col segments of a (suffix, capacity) size class"""
+  suffix, capacity = key
+  if suffix == 'col' and capacity < COLOR_COUNT:
+    return capacity*SPARSE_COLOR_BYTES
+  return capacity*4
+
+def job_bytes(width, height, shards=0):
+  """Bytes of /dev/shm used by the segments of a job"""
+  positionCount = width*height
+  return (segment_bytes(('pos', size_class(positionCount))) + segment_bytes(('col', color_capacity(positionCount, shards)))
+    + STATUS_SIZE + 4*shards)
+
+def used_bytes(pool=False):
+  """Bytes of /dev/shm used by the segments handed out to the jobs, and by the pool if asked"""
+  used = 0
+  for entry in os.scandir(SHM_DIR):
+    if entry.name.startswith(POOL_PREFIX):
+      if pool:
+        used += entry.stat().st_size
+    elif entry.name.endswith(('-pos', '-col', '-status')):
+      used += entry.stat().st_size
+  return used
+
+def init_freelist(buf, count, taken=None, stride=1):
+  """Fill the buffer with a swap-remove free list of the uint32 values 0..count-1
+
+  The values already taken (in iteration order) come first, followed by the values still available.
+  With a stride, the buffer holds stride interleaved free lists: the one at indices s, s + stride, s + 2*stride...
+  only holds the values congruent to s modulo stride.
+  """
+  freelist = numpy.ndarray(count, dtype=numpy.uint32, buffer=buf)
+  if taken is None or len(taken) == 0:
+    freelist[:] = numpy.arange(count, dtype=numpy.uint32)
+    return
+  available = numpy.ones(count, dtype=bool)
+  available[taken] = False
+  freelist[:len(taken)] = taken
+  for shard in range(stride):
+    # First index after the taken values belonging to this shard
+    first = len(taken) + (shard - len(taken)) % stride
+    freelist[first::stride] = numpy.flatnonzero(available[shard::stride])*stride + shard
+
+def shard_colors(slots):
+  """Colors of the color slots drawn by the shards of a sharded job"""
+  values = slots.astype(numpy.uint64)
+  for multiplier in COLOR_MIX_MULTIPLIERS:
+    values = (values*multiplier) & _COLOR_MASK
+    values ^= values >> 12
+  return values.astype(numpy.uint32)
+
+def shard_slots(colors):
+  """Color slots the colors of a sharded job were drawn from, inverse of shard_colors"""
+  values = colors.astype(numpy.uint64)
+  for multiplier in reversed(COLOR_MIX_MULTIPLIERS):
+    values ^= values >> 12
+    values = (values*pow(multiplier, -1, COLOR_COUNT)) & _COLOR_MASK
+  return values.astype(numpy.uint32)
+
+def init_shard_colors(buf, colors, shards):
+  """Fill the buffer with the interleaved color slot free lists of a sharded job, the taken colors (in iteration
+  order) first"""
+  init_freelist(buf, COLOR_COUNT, shard_slots(colors), shards)
+  numpy.ndarray(len(colors), dtype=numpy.uint32, buffer=buf)[:] = colors
+
+def _sparse_slot(table, key):
+  """Slot of the key in a sparse hash table, or of the empty slot it goes to (linear probing)"""
+  slotCount = len(table)
+  slot = ((key*_HASH_MULTIPLIER) & 0xFFFFFFFF) >> (33 - slotCount.bit_length())
+  while table[slot, 0] != key and table[slot, 0] != 0:
+    slot = (slot + 1) % slotCount
+  return slot
+
+def init_sparse_colors(buf, capacity, taken=None):
+  """Fill the buffer with a sparse swap-remove free list of the colors, the taken ones (in iteration order) first"""
+  values = numpy.ndarray(capacity*SPARSE_COLOR_BYTES//4, dtype=numpy.uint32, buffer=buf)
+  head = values[:capacity]
+  table = values[capacity:].reshape(-1, 2)
+  head[:] = numpy.arange(capacity, dtype=numpy.uint32)
+  table[:] = 0
+  if taken is None or len(taken) == 0:
+    return
+  taken = numpy.asarray(taken, dtype=numpy.uint32)
+  head[:len(taken)] = taken
+  # The values below len(taken) that are not taken are the ones the taken values replaced, they move to the indices
+  # of the taken values beyond len(taken)
+  missing = numpy.setdiff1d(numpy.arange(len(taken), dtype=numpy.uint32), taken)
+  moved = numpy.sort(taken[taken >= len(taken)])
+  inHead = moved < capacity
+  head[moved[inHead]] = missing[inHead]
+  for key, value in zip(moved[~inHead].tolist(), missing[~inHead].tolist()):
+    table[_sparse_slot(table, key)] = key, value
+
+def init_status(buf, iteration, turnSize, shards=0):
+  buf[:STATUS_SIZE + 4*shards] = bytes(STATUS_SIZE + 4*shards)
+  struct.pack_into(STATUS_FORMAT, buf, 0, STATUS_VERSION, 0, iteration, 0, 0, shards, turnSize, iteration, time.time(),
+    0, 0, iteration)
+  # Iterations are dealt round robin to the shards
+  for shard in range(shards):
+    struct.pack_into('<I', buf, STATUS_SIZE + 4*shard, len(range(shard, iteration, shards)))
+
+def read_status(buf):
+  """Consistent snapshot of the status header as a dict, lock free (seqlock)
+
+  The agent on turn is the only writer, readers retry while it is updating the header and never hold it up.
+  Returns None if the header is torn (the writer died while updating it), the database row is then authoritative.
+  """
+  for retry in range(SEQLOCK_RETRIES):
+    if retry:
+      time.sleep(0.001)
+    sequence = struct.unpack_from('<I', buf, 4)[0]
+    if sequence % 2 == 0:
+      values = struct.unpack_from(STATUS_FORMAT, buf, 0)
+      if struct.unpack_from('<I', buf, 4)[0] == sequence:
+        return dict(zip(STATUS_FIELDS, values))
+  return None
+
+def read_iteration(buf):
+  """Number of consecutive iterations generated so far
+
+  Shards generate their iterations independently, the iterations are only consecutive up to the first one
+  a shard has not generated yet. None if the header is torn.
+  """
+  header = read_status(buf)
+  if header is None:
+    return None
+  shards = header['shards']
+  if shards == 0:
+    return header['iteration']
+  counters = struct.unpack_from(f'<{shards}I', buf, STATUS_SIZE)
+  return min(counter*shards + shard for shard, counter in enumerate(counters))
+
+def cancel_status(jobId):
+  """Ask the agents of a job to stop at the end of their turn, returns False if the job has no status segment"""
+  try:
+    shmStatus = shared_memory.SharedMemory(create=False, name=f"{jobId}-status")
+  except FileNotFoundError:
+    return False
+  # Only written by the restapi, a single byte the agents poll without the seqlock
+  shmStatus.buf[STATUS_CANCEL] = 1
+  shmStatus.close()
+  return True
+
+def create_status(jobId, iteration, turnSize, shards=0):
+  # The status is created last, agents only start working once it exists
+  shmStatus = shared_memory.SharedMemory(create=True, name=f"{jobId}-status", size=STATUS_SIZE + 4*shards)
+  init_status(shmStatus.buf, iteration, turnSize, shards)
+  shmStatus.close()
+
+def create_handoff(jobId):
+  """Create the named pipes used by the ping and pong agents to wake each other up"""
+  for role in ('ping', 'pong'):
+    os.mkfifo(os.path.join(SHM_DIR, f"{jobId}-{role}-wake"), 0o666)
+
+def create_segments(jobId, width, height, turnSize, positions=None, colors=None, shards=0):
+  """Create and initialise the SHM segments of a job
+
+  positions/colors are the ones already generated when resuming a job from a checkpoint.
+  """
+  iteration = 0 if positions is None else len(positions)
+  # The pos and col buffers double as swap-remove free lists: the first values are the positions/colors generated
+  # so far in iteration order, the following ones are the positions/colors still available in any order
+  positionCount = height*width
+  shmPos = shared_memory.SharedMemory(create=True, name=f"{jobId}-pos", size=positionCount*4)
+  init_freelist(shmPos.buf, positionCount, positions, max(shards, 1))
+  shmPos.close()
+
+  capacity = color_capacity(positionCount, shards)
+  shmCol = shared_memory.SharedMemory(create=True, name=f"{jobId}-col", size=segment_bytes(('col', capacity)))
+  if capacity < COLOR_COUNT:
+    init_sparse_colors(shmCol.buf, capacity, colors)
+  elif shards and colors is not None:
+    init_shard_colors(shmCol.buf, colors, shards)
+  else:
+    init_freelist(shmCol.buf, COLOR_COUNT, colors, max(shards, 1))
+  shmCol.close()
+
+  # Named pipes next to the status segment to wake up the agents when the turn changes
+  create_handoff(jobId)
+  create_status(jobId, iteration, turnSize, shards)
+
+def _unlink(name):
+  try:
+    os.unlink(os.path.join(SHM_DIR, name))
+  except FileNotFoundError:
+    pass
+
+def _owner_alive(owner):
+  """Whether the process that pooled segments under the owner name still runs (holds its owner file)"""
+  try:
+    fd = os.open(os.path.join(SHM_DIR, OWNER_PREFIX + owner), os.O_RDONLY)
+  except FileNotFoundError:
+    return False
+  try:
+    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    return False
+  except BlockingIOError:
+    return True
+  finally:
+    os.close(fd)
+
+def remove_orphan_pools():
+  """Remove the segments pooled by processes that are gone, they are not tracked anymore"""
+  owners = {}
+  for name in os.listdir(SHM_DIR):
+    if name.startswith(POOL_PREFIX):
+      owner = name[len(POOL_PREFIX):].split('-')[0]
+    elif name.startswith(OWNER_PREFIX) and not name.endswith('.tmp'):
+      owner = name[len(OWNER_PREFIX):]
+    else:
+      continue
+    if owner not in owners:
+      owners[owner] = _owner_alive(owner)
+    if not owners[owner]:
+      _unlink(name)
+
+class BudgetExceeded(Exception):
+  """The segments of new jobs do not fit in the SHM budget"""
+
+class JobMemoryManager:
+  """Pool of pre-initialised position/color segments handed out to new jobs
+
+  Position segments and the sparse color segments of the small jobs are pooled per size class (power of two
+  capacity), the dense color segments all have the same size.
+  Handing out a segment is a rename in /dev/shm, so job creation does not depend on the image size. A background
+  thread refills the pools and re-initialises the segments of finished jobs so they can be reused.
+  The pool lives in the budget: it is only refilled within what the jobs leave, and pooled segments are dropped to
+  make room for new jobs.
+  """
+
+  def __init__(self, poolSize, budget):
+    self.poolSize = poolSize
+    # Bytes of /dev/shm the job segments may use
+    self.budget = budget
+    self.lock = threading.Lock()
+    # Serialises the budget check and the allocation of the segments
+    self.admissionLock = threading.Lock()
+    # (suffix, capacity) -> names of the initialised segments waiting in the pool
+    self.pools = {}
+    self.tasks = queue.Queue()
+    self.worker = None
+    # Pooled segments are named after the manager, see OWNER_PREFIX
+    self.owner = uuid.uuid4().hex
+    self.prefix = f"{POOL_PREFIX}{self.owner}-"
+    self.ownerFd = None
+
+  def _start(self):
+    with self.lock:
+      if self.worker is not None:
+        return
+      remove_shm_from_resource_tracker()
+      # Held until the process exits, the kernel drops the lock whatever the way it exits. Locked before being
+      # renamed in place, other processes never see it unlocked
+      ownerPath = os.path.join(SHM_DIR, OWNER_PREFIX + self.owner)
+      self.ownerFd = os.open(ownerPath + '.tmp', os.O_RDONLY | os.O_CREAT, 0o644)
+      fcntl.flock(self.ownerFd, fcntl.LOCK_EX)
+      os.rename(ownerPath + '.tmp', ownerPath)
+      # Segments pooled by a previous run, other processes keep theirs
+      remove_orphan_pools()
+      self.worker = threading.Thread(target=self._run, name='jobmemory', daemon=True)
+      self.worker.start()
+    self.tasks.put(('refill', ('col', COLOR_COUNT)))
+
+  def _run(self):
+    while True:
+      task, *args = self.tasks.get()
+      try:
+        if task == 'refill':
+          key, = args
+          while len(self.pools.get(key, [])) < self.poolSize:
+            # Checked and created under the admission lock, new jobs and the pool never count on the same free bytes
+            with self.admissionLock:
+              if self.budget and used_bytes(pool=True) + segment_bytes(key) > self.budget:
+                break
+              name, shm = self._create_segment(key)
+            self._put(key, self._init_segment(key, name, shm))
+        elif task == 'release':
+          self._release(*args)
+      except OSError as e:
+        print(f"Unable to {task} SHM segments: {e}")
+
+  def _trim(self, excess):
+    """Drop pooled segments until excess bytes are freed, largest first"""
+    with self.lock:
+      for key in sorted(self.pools, key=segment_bytes, reverse=True):
+        pool = self.pools[key]
+        while pool and excess > 0:
+          _unlink(pool.pop())
+          excess -= segment_bytes(key)
+
+  def _create_segment(self, key):
+    name = self.prefix + uuid.uuid4().hex
+    return name, shared_memory.SharedMemory(create=True, name=name, size=segment_bytes(key))
+
+  def _init_segment(self, key, name, shm):
+    if key[0] == 'col' and key[1] < COLOR_COUNT:
+      init_sparse_colors(shm.buf, key[1])
+    else:
+      init_freelist(shm.buf, key[1])
+    shm.close()
+    return name
+
+  def _put(self, key, name):
+    with self.lock:
+      pool = self.pools.setdefault(key, [])
+      if len(pool) < self.poolSize:
+        pool.append(name)
+        return
+    _unlink(name)
+
+  def _recycle(self, key, name, usedCount):
+    with self.lock:
+      full = len(self.pools.get(key, [])) >= self.poolSize
+    if full:
+      _unlink(name)
+      return
+    shm = shared_memory.SharedMemory(create=False, name=name)
+    if key[0] == 'col' and key[1] < COLOR_COUNT:
+      # Small enough to be reset whole
+      init_sparse_colors(shm.buf, key[1])
+      shm.close()
+      self._put(key, name)
+      return
+    # Only the values before usedCount have been swapped around by the agents
+    freelist = numpy.ndarray(key[1], dtype=numpy.uint32, buffer=shm.buf)
+    if key[0] == 'col':
+      freelist[:] = numpy.arange(key[1], dtype=numpy.uint32)
+    else:
+      freelist[:usedCount] = numpy.arange(usedCount, dtype=numpy.uint32)
+    del freelist
+    shm.close()
+    self._put(key, name)
+
+  def _release(self, statusFd, segments, usedCount):
+    if statusFd is not None:
+      try:
+        fcntl.flock(statusFd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        # Agents are still attached (joining their uploads), the segments can not be reused yet
+        threading.Timer(RELEASE_RETRY, self.tasks.put, [('release', statusFd, segments, usedCount)]).start()
+        return
+      os.close(statusFd)
+    for key, name in segments:
+      self._recycle(key, name, usedCount)
+
+  def _take(self, key):
+    with self.lock:
+      pool = self.pools.get(key, [])
+      name = pool.pop() if pool else None
+    self.tasks.put(('refill', key))
+    # Pool miss, initialise a segment on the spot
+    return name if name is not None else self._init_segment(key, *self._create_segment(key))
+
+  def acquire(self, jobId, width, height, turnSize, shards=0):
+    """Hand out a set of initialised segments to a new job, raises BudgetExceeded if they do not fit in the budget"""
+    self.acquire_all([(jobId, width, height, turnSize, shards)])
+
+  def acquire_all(self, jobs):
+    """Hand out the segments of several (jobId, width, height, turnSize, shards) jobs, all of them or none"""
+    self._start()
+    with self.admissionLock:
+      if self.budget:
+        needed = sum(job_bytes(width, height, shards) for jobId, width, height, turnSize, shards in jobs)
+        used = used_bytes()
+        if used + needed > self.budget:
+          raise BudgetExceeded(f"{needed} bytes of SHM needed, {max(self.budget - used, 0)} left out of {self.budget}")
+        # Pooled segments do not count against the jobs, drop the ones in the way of pool misses
+        self._trim(used_bytes(pool=True) + needed - self.budget)
+      for job in jobs:
+        self._acquire(*job)
+
+  def _acquire(self, jobId, width, height, turnSize, shards):
+    # The identity free lists of the pool also are valid interleaved free lists for any number of shards
+    for key in (('pos', size_class(width*height)), ('col', color_capacity(width*height, shards))):
+      os.rename(os.path.join(SHM_DIR, self._take(key)), os.path.join(SHM_DIR, f"{jobId}-{key[0]}"))
+    create_handoff(jobId)
+    create_status(jobId, 0, turnSize, shards)
+
+  def release(self, jobId, width, height):
+    """Take back the segments of a job that does not need them anymore and recycle them once the agents detached"""
+    self._start()
+    try:
+      statusFd = os.open(os.path.join(SHM_DIR, f"{jobId}-status"), os.O_RDONLY)
+    except FileNotFoundError:
+      statusFd = None
+    _unlink(f"{jobId}-status")
+    _unlink(f"{jobId}-ping-wake")
+    _unlink(f"{jobId}-pong-wake")
+    positionCount = width*height
+    segments = []
+    for suffix in ('pos', 'col'):
+      name = self.prefix + uuid.uuid4().hex
+      try:
+        os.rename(os.path.join(SHM_DIR, f"{jobId}-{suffix}"), os.path.join(SHM_DIR, name))
+      except FileNotFoundError:
+        continue
+      size = os.stat(os.path.join(SHM_DIR, name)).st_size
+      if suffix == 'pos':
+        key = ('pos', size_class(positionCount))
+      else:
+        # Dense or sparse depending on the job, told apart by their size
+        key = ('col', COLOR_COUNT if size == COLOR_COUNT*4 else size_class(size//SPARSE_COLOR_BYTES))
+      # Segments restored from a checkpoint are not sized by class, they are not reused
+      if size != segment_bytes(key):
+        _unlink(name)
+        continue
+      segments.append((key, name))
+    self.tasks.put(('release', statusFd, segments, positionCount))
+
+  def clear(self):
+    """Remove the segments pooled by this process and its owner file, once it is done with the SHM"""
+    with self.lock:
+      self.pools.clear()
+      if self.ownerFd is not None:
+        _unlink(OWNER_PREFIX + self.owner)
+        os.close(self.ownerFd)
+        self.ownerFd = None
+    for name in os.listdir(SHM_DIR):
+      if name.startswith(self.prefix):
+        _unlink(name)
+
+def default_budget():
+  """80% of the size of /dev/shm"""
+  stat = os.statvfs(SHM_DIR)
+  return stat.f_frsize*stat.f_blocks*4//5
+
+manager = JobMemoryManager(settings.PINGPONG_SHM_POOL_SIZE, settings.PINGPONG_SHM_BUDGET or default_budget())
@@ -0,0 +1,99 @@
+import numpy
+import os
+import struct
+from django.conf import settings
+
+# One file per job: a header (magic, layout version, width and height of the job) followed by fixed width
+# position/color records in iteration order. The number of valid records is the storedIteration of the job, records
+# written past it (interrupted append) are overwritten by the next append.
+MAGIC = b'R3PD'
+VERSION = 1
+_HEADER = struct.Struct('<4sIII')
+HEADER_SIZE = _HEADER.size
+# Native little endian uint32 fields, read in place through numpy.memmap
+RECORD = numpy.dtype([('position', '<u4'), ('color', '<u4')])
+
+def path(jobId):
+  return os.path.join(settings.PINGPONG_DATA_DIR, f"{jobId}.r3p")
+
+def _records(positions, colors):
+  records = numpy.empty(len(positions), dtype=RECORD)
+  records['position'] = positions
+  records['color'] = colors
+  return records
+
+def _open(filePath, width, height):
+  os.makedirs(settings.PINGPONG_DATA_DIR, exist_ok=True)
+  fd = os.open(filePath, os.O_RDWR | os.O_CREAT, 0o644)
+  if os.fstat(fd).st_size < HEADER_SIZE:
+    os.pwrite(fd, _HEADER.pack(MAGIC, VERSION, width, height), 0)
+  return fd
+
+def _write_chunks(filePath, width, height, offset, chunks, start):
+  fd = _open(filePath, width, height)
+  try:
+    for positions, colors in chunks:
+      # Only the part of the chunk from the iteration start on
+      skip = min(max(start - offset, 0), len(positions))
+      if skip < len(positions):
+        records = _records(positions[skip:], colors[skip:])
+        os.pwrite(fd, records.tobytes(), HEADER_SIZE + (offset + skip)*RECORD.itemsize)
+      offset += len(positions)
+  finally:
+    os.close(fd)
+  return offset
+
+def write(jobId, width, height, offset, positions, colors):
+  """Write the records of the iterations [offset, offset + len(positions)), the writes of a job are serialised"""
+  _write_chunks(path(jobId), width, height, offset, [(positions, colors)], offset)
+
+def write_chunks(jobId, width, height, offset, chunks, start=0):
+  """Write (positions, colors) chunks of records from the iteration offset on as they come, returns the iteration
+  after the last record
+
+  Records before the iteration start are already stored and skipped. Records past the stored iteration of the job
+  only count once the job is updated.
+  """
+  return _write_chunks(path(jobId), width, height, offset, chunks, start)
+
+def replace(jobId, width, height, positions, colors):
+  """Replace all the records of a job, renders still mapping the previous file keep reading it"""
+  replace_chunks(jobId, width, height, [(positions, colors)])
+
+def replace_chunks(jobId, width, height, chunks):
+  """Replace all the records of a job by (positions, colors) chunks written as they come, returns the number of records
+
+  The chunks go to a new file swapped in at the end: renders still mapping the previous file keep reading it, and
+  the previous records are kept if the chunks fail.
+  """
+  filePath = path(jobId)
+  _unlink(filePath + '.tmp')
+  try:
+    count = _write_chunks(filePath + '.tmp', width, height, 0, chunks, 0)
+  except:
+    _unlink(filePath + '.tmp')
+    raise
+  os.replace(filePath + '.tmp', filePath)
+  return count
+
+def read(item, count=None):
+  """Positions and colors of the first count records of a job (all the stored ones by default)
+
+  Both arrays are views of the file mapped in memory, nothing is copied or decoded.
+  """
+  count = item.storedIteration if count is None else min(count, item.storedIteration)
+  if count <= 0:
+    return numpy.empty(0, dtype=numpy.uint32), numpy.empty(0, dtype=numpy.uint32)
+  filePath = path(item.jobId)
+  with open(filePath, 'rb') as f:
+    magic, version, width, height = _HEADER.unpack(f.read(HEADER_SIZE))
+  if magic != MAGIC or version != VERSION:
+    raise ValueError(f"{filePath} is not a version {VERSION} job data file")
+  records = numpy.memmap(filePath, dtype=RECORD, mode='r', offset=HEADER_SIZE, shape=(count,))
+  return records['position'], records['color']
+
+def _unlink(filePath):
+  try:
+    os.unlink(filePath)
+  except FileNotFoundError:
+    pass
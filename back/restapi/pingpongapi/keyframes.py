@@ -0,0 +1,85 @@
+import numpy
+import os
+import threading
+from django.conf import settings
+from . import jobstore, pixels, rendercache
+
+# Builds are serialized, the keyframes of a job are built once whatever the number of concurrent renders
+_buildLock = threading.Lock()
+# The keyframes of the least recently rendered jobs are removed beyond PINGPONG_KEYFRAME_BUDGET bytes
+budget = rendercache.FileBudget(settings.PINGPONG_KEYFRAME_BUDGET, '-keyframes.npy')
+
+def _path(jobId):
+  return os.path.join(settings.PINGPONG_KEYFRAME_DIR, f"{jobId}-keyframes.npy")
+
+def keyframe_iterations(positionCount):
+  """Iterations of the keyframes of a job, every PINGPONG_KEYFRAME_INTERVAL iterations and at the last one"""
+  return list(range(settings.PINGPONG_KEYFRAME_INTERVAL, positionCount, settings.PINGPONG_KEYFRAME_INTERVAL)) + [positionCount]
+
+def build(item):
+  """Save the keyframe images of a complete job
+
+  The keyframes are written straight to a memory mapped .npy file, only the image being drawn is held in memory.
+  """
+  keyframesPath = _path(item.jobId)
+  with _buildLock:
+    if os.path.exists(keyframesPath):
+      budget.touch(keyframesPath)
+      return
+    os.makedirs(settings.PINGPONG_KEYFRAME_DIR, exist_ok=True)
+    positions, colors = jobstore.read(item)
+    positionCount = item.width*item.height
+    iterations = keyframe_iterations(positionCount)
+    # Written next to the final file and renamed, a file that exists is always complete
+    keyframes = numpy.lib.format.open_memmap(keyframesPath + '.tmp', mode='w+', dtype='<u4',
+      shape=(len(iterations), positionCount))
+    # Each keyframe is the previous one plus the records in between
+    image = numpy.full(positionCount, pixels.BLACK, dtype='<u4')
+    previous = 0
+    for index, iteration in enumerate(iterations):
+      image[positions[previous:iteration]] = pixels.to_rgba(colors[previous:iteration])
+      keyframes[index] = image
+      previous = iteration
+    keyframes.flush()
+    del keyframes
+    os.replace(keyframesPath + '.tmp', keyframesPath)
+    budget.add(keyframesPath)
+
+def discard(jobId):
+  """Remove the keyframes of a job whose data has been replaced"""
+  with _buildLock:
+    budget.remove(_path(jobId))
+    try:
+      os.unlink(_path(jobId))
+    except FileNotFoundError:
+      pass
+
+def render(item, iteration):
+  """Raw RGBA bytes of a complete job at the given iteration
+
+  The image starts from the nearest keyframe, before or after the iteration. Positions are only drawn once, so
+  going back from a later keyframe is blanking the positions drawn since the iteration.
+  """
+  # Built or marked as used, the file stays mapped if it is evicted by another build while the image is drawn
+  build(item)
+  positions, colors = jobstore.read(item)
+  try:
+    keyframes = numpy.load(_path(item.jobId), mmap_mode='r')
+  except FileNotFoundError:
+    # Evicted right after the build
+    build(item)
+    keyframes = numpy.load(_path(item.jobId), mmap_mode='r')
+  positionCount = item.width*item.height
+  # The blank image at iteration 0 is an implicit keyframe
+  iterations = [0] + keyframe_iterations(positionCount)
+  index = min(range(len(iterations)), key=lambda i: abs(iterations[i] - iteration))
+  keyframe = iterations[index]
+  if index == 0:
+    image = numpy.full(positionCount, pixels.BLACK, dtype='<u4')
+  else:
+    image = numpy.array(keyframes[index - 1])
+  if iteration > keyframe:
+    image[positions[keyframe:iteration]] = pixels.to_rgba(colors[keyframe:iteration])
+  elif iteration < keyframe:
+    image[positions[iteration:keyframe]] = pixels.BLACK
+  return image.tobytes()
@@ -0,0 +1,173 @@
+import json
+import multiprocessing
+import numpy
+import os
+import requests
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from pingpongapi import jobmemory, jobstore, keyframes, metrics, pixels, publisher
+from pingpongapi.models import PingpongJob
+
+class _QuietHandler(WSGIRequestHandler):
+  def log_message(self, format, *args):
+    pass
+
+class LocalBroker:
+  """In-process stand-in for the RabbitMQ publisher of create_job, keeps the published messages"""
+
+  def __init__(self):
+    self.messages = []
+
+  def publish(self, messages):
+    self.messages.extend((routingKey, json.loads(body)) for routingKey, body, priority in messages)
+
+def parse_size(size):
+  try:
+    width, height = (int(value) for value in size.lower().split('x'))
+  except ValueError:
+    raise CommandError(f"Invalid size {size}, expected WxH")
+  return width, height
+
+def pack_records(positions, colors):
+  """Packed 24 bit position/color records, the body uploaded by the agents"""
+  records = numpy.empty((len(positions), pixels.RECORD_SIZE), dtype=numpy.uint8)
+  for byte in range(3):
+    records[:, byte] = (positions >> (8*byte)) & 0xFF
+    records[:, 3 + byte] = (colors >> (8*byte)) & 0xFF
+  return records.tobytes()
+
+def peak_rss(snapshot):
+  values = [value for (name, labels), value in snapshot.items() if name == 'r3p_agent_worker_peak_rss_bytes']
+  # Sum of the single observation made by the worker
+  return max((value[-2] for value in values), default=0)
+
+class Command(BaseCommand):
+  help = ("Benchmark the job creation, the generation by the real agents, the update ingestion and the render encoding "
+    "against local SHM segments, without RabbitMQ. Prints one JSON line per image size.")
+
+  def add_arguments(self, parser):
+    parser.add_argument('sizes', nargs='*', default=['56x56', '128x128', '256x256'], help='image sizes (WxH)')
+    parser.add_argument('--turn-size', type=int, default=1, help='iterations generated by an agent per turn')
+    parser.add_argument('--shards', type=int, default=0, help='generate with N shard agents instead of ping and pong')
+    parser.add_argument('--solo', action='store_true', help='generate with a solo agent instead of ping and pong')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the solo jobs, fixed so the runs are comparable')
+    parser.add_argument('--agent-dir', default=str(settings.BASE_DIR.parent / 'pongagent'), help='directory of agent.py')
+    parser.add_argument('--output', help='append the results to this file instead of printing them')
+
+  def handle(self, *args, **options):
+    sizes = [parse_size(size) for size in options['sizes']]
+    # Throwaway database, data files, tile pyramids and keyframes, the benchmark jobs never end up in the real ones
+    testDir = tempfile.mkdtemp(prefix='r3p-benchmark-')
+    settings.PINGPONG_DATA_DIR = os.path.join(testDir, 'data')
+    settings.PINGPONG_TILE_DIR = os.path.join(testDir, 'tiles')
+    settings.PINGPONG_KEYFRAME_DIR = os.path.join(testDir, 'keyframes')
+    databaseName = connection.settings_dict['NAME']
+    connection.settings_dict['TEST']['NAME'] = os.path.join(testDir, 'db.sqlite3')
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    server = ThreadedWSGIServer(('127.0.0.1', 0), _QuietHandler)
+    server.set_app(get_wsgi_application())
+    threading.Thread(target=server.serve_forever, name='benchmark-server', daemon=True).start()
+    # The agents upload their records to the local server
+    os.environ['PONGAPI_HOST'] = '127.0.0.1'
+    os.environ['PONGAPI_PORT'] = str(server.server_port)
+    sys.path.insert(0, options['agent_dir'])
+    import agent
+
+    broker = LocalBroker()
+    output = open(options['output'], 'a') if options['output'] else self.stdout
+    try:
+      with mock.patch.object(publisher, 'pool', broker):
+        for width, height in sizes:
+          result = self.run_size(agent, broker, f'http://127.0.0.1:{server.server_port}/pingpong', width, height,
+            options['turn_size'], options['shards'], options['solo'], options['seed'])
+          output.write(json.dumps(result) + '\n')
+          output.flush()
+    finally:
+      if options['output']:
+        output.close()
+      server.shutdown()
+      server.server_close()
+      self.drain()
+      connection.creation.destroy_test_db(databaseName, verbosity=0)
+      shutil.rmtree(testDir)
+
+  def run_size(self, agent, broker, url, width, height, turnSize, shards, solo, seed):
+    result = {'width': width, 'height': height, 'turnSize': turnSize, 'shards': shards, 'solo': solo}
+    broker.messages.clear()
+
+    t1 = time.perf_counter()
+    response = requests.post(f'{url}/create/', json={'width': width, 'height': height, 'turn_size': turnSize,
+      'shards': shards, 'solo': solo, 'seed': seed})
+    result['createSeconds'] = time.perf_counter() - t1
+    if response.status_code != 201:
+      raise CommandError(f"Unable to create a {width}x{height} job: {response.text}")
+    jobId = response.json()['message']['jobId']
+    result['shmBytes'] = metrics.shm_bytes()
+
+    # Fresh worker processes so the peak RSS is the one of this size
+    # The agents log their progress on stdout, keep it for the results
+    stdout = os.dup(1)
+    os.dup2(2, 1)
+    workers = ProcessPoolExecutor(max_workers=2*len(broker.messages),
+      mp_context=multiprocessing.get_context('spawn'), initializer=agent.init_worker)
+    try:
+      t1 = time.perf_counter()
+      futures = []
+      # Same dispatch as the queues of the agents
+      for routingKey, image in broker.messages:
+        if routingKey.startswith('pingpong.shard.'):
+          futures.append(workers.submit(agent.run_worker, agent.run_shard, image))
+        elif routingKey.startswith('pingpong.solo.'):
+          futures.append(workers.submit(agent.run_worker, agent.run_solo, image))
+        else:
+          for role in ('ping', 'pong'):
+            futures.append(workers.submit(agent.run_worker, agent.run_job, role, image))
+      snapshots = [future.result() for future in futures]
+      elapsed = time.perf_counter() - t1
+    finally:
+      workers.shutdown()
+      os.dup2(stdout, 1)
+      os.close(stdout)
+    result['generateSeconds'] = elapsed
+    result['iterationsPerSecond'] = width*height/elapsed
+    result['agentPeakRssBytes'] = max(peak_rss(snapshot) for snapshot in snapshots)
+
+    item = PingpongJob.objects.get(pk=jobId)
+    if item.storedIteration != width*height:
+      raise CommandError(f"Job {jobId} only stored {item.storedIteration} of {width*height} iterations")
+    body = pack_records(*jobstore.read(item))
+    t1 = time.perf_counter()
+    response = requests.post(f'{url}/update/{jobId}/', data=body, headers={'Content-Type': 'application/octet-stream'})
+    result['updateSeconds'] = time.perf_counter() - t1
+    response.raise_for_status()
+
+    # Cold renders, the update dropped the keyframes of the job and bumped its generation
+    for format in ('rgba', 'png'):
+      t1 = time.perf_counter()
+      response = requests.get(f'{url}/render/{jobId}/', params={'output': format})
+      result[f'render{format.capitalize()}Seconds'] = time.perf_counter() - t1
+      response.raise_for_status()
+    keyframes.discard(jobId)
+
+    # Linux reports the peak in kilobytes
+    result['restapiPeakRssBytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+    return result
+
+  def drain(self):
+    """Wait for the segments of the benchmark jobs to be recycled and remove the pooled ones"""
+    # The agents are gone, the pending releases succeed on their next retry
+    time.sleep(2*jobmemory.RELEASE_RETRY)
+    while not jobmemory.manager.tasks.empty():
+      time.sleep(jobmemory.RELEASE_RETRY)
+    jobmemory.manager.clear()
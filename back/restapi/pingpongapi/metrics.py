@@ -0,0 +1,101 @@
+import bisect
+import functools
+import os
+import threading
+import time
+from . import jobmemory
+
+# Default histogram buckets (seconds)
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+# Default histogram buckets (bytes)
+SIZE_BUCKETS = (1024, 16*1024, 256*1024, 4*1024*1024, 64*1024*1024)
+
+_lock = threading.Lock()
+# name -> (type, help, buckets)
+_metrics = {}
+# (name, labels) -> value for counters, [bucket counts..., +Inf count, sum, count] for histograms
+_values = {}
+
+def counter(name, help):
+  _metrics.setdefault(name, ('counter', help, None))
+
+def histogram(name, help, buckets=TIME_BUCKETS):
+  _metrics.setdefault(name, ('histogram', help, buckets))
+
+def inc(name, value=1, **labels):
+  key = (name, tuple(sorted(labels.items())))
+  with _lock:
+    _values[key] = _values.get(key, 0) + value
+
+def observe(name, value, **labels):
+  buckets = _metrics[name][2]
+  key = (name, tuple(sorted(labels.items())))
+  with _lock:
+    values = _values.get(key)
+    if values is None:
+      values = _values[key] = [0]*(len(buckets) + 3)
+    values[bisect.bisect_left(buckets, value)] += 1
+    values[-2] += value
+    values[-1] += 1
+
+def timed(view):
+  """Record the duration of a view in r3p_api_request_seconds"""
+  @functools.wraps(view)
+  def wrapper(request, *args, **kwargs):
+    t1 = time.perf_counter()
+    try:
+      return view(request, *args, **kwargs)
+    finally:
+      observe('r3p_api_request_seconds', time.perf_counter() - t1, view=view.__name__)
+  return wrapper
+
+def shm_bytes():
+  """Bytes of /dev/shm used by the job segments and the pool"""
+  used = {'job': 0, 'pool': 0}
+  for entry in os.scandir(jobmemory.SHM_DIR):
+    if entry.name.startswith(jobmemory.POOL_PREFIX):
+      used['pool'] += entry.stat().st_blocks*512
+    elif entry.name.endswith(('-pos', '-col', '-status')):
+      used['job'] += entry.stat().st_blocks*512
+  return used
+
+def _labels(labels, extra=()):
+  labels = list(labels) + list(extra)
+  if not labels:
+    return ''
+  return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+def render():
+  """Prometheus text exposition of the metrics"""
+  lines = []
+  with _lock:
+    values = sorted(_values.items())
+  for name, (type, help, buckets) in sorted(_metrics.items()):
+    lines.append(f'# HELP {name} {help}')
+    lines.append(f'# TYPE {name} {type}')
+    for (valueName, labels), value in values:
+      if valueName != name:
+        continue
+      if type != 'histogram':
+        lines.append(f'{name}{_labels(labels)} {value}')
+        continue
+      cumulated = 0
+      for bound, count in zip(list(buckets) + ['+Inf'], value):
+        cumulated += count
+        lines.append(f'{name}_bucket{_labels(labels, [("le", bound)])} {cumulated}')
+      lines.append(f'{name}_sum{_labels(labels)} {value[-2]}')
+      lines.append(f'{name}_count{_labels(labels)} {value[-1]}')
+  # Sampled at scrape time
+  lines.append('# HELP r3p_shm_bytes Bytes of /dev/shm used by the job segments and the segment pool')
+  lines.append('# TYPE r3p_shm_bytes gauge')
+  for kind, used in shm_bytes().items():
+    lines.append(f'r3p_shm_bytes{{kind="{kind}"}} {used}')
+  return '\n'.join(lines) + '\n'
+
+histogram('r3p_api_request_seconds', 'Duration of the restapi views')
+histogram('r3p_api_render_bytes', 'Size of the rendered images', SIZE_BUCKETS)
+counter('r3p_api_render_cache_total', 'Render cache lookups')
+counter('r3p_api_records_total', 'Records stored through update and append')
+counter('r3p_api_shm_reclaimed_total', 'Jobs whose SHM segments were reclaimed by the janitor')
+counter('r3p_api_jobs_rejected_total', 'Jobs rejected because their SHM segments did not fit in the budget')
+counter('r3p_api_jobs_cancelled_total', 'Jobs cancelled before completion')
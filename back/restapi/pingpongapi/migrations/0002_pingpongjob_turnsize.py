@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 08:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pingpongapi', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pingpongjob',
+            name='turnSize',
+            field=models.IntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2 on 2026-10-18 08:54
+
+from django.db import migrations, models
+
+
+def set_stored_iteration(apps, schema_editor):
+    # Jobs with data were uploaded in one go at the end, their data holds all the iterations
+    PingpongJob = apps.get_model('pingpongapi', 'PingpongJob')
+    PingpongJob.objects.exclude(data='[]').update(storedIteration=models.F('iteration'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pingpongapi', '0002_pingpongjob_turnsize'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pingpongjob',
+            name='storedIteration',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(set_stored_iteration, migrations.RunPython.noop),
+    ]
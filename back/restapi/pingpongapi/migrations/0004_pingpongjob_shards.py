@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pingpongapi', '0003_pingpongjob_storediteration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pingpongjob',
+            name='shards',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+def export_data(apps, schema_editor):
+    from pingpongapi import jobstore, pixels
+    PingpongJob = apps.get_model('pingpongapi', 'PingpongJob')
+    for item in PingpongJob.objects.iterator():
+        positions, colors = pixels.decode_json_data(item.data)
+        jobstore.replace(item.jobId, item.width, item.height, positions[:item.storedIteration], colors[:item.storedIteration])
+
+
+def import_data(apps, schema_editor):
+    from pingpongapi import jobstore, pixels
+    PingpongJob = apps.get_model('pingpongapi', 'PingpongJob')
+    for item in PingpongJob.objects.iterator():
+        try:
+            positions, colors = jobstore.read(item)
+        except FileNotFoundError:
+            continue
+        item.data = pixels.encode_json_data(positions, colors)
+        item.save(update_fields=['data'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pingpongapi', '0004_pingpongjob_shards'),
+    ]
+
+    operations = [
+        migrations.RunPython(export_data, import_data),
+        # A default so the field can be added back to the existing rows when unapplied
+        migrations.AlterField(
+            model_name='pingpongjob',
+            name='data',
+            field=models.TextField(default='[]'),
+        ),
+        migrations.RemoveField(
+            model_name='pingpongjob',
+            name='data',
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 09:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pingpongapi', '0005_move_data_to_jobstore'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pingpongjob',
+            name='seed',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='pingpongjob',
+            name='solo',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pingpongapi', '0006_pingpongjob_solo'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pingpongjob',
+            name='cancelled',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='pingpongjob',
+            name='priority',
+            field=models.SmallIntegerField(default=0),
+        ),
+    ]
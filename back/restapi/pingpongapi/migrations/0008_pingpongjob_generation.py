@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pingpongapi', '0007_pingpongjob_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pingpongjob',
+            name='generation',
+            field=models.IntegerField(default=0),
+        ),
+    ]
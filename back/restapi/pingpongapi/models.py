@@ -6,7 +6,21 @@ class PingpongJob(models.Model):
     width = models.IntegerField()
     height = models.IntegerField()
     iteration = models.IntegerField()
-    data = models.TextField()
+    turnSize = models.IntegerField(default=1)
+    # Number of iterations stored in the data file, the iteration is only a progress report while the job is running
+    storedIteration = models.IntegerField(default=0)
+    # Number of agents generating the job in parallel, 0 for a ping/pong job
+    shards = models.IntegerField(default=0)
+    # Generated in a few vectorized steps by a single solo agent, from the random draws of the seed
+    solo = models.BooleanField(default=False)
+    seed = models.BigIntegerField(default=0)
+    # RabbitMQ priority of the messages of a solo or sharded job (0 to 9), within the queues of its size class
+    priority = models.SmallIntegerField(default=0)
+    # Stopped before completion, the data stored so far is kept
+    cancelled = models.BooleanField(default=False)
+    # Bumped each time the data is replaced (update), the renders of a previous generation are stale
+    generation = models.IntegerField(default=0)
+    # The position/color records are stored in a file per job, see jobstore
 
     def __str__(self):
         return self.jobId
\ No newline at end of file
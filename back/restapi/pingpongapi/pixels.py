@@ -0,0 +1,107 @@
+import json
+import numpy
+import zlib
+import zstandard
+
+# Binary records are a 24 bit little endian position followed by a 24 bit little endian color
+RECORD_SIZE = 6
+# Number of bytes read from the request body at once
+READ_CHUNK_SIZE = 1 << 20
+
+# Largest value of a 24 bit position or color
+MAX_VALUE = (1 << 24) - 1
+
+def decode_json_data(data):
+  """Decode the JSON encoded ``[[pos1, color1], [pos2, color2], ...]`` array into two uint32 arrays
+
+  Raises ValueError if the data is not such an array of 24 bit integers.
+  """
+  if isinstance(data, str) and data.strip() == '':
+    return numpy.empty(0, dtype=numpy.uint32), numpy.empty(0, dtype=numpy.uint32)
+  try:
+    values = numpy.array(json.loads(data) if isinstance(data, str) else data)
+  except (TypeError, ValueError):
+    raise ValueError("Invalid data, expected a JSON array of [position, color] pairs")
+  if values.shape == (0,):
+    return numpy.empty(0, dtype=numpy.uint32), numpy.empty(0, dtype=numpy.uint32)
+  if values.ndim != 2 or values.shape[1] != 2 or values.dtype.kind not in 'iu' or values.min() < 0 or values.max() > MAX_VALUE:
+    raise ValueError("Invalid data, expected a JSON array of [position, color] pairs of 24 bit integers")
+  values = values.astype(numpy.uint32)
+  return values[:, 0], values[:, 1]
+
+def check_records(positions, offset, positionCount):
+  """Raise ValueError if records written from the iteration offset on do not fit in a job of positionCount pixels"""
+  if offset + len(positions) > positionCount:
+    raise ValueError(f"Records past the last iteration {positionCount} of the job")
+  if len(positions) and int(positions.max()) >= positionCount:
+    raise ValueError(f"Positions past the last pixel {positionCount - 1} of the job")
+
+def iter_checked_records(chunks, offset, positionCount):
+  """Pass (positions, colors) chunks through, raises ValueError before the first chunk which does not fit in the job"""
+  for positions, colors in chunks:
+    check_records(positions, offset, positionCount)
+    offset += len(positions)
+    yield positions, colors
+
+# Opaque black, the color of the pixels not generated yet
+BLACK = 0xFF000000
+
+def to_rgba(colors):
+  """Convert 0xRRGGBB colors into opaque RGBA pixels read as little endian uint32 (0xAABBGGRR)"""
+  return ((colors >> 16) & 0xFF) | (colors & 0xFF00) | ((colors & 0xFF) << 16) | BLACK
+
+def render_rgba(width, height, positions, colors):
+  """Scatter the colors at their flattened positions and return the raw RGBA bytes of the image"""
+  image = numpy.full(width*height, BLACK, dtype='<u4')
+  image[positions] = to_rgba(colors)
+  return image.tobytes()
+
+def encode_json_data(positions, colors):
+  """Encode two position/color arrays into the JSON ``[[pos1, color1], [pos2, color2], ...]`` array"""
+  return json.dumps(numpy.column_stack((positions, colors)).tolist())
+
+def decode_records(buffer):
+  """Decode a buffer of packed 24 bit position/color records into two uint32 arrays"""
+  records = numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(-1, RECORD_SIZE).astype(numpy.uint32)
+  positions = records[:, 0] | (records[:, 1] << 8) | (records[:, 2] << 16)
+  colors = records[:, 3] | (records[:, 4] << 8) | (records[:, 5] << 16)
+  return positions, colors
+
+def _decompressor(encoding):
+  if encoding in ('', 'identity'):
+    return None
+  if encoding in ('zlib', 'deflate'):
+    return zlib.decompressobj()
+  if encoding == 'zstd':
+    return zstandard.ZstdDecompressor().decompressobj()
+  raise ValueError(f"Unsupported content encoding {encoding}")
+
+def _iter_decompressed(stream, encoding):
+  decompressor = _decompressor(encoding)
+  try:
+    while stream is not None:
+      chunk = stream.read(READ_CHUNK_SIZE)
+      if not chunk:
+        break
+      yield decompressor.decompress(chunk) if decompressor is not None else chunk
+    if decompressor is not None:
+      yield decompressor.flush()
+  except (zlib.error, zstandard.ZstdError) as e:
+    raise ValueError(f"Unable to decompress binary data: {e}")
+
+def iter_binary_data(stream, encoding=''):
+  """Read packed records from a file-like object chunk by chunk and yield them as position/color arrays
+
+  The body can optionally be compressed with zlib or zstd, it is decompressed on the fly so only one chunk
+  is held in memory at a time.
+  """
+  pending = b''
+  for chunk in _iter_decompressed(stream, encoding):
+    chunk = pending + chunk
+    # Keep the trailing partial record for the next chunk
+    usable = len(chunk) - len(chunk) % RECORD_SIZE
+    pending = chunk[usable:]
+    if usable:
+      yield decode_records(memoryview(chunk)[:usable])
+  if pending:
+    raise ValueError("Truncated binary data")
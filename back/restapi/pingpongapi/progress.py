@@ -0,0 +1,113 @@
+import asyncio
+import json
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from multiprocessing import shared_memory
+from . import jobmemory
+from .models import PingpongJob
+
+# jobId -> JobProgress of the jobs streamed to at least one client
+_jobs = {}
+
+class JobProgress:
+  """Sample the progress of a job and fan it out to all the clients streaming it
+
+  A single sampler per job reads the SHM status segment (or the database once the segment is gone) whatever the
+  number of clients, and nothing is written to the database. Each client only keeps the latest update, a slow
+  client skips intermediate updates instead of queueing them.
+  """
+
+  def __init__(self, jobId, total, iteration):
+    self.jobId = jobId
+    self.total = total
+    self.iteration = iteration
+    self.cancelled = False
+    self.subscribers = set()
+    self.task = None
+    self.event = None
+
+  def subscribe(self):
+    queue = asyncio.Queue(maxsize=1)
+    # Late subscribers start from the last update
+    if self.event is not None:
+      queue.put_nowait(self.event)
+    self.subscribers.add(queue)
+    if self.task is None:
+      self.task = asyncio.create_task(self._run())
+    return queue
+
+  def unsubscribe(self, queue):
+    self.subscribers.discard(queue)
+
+  def _publish(self, event):
+    self.event = event
+    for queue in self.subscribers:
+      if queue.full():
+        queue.get_nowait()
+      queue.put_nowait(event)
+
+  def _stored(self):
+    return PingpongJob.objects.values_list('storedIteration', 'cancelled').get(pk=self.jobId)
+
+  async def _run(self):
+    shmStatus = None
+    lastTime, lastIteration = time.monotonic(), self.iteration
+    try:
+      while self.subscribers:
+        if shmStatus is None:
+          try:
+            shmStatus = shared_memory.SharedMemory(create=False, name=f"{self.jobId}-status")
+          except FileNotFoundError:
+            pass
+        iteration = None
+        if shmStatus is not None:
+          # The segment stays mapped after the restapi unlinks it, it then holds the last iteration
+          iteration = jobmemory.read_iteration(shmStatus.buf)
+          self.cancelled = bool(shmStatus.buf[jobmemory.STATUS_CANCEL])
+        if iteration is None:
+          # Not generated yet, generated and uploaded, cancelled, or torn header
+          iteration, self.cancelled = await sync_to_async(self._stored)()
+        # Never go back (segment recycled while being read)
+        self.iteration = max(self.iteration, iteration)
+        now = time.monotonic()
+        rate = (self.iteration - lastIteration)/(now - lastTime)
+        lastTime, lastIteration = now, self.iteration
+        self._publish({'iteration': self.iteration, 'total': self.total, 'rate': rate, 'cancelled': self.cancelled})
+        if self.iteration >= self.total or self.cancelled:
+          break
+        await asyncio.sleep(settings.PINGPONG_PROGRESS_INTERVAL)
+    finally:
+      if shmStatus is not None:
+        shmStatus.close()
+      _jobs.pop(self.jobId, None)
+      if self.iteration < self.total and not self.cancelled:
+        # Stopped on an error, end the streams still attached
+        self._publish(None)
+
+async def stream(item):
+  """Server-Sent Events stream of the progress of a job, ends once the job is complete or cancelled"""
+  progress = _jobs.get(item.jobId)
+  if progress is None:
+    progress = _jobs[item.jobId] = JobProgress(item.jobId, item.width*item.height, item.iteration)
+  queue = progress.subscribe()
+  last = None
+  try:
+    while True:
+      try:
+        event = await asyncio.wait_for(queue.get(), settings.PINGPONG_PROGRESS_KEEPALIVE)
+      except asyncio.TimeoutError:
+        # Comment line keeping idle connections (and proxies) open
+        yield ': keepalive\n\n'
+        continue
+      if event is None:
+        # The progress can not be sampled anymore, tells the client not to reconnect
+        yield 'event: failed\ndata: {}\n\n'
+        break
+      if event['iteration'] != last or event['cancelled']:
+        last = event['iteration']
+        yield f"data: {json.dumps(event)}\n\n"
+      if event['iteration'] >= event['total'] or event['cancelled']:
+        break
+  finally:
+    progress.unsubscribe(queue)
@@ -0,0 +1,71 @@
+import os
+import pika
+import queue
+from django.conf import settings
+
+EXCHANGE = 'pingpongtopic'
+
+class Publisher:
+  """Pool of long-lived RabbitMQ channels publishing the job messages
+
+  Opening a connection costs a TCP and an AMQP handshake, so the channels stay open and are handed out to one
+  request at a time (pika connections are not thread safe). Channels are in confirm mode, a publish returns once
+  the broker took the messages. A channel is connected on first use and reconnected once if the broker dropped it.
+  """
+
+  def __init__(self, host, size):
+    self.parameters = pika.ConnectionParameters(host=host)
+    # Last used first so the busy channels stay warm, None is a slot not connected yet
+    self.channels = queue.LifoQueue()
+    for _ in range(size):
+      self.channels.put(None)
+
+  def _connect(self):
+    connection = pika.BlockingConnection(self.parameters)
+    channel = connection.channel()
+    channel.exchange_declare(exchange=EXCHANGE, exchange_type='topic')
+    channel.confirm_delivery()
+    return channel
+
+  def _close(self, channel):
+    try:
+      channel.connection.close()
+    except pika.exceptions.AMQPError:
+      pass
+
+  def publish(self, messages):
+    """Publish the (routing key, body, priority) messages and wait for the broker to confirm them
+
+    Blocks while all the channels are in use.
+    """
+    channel = self.channels.get()
+    sent = 0
+    try:
+      for attempt in range(2):
+        try:
+          if channel is None or not channel.is_open:
+            channel = self._connect()
+          else:
+            # Send the heartbeats missed while idle, raises if the broker closed the connection meanwhile
+            channel.connection.process_data_events(time_limit=0)
+          # Messages confirmed before a failure are not sent twice
+          for routingKey, body, priority in messages[sent:]:
+            channel.basic_publish(exchange=EXCHANGE, routing_key=routingKey, body=body,
+              properties=pika.BasicProperties(priority=priority))
+            sent += 1
+          return
+        except pika.exceptions.AMQPError:
+          if channel is not None:
+            self._close(channel)
+            channel = None
+          if attempt:
+            raise
+    finally:
+      self.channels.put(channel)
+
+# Set up by PingpongapiConfig.ready, nothing is connected before the first job
+pool = None
+
+def setup():
+  global pool
+  pool = Publisher(os.getenv('RABBITMQ_HOST', 'localhost'), settings.PINGPONG_PUBLISHER_POOL_SIZE)
@@ -0,0 +1,165 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from PIL import Image
+
+# Render formats: content type and Pillow save options, rgba is the raw stream drawn by the UI canvas
+FORMATS = {
+  'rgba': ('application/octet-stream', None),
+  'png': ('image/png', {'format': 'PNG', 'optimize': False}),
+  'webp': ('image/webp', {'format': 'WEBP', 'lossless': True}),
+}
+
+def etag(jobId, generation, iteration, format):
+  return f'"{jobId}-{generation}-{iteration}-{format}"'
+
+def encode(width, height, rgba, format):
+  """Encode the raw RGBA bytes of an image in one of the render formats"""
+  options = FORMATS[format][1]
+  if options is None:
+    return rgba
+  output = io.BytesIO()
+  Image.frombuffer('RGBA', (width, height), rgba, 'raw', 'RGBA', 0, 1).save(output, **options)
+  return output.getvalue()
+
+class RenderCache:
+  """LRU cache of the rendered images keyed by (jobId, generation, iteration, format)
+
+  The stored data of a job is append only until it is replaced, which bumps the generation of the job. The image of
+  a job at a stored iteration of a generation never changes, so the entries never need to be invalidated, the ones
+  of a previous generation are no longer requested and get evicted. Entries evicted from memory are spilled to disk
+  when a disk budget is set, each tier evicts its least recently used entries to stay within its byte budget.
+  """
+
+  def __init__(self, memoryBudget, diskBudget, directory):
+    self.memoryBudget = memoryBudget
+    self.diskBudget = diskBudget
+    self.directory = directory
+    self.lock = threading.Lock()
+    # key -> rendered bytes, and key -> size of the spilled file, least recently used first
+    self.memory = OrderedDict()
+    self.memorySize = 0
+    self.disk = OrderedDict()
+    self.diskSize = 0
+
+  def _path(self, key):
+    jobId, generation, iteration, format = key
+    return os.path.join(self.directory, f"{jobId}-{generation}-{iteration}.{format}")
+
+  def get(self, key):
+    with self.lock:
+      if key in self.memory:
+        self.memory.move_to_end(key)
+        return self.memory[key]
+      if key not in self.disk:
+        return None
+      self.disk.move_to_end(key)
+    try:
+      with open(self._path(key), 'rb') as f:
+        return f.read()
+    except FileNotFoundError:
+      return None
+
+  def put(self, key, content):
+    spilled = []
+    with self.lock:
+      if key in self.memory or len(content) > self.memoryBudget:
+        return
+      self.memory[key] = content
+      self.memorySize += len(content)
+      while self.memorySize > self.memoryBudget:
+        evictedKey, evicted = self.memory.popitem(last=False)
+        self.memorySize -= len(evicted)
+        if evictedKey not in self.disk and len(evicted) <= self.diskBudget:
+          spilled.append((evictedKey, evicted))
+    # Disk writes happen outside of the lock, the entry is only visible once the file is complete
+    for evictedKey, evicted in spilled:
+      self._spill(evictedKey, evicted)
+
+  def _spill(self, key, content):
+    try:
+      os.makedirs(self.directory, exist_ok=True)
+      path = self._path(key)
+      with open(path + '.tmp', 'wb') as f:
+        f.write(content)
+      os.replace(path + '.tmp', path)
+    except OSError as e:
+      print(f"Unable to spill render {key} to disk: {e}")
+      return
+    removed = []
+    with self.lock:
+      self.disk[key] = len(content)
+      self.diskSize += len(content)
+      while self.diskSize > self.diskBudget:
+        evictedKey, size = self.disk.popitem(last=False)
+        self.diskSize -= size
+        removed.append(evictedKey)
+    for evictedKey in removed:
+      try:
+        os.unlink(self._path(evictedKey))
+      except FileNotFoundError:
+        pass
+
+class FileBudget:
+  """LRU index of the files built per job in a directory (keyframes, tile pyramids), kept within a byte budget
+
+  A file is added once complete and touched each time it is used, adding one removes the least recently used ones
+  beyond the budget (never the one just added). The files left by a previous run are indexed by modification time
+  when the directory is first seen.
+  """
+
+  def __init__(self, budget, suffix):
+    self.budget = budget
+    self.suffix = suffix
+    self.lock = threading.Lock()
+    # path -> size, least recently used first
+    self.files = OrderedDict()
+    self.size = 0
+    self.directories = set()
+
+  def _scan(self, directory):
+    if directory in self.directories:
+      return
+    self.directories.add(directory)
+    try:
+      entries = [(entry.stat().st_mtime, entry.path, entry.stat().st_size) for entry in os.scandir(directory)
+        if entry.name.endswith(self.suffix)]
+    except FileNotFoundError:
+      return
+    for mtime, path, size in sorted(entries):
+      if path not in self.files:
+        self.files[path] = size
+        self.size += size
+
+  def touch(self, path):
+    with self.lock:
+      self._scan(os.path.dirname(path))
+      if path in self.files:
+        self.files.move_to_end(path)
+
+  def add(self, path):
+    size = os.stat(path).st_size
+    removed = []
+    with self.lock:
+      self._scan(os.path.dirname(path))
+      self.size += size - self.files.pop(path, 0)
+      self.files[path] = size
+      while self.size > self.budget and len(self.files) > 1:
+        evictedPath, evictedSize = self.files.popitem(last=False)
+        self.size -= evictedSize
+        removed.append(evictedPath)
+    for evictedPath in removed:
+      try:
+        os.unlink(evictedPath)
+      except FileNotFoundError:
+        pass
+
+  def remove(self, path):
+    """Forget a file, the caller removes it"""
+    with self.lock:
+      self.size -= self.files.pop(path, 0)
+
+cache = RenderCache(settings.PINGPONG_RENDER_CACHE_MEMORY, settings.PINGPONG_RENDER_CACHE_DISK,
+  settings.PINGPONG_RENDER_CACHE_DIR)
@@ -5,4 +5,4 @@ from .models import PingpongJob
 class PingpongJobSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = PingpongJob
-        fields = ('jobId', 'width', 'height', 'iteration', 'data')
\ No newline at end of file
+        fields = ('jobId', 'width', 'height', 'iteration', 'turnSize', 'storedIteration', 'shards', 'solo', 'seed', 'priority', 'cancelled', 'generation')
\ No newline at end of file
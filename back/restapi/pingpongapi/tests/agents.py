@@ -0,0 +1,44 @@
+import numpy
+import sys
+from django.conf import settings
+from pingpongapi import jobmemory
+
+# The agents lay out the SHM segments on their own, the tests check both sides agree
+sys.path.insert(0, str(settings.BASE_DIR.parent / 'pongagent'))
+import freelist as agentfreelist
+import status as agentstatus
+
+__all__ = ['agentfreelist', 'agentstatus', 'draw', 'DenseReference', 'sparse_values', 'assert_permutation']
+
+def draw(positions, colors, positionCount, start, end, rng):
+  """Swap-remove draws of the ping/pong agents for the iterations [start, end)"""
+  for iteration in range(start, end):
+    randomIndex = rng.randint(iteration, positionCount - 1)
+    positions[iteration], positions[randomIndex] = positions[randomIndex], positions[iteration]
+    randomIndex = rng.randint(iteration, jobmemory.COLOR_COUNT - 1)
+    colors[iteration], colors[randomIndex] = colors[randomIndex], colors[iteration]
+
+class DenseReference:
+  """Identity free list of all the colors, only the swapped indices are stored"""
+
+  def __init__(self):
+    self.values = {}
+
+  def __getitem__(self, index):
+    return self.values.get(index, index)
+
+  def __setitem__(self, index, value):
+    self.values[index] = value
+
+def sparse_values(colBuf, capacity):
+  """All the values of a sparse color free list read through the agent, as a dense array"""
+  colors = agentfreelist.SparseColors(colBuf)
+  table = numpy.frombuffer(colBuf, dtype=numpy.uint32)[capacity:].reshape(-1, 2)
+  indices = numpy.union1d(numpy.arange(capacity), table[table[:, 0] != 0, 0])
+  values = numpy.arange(jobmemory.COLOR_COUNT, dtype=numpy.uint32)
+  values[indices] = [colors[index] for index in indices.tolist()]
+  colors.release()
+  return values
+
+def assert_permutation(testCase, values):
+  testCase.assertTrue((numpy.bincount(values, minlength=len(values)) == 1).all())
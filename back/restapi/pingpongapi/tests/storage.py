@@ -0,0 +1,12 @@
+import tempfile
+
+def temporary_dirs(testCase, *names):
+  """Point the given directory settings at temporary directories for the duration of a test"""
+  directories = {}
+  for name in names:
+    directory = tempfile.TemporaryDirectory()
+    testCase.addCleanup(directory.cleanup)
+    directories[name] = directory.name
+  override = testCase.settings(**directories)
+  override.enable()
+  testCase.addCleanup(override.disable)
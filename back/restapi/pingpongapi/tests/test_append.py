@@ -0,0 +1,53 @@
+import os
+import uuid
+from django.test import TestCase
+from pingpongapi import jobmemory, jobstore
+from pingpongapi.models import PingpongJob
+from .storage import temporary_dirs
+from .test_upload import encode_records
+
+class AppendTest(TestCase):
+  """append_job only stores contiguous records which fit in the job"""
+
+  def setUp(self):
+    jobmemory.remove_shm_from_resource_tracker()
+    temporary_dirs(self, 'PINGPONG_DATA_DIR', 'PINGPONG_TILE_DIR', 'PINGPONG_KEYFRAME_DIR')
+    self.jobId = str(uuid.uuid4())
+    jobmemory.create_segments(self.jobId, 2, 2, 1)
+    PingpongJob.objects.create(jobId=self.jobId, width=2, height=2, iteration=0)
+
+  def tearDown(self):
+    for suffix in ('-pos', '-col', '-status', '-ping-wake', '-pong-wake'):
+      jobmemory._unlink(self.jobId + suffix)
+
+  def append(self, offset, positions, colors):
+    return self.client.post(f'/pingpong/append/{self.jobId}/?offset={offset}', encode_records(positions, colors),
+      content_type='application/octet-stream')
+
+  def assert_stored(self, positions, colors):
+    item = PingpongJob.objects.get(pk=self.jobId)
+    self.assertEqual(item.storedIteration, len(positions))
+    self.assertEqual([values.tolist() for values in jobstore.read(item)], [positions, colors])
+
+  def test_append(self):
+    self.assertEqual(self.append(0, [2, 1], [5, 6]).status_code, 200)
+    # Retried and overlapping appends only add the records not stored yet
+    self.assertEqual(self.append(0, [2, 1], [5, 6]).status_code, 200)
+    self.assertEqual(self.append(1, [1, 3], [6, 7]).status_code, 200)
+    self.assertEqual(self.append(4, [0], [8]).status_code, 409)
+    self.assert_stored([2, 1, 3], [5, 6, 7])
+    self.assertTrue(os.path.exists(os.path.join(jobmemory.SHM_DIR, f"{self.jobId}-status")))
+    self.assertEqual(self.append(3, [0], [8]).status_code, 200)
+    self.assert_stored([2, 1, 3, 0], [5, 6, 7, 8])
+    # Complete, the segments are released
+    self.assertFalse(os.path.exists(os.path.join(jobmemory.SHM_DIR, f"{self.jobId}-status")))
+
+  def test_outside_job(self):
+    self.assertEqual(self.append(0, [2], [5]).status_code, 200)
+    for offset, positions in ((0, [2, 1, 3, 0, 1, 2]), (1, [1, 3, 0, 2]), (1, [4]), (0, [2, 1 << 20])):
+      self.assertEqual(self.append(offset, positions, [1]*len(positions)).status_code, 400)
+    self.assertEqual(self.append(-1, [2], [5]).status_code, 400)
+    self.assert_stored([2], [5])
+    # The rejected records do not get in the way of the next append
+    self.assertEqual(self.append(1, [1], [6]).status_code, 200)
+    self.assert_stored([2, 1], [5, 6])
@@ -0,0 +1,103 @@
+import numpy
+import random
+from django.test import SimpleTestCase
+from pingpongapi import jobmemory
+from .agents import DenseReference, agentfreelist, assert_permutation, draw, sparse_values
+
+class SparseColorsTest(SimpleTestCase):
+
+  def test_agent_draws_match_dense(self):
+    positionCount = 3000
+    capacity = jobmemory.size_class(positionCount)
+    buf = bytearray(jobmemory.segment_bytes(('col', capacity)))
+    jobmemory.init_sparse_colors(buf, capacity)
+    colors = agentfreelist.color_list(memoryview(buf))
+    self.assertIsInstance(colors, agentfreelist.SparseColors)
+    reference = DenseReference()
+    positions = list(range(positionCount))
+    draw(positions, colors, positionCount, 0, positionCount, random.Random(1))
+    draw(list(range(positionCount)), reference, positionCount, 0, positionCount, random.Random(1))
+    for index in list(range(positionCount)) + list(reference.values):
+      self.assertEqual(colors[index], reference[index])
+    colors.release()
+    assert_permutation(self, sparse_values(memoryview(buf), capacity))
+
+  def test_restore_matches_drawn(self):
+    positionCount = 3000
+    capacity = jobmemory.size_class(positionCount)
+    reference = DenseReference()
+    draw(list(range(positionCount)), reference, positionCount, 0, 2000, random.Random(2))
+    taken = numpy.array([reference[index] for index in range(2000)], dtype=numpy.uint32)
+    buf = bytearray(jobmemory.segment_bytes(('col', capacity)))
+    jobmemory.init_sparse_colors(buf, capacity, taken)
+    values = sparse_values(memoryview(buf), capacity)
+    self.assertTrue((values[:2000] == taken).all())
+    assert_permutation(self, values)
+    # The agent keeps drawing from the restored list
+    colors = agentfreelist.color_list(memoryview(buf))
+    draw(list(range(positionCount)), colors, positionCount, 2000, positionCount, random.Random(3))
+    colors.release()
+    assert_permutation(self, sparse_values(memoryview(buf), capacity))
+
+
+class StridedFreelistTest(SimpleTestCase):
+
+  def test_interleaved_free_lists(self):
+    count, shards = 1000, 3
+    counters = (120, 100, 110)
+    posBuf = bytearray(4*count)
+    jobmemory.init_freelist(posBuf, count)
+    colBuf = bytearray(4*jobmemory.COLOR_COUNT)
+    jobmemory.init_freelist(colBuf, jobmemory.COLOR_COUNT)
+    positions = memoryview(posBuf).cast('I')
+    colors = memoryview(colBuf).cast('I')
+    # Shards at different counters, the iterations are only consecutive up to the slowest one
+    for shard, end in enumerate(counters):
+      agentfreelist.draw_shard(positions, colors, count, shard, shards, 0, end, random.Random(shard))
+    iteration = min(counter*shards + shard for shard, counter in enumerate(counters))
+    takenPositions = numpy.array(positions[:iteration], dtype=numpy.uint32)
+    takenColors = numpy.array(colors[:iteration], dtype=numpy.uint32)
+    positions.release()
+    colors.release()
+    # Values drawn by a shard stay in its interleaved free list
+    self.assertTrue((takenPositions % shards == numpy.arange(iteration) % shards).all())
+    self.assertTrue((jobmemory.shard_slots(takenColors) % shards == numpy.arange(iteration) % shards).all())
+    self.assertEqual(len(numpy.unique(takenColors)), iteration)
+
+    restored = bytearray(4*count)
+    jobmemory.init_freelist(restored, count, takenPositions, shards)
+    values = numpy.frombuffer(restored, dtype=numpy.uint32)
+    self.assertTrue((values[:iteration] == takenPositions).all())
+    self.assertTrue((values % shards == numpy.arange(count) % shards).all())
+    assert_permutation(self, values)
+    restored = bytearray(4*jobmemory.COLOR_COUNT)
+    jobmemory.init_shard_colors(restored, takenColors, shards)
+    values = numpy.frombuffer(restored, dtype=numpy.uint32)
+    self.assertTrue((values[:iteration] == takenColors).all())
+    # The indices after the iteration still hold the slots
+    slots = numpy.concatenate((jobmemory.shard_slots(values[:iteration]), values[iteration:]))
+    self.assertTrue((slots % shards == numpy.arange(jobmemory.COLOR_COUNT) % shards).all())
+    assert_permutation(self, slots)
+
+  def test_color_bijection(self):
+    self.assertEqual(agentfreelist.COLOR_MIX_MULTIPLIERS, jobmemory.COLOR_MIX_MULTIPLIERS)
+    slots = numpy.arange(jobmemory.COLOR_COUNT, dtype=numpy.uint32)
+    colors = jobmemory.shard_colors(slots)
+    assert_permutation(self, colors)
+    self.assertTrue((jobmemory.shard_slots(colors) == slots).all())
+    for slot in random.Random(6).sample(range(jobmemory.COLOR_COUNT), 1000):
+      self.assertEqual(agentfreelist.shard_color(slot), colors[slot])
+
+  def test_colors_independent_of_positions(self):
+    count = 12000
+    for shards in (2, 3, 4):
+      positions = list(range(count))
+      colors = DenseReference()
+      for shard in range(shards):
+        agentfreelist.draw_shard(positions, colors, count, shard, shards, 0, len(range(shard, count, shards)),
+          random.Random(shard))
+      colorResidues = numpy.array([colors[iteration] % shards for iteration in range(count)])
+      # Each (position, color) residue pair is about as frequent as the others
+      pairs = numpy.bincount(numpy.array(positions) % shards*shards + colorResidues, minlength=shards*shards)
+      expected = count/(shards*shards)
+      self.assertTrue((abs(pairs - expected) < 0.15*expected).all(), pairs)
@@ -0,0 +1,72 @@
+import os
+import time
+import uuid
+from django.test import SimpleTestCase
+from pingpongapi import jobmemory
+
+class BudgetTest(SimpleTestCase):
+  """The job segments and the pool stay within the SHM budget"""
+
+  def setUp(self):
+    jobmemory.remove_shm_from_resource_tracker()
+    self.jobIds = []
+
+  def tearDown(self):
+    for jobId in self.jobIds:
+      for suffix in ('-pos', '-col', '-status', '-ping-wake', '-pong-wake'):
+        jobmemory._unlink(jobId + suffix)
+
+  def manager(self, poolSize, budget):
+    manager = jobmemory.JobMemoryManager(poolSize, budget)
+    self.addCleanup(manager.clear)
+    return manager
+
+  def job(self):
+    self.jobIds.append(str(uuid.uuid4()))
+    return (self.jobIds[-1], 64, 64, 1, 0)
+
+  def pooled(self, manager):
+    return sorted(name for name in os.listdir(jobmemory.SHM_DIR) if name.startswith(manager.prefix))
+
+  def test_admission(self):
+    jobBytes = jobmemory.job_bytes(64, 64)
+    budget = jobmemory.used_bytes() + 2*jobBytes
+    manager = self.manager(1, budget)
+    manager.acquire_all([self.job()])
+    manager.acquire(*self.job())
+    with self.assertRaises(jobmemory.BudgetExceeded):
+      manager.acquire(*self.job())
+    self.assertFalse(os.path.exists(os.path.join(jobmemory.SHM_DIR, f"{self.jobIds[-1]}-status")))
+    # The pool is only refilled within what the jobs leave
+    while not manager.tasks.empty():
+      time.sleep(0.05)
+    time.sleep(0.2)
+    poolBytes = sum(os.path.getsize(os.path.join(jobmemory.SHM_DIR, name)) for name in self.pooled(manager))
+    self.assertLessEqual(jobmemory.used_bytes() + poolBytes, budget)
+
+  def test_all_or_none(self):
+    jobBytes = jobmemory.job_bytes(64, 64)
+    manager = self.manager(1, jobmemory.used_bytes() + 3*jobBytes)
+    manager.acquire(*self.job())
+    jobs = [self.job(), self.job(), self.job()]
+    with self.assertRaises(jobmemory.BudgetExceeded):
+      manager.acquire_all(jobs)
+    for jobId, width, height, turnSize, shards in jobs:
+      self.assertFalse(os.path.exists(os.path.join(jobmemory.SHM_DIR, f"{jobId}-pos")))
+    manager.acquire_all(jobs[:2])
+    for jobId, width, height, turnSize, shards in jobs[:2]:
+      self.assertTrue(os.path.exists(os.path.join(jobmemory.SHM_DIR, f"{jobId}-status")))
+
+  def test_trim(self):
+    manager = self.manager(2, 0)
+    small, large = ('pos', 4096), ('pos', 16384)
+    for key in (small, large):
+      for index in range(2):
+        manager._put(key, manager._init_segment(key, *manager._create_segment(key)))
+    self.assertEqual(len(self.pooled(manager)), 4)
+    # Largest segments first, as few as needed
+    manager._trim(1)
+    self.assertEqual((len(manager.pools[small]), len(manager.pools[large])), (2, 1))
+    manager._trim(jobmemory.segment_bytes(large) + 1)
+    self.assertEqual((len(manager.pools[small]), len(manager.pools[large])), (1, 0))
+    self.assertEqual(self.pooled(manager), sorted(manager.pools[small]))
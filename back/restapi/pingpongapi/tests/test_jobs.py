@@ -0,0 +1,29 @@
+from django.test import SimpleTestCase, TestCase
+from pingpongapi import views
+from pingpongapi.models import PingpongJob
+
+class PriorityTest(SimpleTestCase):
+
+  def test_priority(self):
+    for spec in ({'shards': 2}, {'solo': True}):
+      job = views.parse_job(dict(spec, width=10, height=10, priority=5))
+      self.assertEqual(job['priority'], 5)
+      self.assertEqual({priority for routingKey, body, priority in views.job_messages(job)}, {5})
+    job = views.parse_job({'width': 10, 'height': 10})
+    self.assertEqual(views.job_messages(job)[0][2], None)
+    for priority in (-1, 10, 'high'):
+      with self.assertRaises(ValueError):
+        views.parse_job({'width': 10, 'height': 10, 'shards': 2, 'priority': priority})
+
+class PingPongPriorityTest(TestCase):
+
+  def test_rejected(self):
+    # The ping and pong queues are FIFO, a priority would never be applied
+    with self.assertRaises(ValueError):
+      views.parse_job({'width': 10, 'height': 10, 'priority': 1})
+    response = self.client.post('/pingpong/create/', {'width': 10, 'height': 10, 'priority': 1}, content_type='application/json')
+    self.assertEqual(response.status_code, 400)
+    response = self.client.post('/pingpong/create/bulk/', {'jobs': [{'width': 10, 'height': 10, 'shards': 2, 'priority': 1},
+      {'width': 10, 'height': 10, 'priority': 1}]}, content_type='application/json')
+    self.assertEqual(response.status_code, 400)
+    self.assertFalse(PingpongJob.objects.exists())
@@ -0,0 +1,49 @@
+import numpy
+import os
+import uuid
+from django.test import TestCase
+from unittest import mock
+from pingpongapi import jobstore, keyframes, pixels, rendercache
+from pingpongapi.models import PingpongJob
+from .storage import temporary_dirs
+
+class KeyframesTest(TestCase):
+  """Renders from the keyframes match the images drawn from the records"""
+
+  def setUp(self):
+    temporary_dirs(self, 'PINGPONG_DATA_DIR', 'PINGPONG_KEYFRAME_DIR')
+    override = self.settings(PINGPONG_KEYFRAME_INTERVAL=7)
+    override.enable()
+    self.addCleanup(override.disable)
+
+  def create_job(self, width, height, seed):
+    rng = numpy.random.default_rng(seed)
+    positionCount = width*height
+    item = PingpongJob.objects.create(jobId=str(uuid.uuid4()), width=width, height=height, iteration=positionCount,
+      storedIteration=positionCount)
+    jobstore.write(item.jobId, width, height, 0, rng.permutation(positionCount).astype(numpy.uint32),
+      rng.choice(1 << 24, positionCount, replace=False).astype(numpy.uint32))
+    return item
+
+  def test_render(self):
+    item = self.create_job(6, 5, 1)
+    for iteration in range(item.storedIteration + 1):
+      self.assertEqual(keyframes.render(item, iteration),
+        pixels.render_rgba(item.width, item.height, *jobstore.read(item, iteration)), iteration)
+
+  def test_budget(self):
+    items = [self.create_job(6, 5, seed) for seed in range(3)]
+    for item in items[:2]:
+      keyframes.render(item, 10)
+    fileSize = os.path.getsize(keyframes._path(items[0].jobId))
+    # Room for the keyframes of two jobs
+    budget = rendercache.FileBudget(2*fileSize, '-keyframes.npy')
+    self.enterContext(mock.patch.object(keyframes, 'budget', budget))
+    # The first job is used again, the second one is the least recently used
+    keyframes.render(items[0], 10)
+    keyframes.render(items[2], 10)
+    self.assertTrue(os.path.exists(keyframes._path(items[0].jobId)))
+    self.assertFalse(os.path.exists(keyframes._path(items[1].jobId)))
+    # Built again when rendered
+    self.assertEqual(keyframes.render(items[1], 10), pixels.render_rgba(6, 5, *jobstore.read(items[1], 10)))
+    self.assertFalse(os.path.exists(keyframes._path(items[0].jobId)))
@@ -0,0 +1,40 @@
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TransactionTestCase
+from pingpongapi import jobstore
+from .storage import temporary_dirs
+
+class MoveDataMigrationTest(TransactionTestCase):
+  """Migration 0005 moves the JSON data of the jobs to the jobstore files and back"""
+
+  before = [('pingpongapi', '0004_pingpongjob_shards')]
+  after = [('pingpongapi', '0005_move_data_to_jobstore')]
+
+  def setUp(self):
+    temporary_dirs(self, 'PINGPONG_DATA_DIR')
+    self.addCleanup(self.migrate, MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+  def migrate(self, targets):
+    executor = MigrationExecutor(connection)
+    executor.loader.build_graph()
+    executor.migrate(targets)
+    return executor.loader.project_state(targets).apps
+
+  def test_round_trip(self):
+    apps = self.migrate(self.before)
+    PingpongJob = apps.get_model('pingpongapi', 'PingpongJob')
+    PingpongJob.objects.create(jobId='partial', width=2, height=2, iteration=3, storedIteration=2,
+      data='[[3, 16777215], [0, 5], [1, 6]]')
+    PingpongJob.objects.create(jobId='empty', width=2, height=2, iteration=0, data='')
+
+    apps = self.migrate(self.after)
+    # Only the stored iterations are moved
+    item = apps.get_model('pingpongapi', 'PingpongJob').objects.get(pk='partial')
+    self.assertEqual([values.tolist() for values in jobstore.read(item)], [[3, 0], [16777215, 5]])
+    item = apps.get_model('pingpongapi', 'PingpongJob').objects.get(pk='empty')
+    self.assertEqual([values.tolist() for values in jobstore.read(item)], [[], []])
+
+    apps = self.migrate(self.before)
+    PingpongJob = apps.get_model('pingpongapi', 'PingpongJob')
+    self.assertEqual(PingpongJob.objects.get(pk='partial').data, '[[3, 16777215], [0, 5]]')
+    self.assertEqual(PingpongJob.objects.get(pk='empty').data, '[]')
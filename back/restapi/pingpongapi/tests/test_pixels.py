@@ -0,0 +1,53 @@
+import numpy
+import random
+import uuid
+from django.test import SimpleTestCase, TestCase
+from pingpongapi import jobstore, pixels
+from pingpongapi.models import PingpongJob
+from .storage import temporary_dirs
+
+def reference_rgba(width, height, positions, colors):
+  """Image drawn pixel by pixel"""
+  image = [pixels.BLACK]*(width*height)
+  for position, color in zip(positions, colors):
+    image[position] = 0xFF000000 | (color & 0xFF) << 16 | (color & 0xFF00) | color >> 16
+  return numpy.array(image, dtype='<u4').tobytes()
+
+class RenderRgbaTest(SimpleTestCase):
+
+  def test_scatter(self):
+    positions = numpy.array([5, 0, 11], dtype=numpy.uint32)
+    colors = numpy.array([0x112233, 0xFFFFFF, 0x0000FF], dtype=numpy.uint32)
+    rgba = pixels.render_rgba(4, 3, positions, colors)
+    self.assertEqual(rgba, reference_rgba(4, 3, positions, colors))
+    self.assertEqual(rgba[20:24], bytes([0x11, 0x22, 0x33, 0xFF]))
+
+class RenderIterationTest(TestCase):
+  """render_job only applies the records up to ?iteration"""
+
+  def setUp(self):
+    temporary_dirs(self, 'PINGPONG_DATA_DIR')
+    self.width, self.height = 7, 5
+    rng = random.Random(5)
+    self.positions = numpy.array(rng.sample(range(self.width*self.height), 20), dtype=numpy.uint32)
+    self.colors = numpy.array(rng.sample(range(1 << 24), 20), dtype=numpy.uint32)
+    self.item = PingpongJob.objects.create(jobId=str(uuid.uuid4()), width=self.width, height=self.height, iteration=20,
+      storedIteration=20)
+    jobstore.write(self.item.jobId, self.width, self.height, 0, self.positions, self.colors)
+
+  def render(self, query):
+    response = self.client.get(f'/pingpong/render/{self.item.jobId}/{query}')
+    self.assertEqual(response.status_code, 200)
+    return response.content
+
+  def test_iterations(self):
+    for iteration in (0, 1, 13, 20):
+      self.assertEqual(self.render(f'?iteration={iteration}'),
+        reference_rgba(self.width, self.height, self.positions[:iteration], self.colors[:iteration]))
+    # Clamped to the stored records
+    self.assertEqual(self.render('?iteration=100'), self.render(''))
+    self.assertEqual(self.render(''), reference_rgba(self.width, self.height, self.positions, self.colors))
+
+  def test_invalid_iteration(self):
+    response = self.client.get(f'/pingpong/render/{self.item.jobId}/?iteration=abc')
+    self.assertEqual(response.status_code, 400)
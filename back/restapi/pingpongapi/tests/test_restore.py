@@ -0,0 +1,105 @@
+import numpy
+import random
+import uuid
+from django.test import TestCase
+from multiprocessing import shared_memory
+from pingpongapi import jobmemory, jobstore
+from pingpongapi.models import PingpongJob
+from .agents import agentfreelist, agentstatus, assert_permutation, draw, sparse_values
+from .storage import temporary_dirs
+
+class RestoreTest(TestCase):
+  """A job checkpointed by the agents and restored by the restapi resumes where it stopped"""
+
+  def setUp(self):
+    jobmemory.remove_shm_from_resource_tracker()
+    self.jobId = str(uuid.uuid4())
+    temporary_dirs(self, 'PINGPONG_DATA_DIR')
+
+  def tearDown(self):
+    for suffix in ('-pos', '-col', '-status', '-ping-wake', '-pong-wake'):
+      jobmemory._unlink(self.jobId + suffix)
+
+
+  def checkpoint(self, width, height, shards, generate):
+    """Generate a job through the agent modules, keep its checkpoint and drop its segments"""
+    jobmemory.create_segments(self.jobId, width, height, 1, shards=shards)
+    shmPos = shared_memory.SharedMemory(name=f"{self.jobId}-pos")
+    shmCol = shared_memory.SharedMemory(name=f"{self.jobId}-col")
+    shmStatus = shared_memory.SharedMemory(name=f"{self.jobId}-status")
+    positions = shmPos.buf.cast('I')
+    colors = agentfreelist.color_list(shmCol.buf)
+    iteration = generate(positions, colors, shmStatus.buf)
+    jobstore.write(self.jobId, width, height, 0, numpy.array(positions[:iteration], dtype=numpy.uint32),
+      numpy.array([colors[index] for index in range(iteration)], dtype=numpy.uint32))
+    PingpongJob.objects.create(jobId=self.jobId, width=width, height=height, iteration=iteration,
+      storedIteration=iteration, shards=shards)
+    positions.release()
+    colors.release()
+    for shm in (shmPos, shmCol, shmStatus):
+      shm.close()
+    self.tearDown()
+    return iteration
+
+  def restore(self):
+    response = self.client.post(f'/pingpong/restore/{self.jobId}/')
+    self.assertEqual(response.status_code, 200)
+    self.assertFalse(response.json()['finished'])
+    item = PingpongJob.objects.get(pk=self.jobId)
+    return item, jobstore.read(item)
+
+  def test_ping_pong(self):
+    width, height = 60, 50
+    def generate(positions, colors, statusBuf):
+      draw(positions, colors, width*height, 0, 1234, random.Random(4))
+      return 1234
+    iteration = self.checkpoint(width, height, 0, generate)
+    item, (storedPositions, storedColors) = self.restore()
+
+    jobStatus = agentstatus.JobStatus(self.jobId)
+    header = agentstatus.read(jobStatus.buf)
+    self.assertEqual((header.iteration, header.checkpoint, header.startIteration, header.shards),
+      (iteration, iteration, iteration, 0))
+    jobStatus.close()
+    shmPos = shared_memory.SharedMemory(name=f"{self.jobId}-pos")
+    positions = numpy.frombuffer(shmPos.buf, dtype=numpy.uint32)
+    self.assertTrue((positions[:iteration] == storedPositions).all())
+    assert_permutation(self, positions)
+    del positions
+    shmPos.close()
+    shmCol = shared_memory.SharedMemory(name=f"{self.jobId}-col")
+    capacity = jobmemory.color_capacity(width*height)
+    values = sparse_values(shmCol.buf, capacity)
+    self.assertTrue((values[:iteration] == storedColors).all())
+    assert_permutation(self, values)
+    shmCol.close()
+
+  def test_sharded(self):
+    width, height, shards = 60, 50, 3
+    counters = (400, 390, 410)
+    def generate(positions, colors, statusBuf):
+      for shard, counter in enumerate(counters):
+        agentfreelist.draw_shard(positions, colors, width*height, shard, shards, 0, counter, random.Random(shard))
+        agentstatus.write_counter(statusBuf, shard, counter)
+      return agentstatus.read_iteration(statusBuf, shards)
+    iteration = self.checkpoint(width, height, shards, generate)
+    item, (storedPositions, storedColors) = self.restore()
+
+    jobStatus = agentstatus.JobStatus(self.jobId)
+    self.assertEqual(agentstatus.read(jobStatus.buf).checkpoint, iteration)
+    # Each shard resumes after its last checkpointed iteration
+    self.assertEqual([agentstatus.read_counter(jobStatus.buf, shard) for shard in range(shards)],
+      [len(range(shard, iteration, shards)) for shard in range(shards)])
+    self.assertEqual(agentstatus.read_iteration(jobStatus.buf, shards), iteration)
+    jobStatus.close()
+    for suffix, stored, count in (('pos', storedPositions, width*height), ('col', storedColors, jobmemory.COLOR_COUNT)):
+      shm = shared_memory.SharedMemory(name=f"{self.jobId}-{suffix}")
+      values = numpy.frombuffer(shm.buf, dtype=numpy.uint32, count=count)
+      self.assertTrue((values[:iteration] == stored).all())
+      if suffix == 'col':
+        # The colors generated are stored, the free color slots after them
+        values = numpy.concatenate((jobmemory.shard_slots(values[:iteration]), values[iteration:]))
+      self.assertTrue((values % shards == numpy.arange(count) % shards).all())
+      assert_permutation(self, values)
+      del values
+      shm.close()
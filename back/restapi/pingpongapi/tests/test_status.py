@@ -0,0 +1,76 @@
+import uuid
+from django.test import SimpleTestCase, TestCase
+from multiprocessing import shared_memory
+from pingpongapi import jobmemory
+from pingpongapi.models import PingpongJob
+from .agents import agentstatus
+
+class StatusHeaderTest(SimpleTestCase):
+
+  def test_layout(self):
+    self.assertEqual(agentstatus._FORMAT, jobmemory.STATUS_FORMAT)
+    self.assertEqual(agentstatus.HEADER_SIZE, jobmemory.STATUS_SIZE)
+    self.assertEqual(agentstatus.CANCEL, jobmemory.STATUS_CANCEL)
+    self.assertEqual(agentstatus.Header._fields, jobmemory.STATUS_FIELDS)
+
+  def test_round_trip(self):
+    buf = bytearray(jobmemory.STATUS_SIZE)
+    jobmemory.init_status(buf, 10, 5)
+    header = agentstatus.read(buf)
+    self.assertEqual((header.version, header.iteration, header.state, header.turnSize, header.checkpoint,
+      header.startIteration), (jobmemory.STATUS_VERSION, 10, 0, 5, 10, 10))
+    agentstatus.update_progress(buf, header, 20, checkpoint=15, state=agentstatus.FINISHED)
+    status = jobmemory.read_status(buf)
+    self.assertEqual((status['sequence'], status['iteration'], status['checkpoint'], status['state']),
+      (2, 20, 15, agentstatus.FINISHED))
+    self.assertEqual(jobmemory.read_iteration(buf), 20)
+    buf[jobmemory.STATUS_CANCEL] = 1
+    self.assertTrue(agentstatus.read(buf).cancelled)
+
+  def test_torn_header(self):
+    buf = bytearray(jobmemory.STATUS_SIZE)
+    jobmemory.init_status(buf, 10, 1)
+    # Left odd by a writer that died while updating it
+    buf[4] = 1
+    self.assertIsNone(jobmemory.read_status(buf))
+    with self.assertRaises(RuntimeError):
+      agentstatus.read(buf)
+
+class StatusViewTest(TestCase):
+
+  def setUp(self):
+    jobmemory.remove_shm_from_resource_tracker()
+    self.jobId = str(uuid.uuid4())
+    PingpongJob.objects.create(jobId=self.jobId, width=10, height=10, iteration=5)
+    jobmemory.create_status(self.jobId, 5, 1)
+    self.addCleanup(jobmemory._unlink, f"{self.jobId}-status")
+    self.shm = shared_memory.SharedMemory(name=f"{self.jobId}-status")
+    self.addCleanup(self.shm.close)
+
+  def test_running(self):
+    agentstatus.update_progress(self.shm.buf, agentstatus.read(self.shm.buf), 8)
+    response = self.client.get(f'/pingpong/status/{self.jobId}/')
+    self.assertEqual(response.json()['iteration'], 8)
+    self.assertIn('rate', response.json())
+
+  def test_torn_header(self):
+    self.shm.buf[4] = 1
+    response = self.client.get(f'/pingpong/status/{self.jobId}/')
+    self.assertEqual(response.status_code, 200)
+    # The last known status of the database row
+    self.assertEqual(response.json()['iteration'], 5)
+    self.assertNotIn('rate', response.json())
+
+class ShardCountersTest(SimpleTestCase):
+
+  def test_shard_counters(self):
+    shards = 3
+    buf = bytearray(jobmemory.STATUS_SIZE + 4*shards)
+    jobmemory.init_status(buf, 10, 1, shards)
+    self.assertEqual(agentstatus.read(buf).shards, shards)
+    self.assertEqual([agentstatus.read_counter(buf, shard) for shard in range(shards)], [4, 3, 3])
+    self.assertEqual(agentstatus.read_iteration(buf, shards), 10)
+    agentstatus.write_counter(buf, 1, 5)
+    agentstatus.write_counter(buf, 2, 4)
+    self.assertEqual(agentstatus.read_iteration(buf, shards), jobmemory.read_iteration(buf))
+    self.assertEqual(jobmemory.read_iteration(buf), 12)
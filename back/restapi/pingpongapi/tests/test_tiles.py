@@ -0,0 +1,103 @@
+import numpy
+import os
+import uuid
+from django.test import TestCase
+from unittest import mock
+from pingpongapi import jobstore, pixels, rendercache, tiles
+from pingpongapi.models import PingpongJob
+from .storage import temporary_dirs
+from .test_upload import encode_records
+
+def reference_levels(width, height, tileSize, rgba):
+  """Pyramid averaged level by level from the whole previous level"""
+  levels = [numpy.frombuffer(rgba, dtype='<u4').reshape(height, width)]
+  while levels[-1].shape[0] > tileSize or levels[-1].shape[1] > tileSize:
+    previous = levels[-1]
+    # The last row/column of a level with an odd size is repeated
+    previous = numpy.pad(previous, ((0, previous.shape[0] % 2), (0, previous.shape[1] % 2)), mode='edge')
+    level = numpy.full((previous.shape[0]//2, previous.shape[1]//2), pixels.BLACK, dtype='<u4')
+    for channel in range(3):
+      values = ((previous >> (8*channel)) & 0xFF).astype(numpy.uint32)
+      total = values[0::2, 0::2] + values[0::2, 1::2] + values[1::2, 0::2] + values[1::2, 1::2]
+      level |= (total//4) << (8*channel)
+    levels.append(level)
+  return levels
+
+class TilesTest(TestCase):
+
+  def setUp(self):
+    temporary_dirs(self, 'PINGPONG_DATA_DIR', 'PINGPONG_TILE_DIR', 'PINGPONG_KEYFRAME_DIR')
+    override = self.settings(PINGPONG_TILE_SIZE=8)
+    override.enable()
+    self.addCleanup(override.disable)
+    self.width, self.height = 37, 23
+    rng = numpy.random.default_rng(3)
+    positionCount = self.width*self.height
+    self.positions = rng.permutation(positionCount).astype(numpy.uint32)
+    self.colors = rng.choice(1 << 24, positionCount, replace=False).astype(numpy.uint32)
+
+  def create_job(self, storedIteration):
+    item = PingpongJob.objects.create(jobId=str(uuid.uuid4()), width=self.width, height=self.height,
+      iteration=storedIteration, storedIteration=storedIteration)
+    jobstore.write(item.jobId, self.width, self.height, 0, self.positions, self.colors)
+    return item
+
+  def pyramid(self, item):
+    buf, views = tiles._map(tiles._path(item.jobId), tiles.level_sizes(self.width, self.height, 8), 'r')
+    return [numpy.array(view) for view in views]
+
+  def assert_pyramid(self, item, iteration):
+    rgba = pixels.render_rgba(self.width, self.height, self.positions[:iteration], self.colors[:iteration])
+    reference = reference_levels(self.width, self.height, 8, rgba)
+    levels = self.pyramid(item)
+    self.assertEqual(len(levels), len(reference))
+    for level, expected in zip(levels, reference):
+      self.assertTrue((level == expected).all())
+
+  def test_incremental_matches_one_shot(self):
+    item = self.create_job(0)
+    for iteration in (0, 1, 100, 101, 500, self.width*self.height):
+      item.storedIteration = iteration
+      self.assertEqual(tiles.update(item), iteration)
+      self.assert_pyramid(item, iteration)
+    oneShot = self.create_job(self.width*self.height)
+    tiles.update(oneShot)
+    for level, expected in zip(self.pyramid(oneShot), self.pyramid(item)):
+      self.assertTrue((level == expected).all())
+
+  def test_tile(self):
+    item = self.create_job(300)
+    rgba = pixels.render_rgba(self.width, self.height, self.positions[:300], self.colors[:300])
+    levels = tiles.levels(self.width, self.height, 8)
+    self.assertEqual([(level['columns'], level['rows']) for level in levels], [(1, 1), (2, 1), (3, 2), (5, 3)])
+    # Last column and row of the full resolution, transparent beyond the image
+    tile = numpy.frombuffer(tiles.tile(item, 3, 4, 2), dtype='<u4').reshape(8, 8)
+    image = numpy.frombuffer(rgba, dtype='<u4').reshape(self.height, self.width)
+    self.assertTrue((tile[:7, :5] == image[16:, 32:]).all())
+    self.assertTrue((tile[7:, :] == 0).all() and (tile[:, 5:] == 0).all())
+    self.assertIsNone(tiles.tile(item, 3, 5, 0))
+    self.assertIsNone(tiles.tile(item, 4, 0, 0))
+
+  def test_built_on_first_tile_request(self):
+    item = PingpongJob.objects.create(jobId=str(uuid.uuid4()), width=self.width, height=self.height, iteration=0)
+    response = self.client.post(f'/pingpong/append/{item.jobId}/?offset=0',
+      encode_records(self.positions[:50].tolist(), self.colors[:50].tolist()), content_type='application/octet-stream')
+    self.assertEqual(response.status_code, 200)
+    # Nothing is built in the upload path
+    self.assertFalse(os.path.exists(tiles._path(item.jobId)))
+    self.assertEqual(self.client.get(f'/pingpong/render/{item.jobId}/tile/0/0/0/').status_code, 200)
+    self.assert_pyramid(PingpongJob.objects.get(pk=item.jobId), 50)
+
+  def test_budget(self):
+    items = [self.create_job(self.width*self.height) for index in range(3)]
+    tiles.update(items[0])
+    fileSize = os.path.getsize(tiles._path(items[0].jobId))
+    # Room for the pyramids of two jobs
+    self.enterContext(mock.patch.object(tiles, 'budget', rendercache.FileBudget(2*fileSize, '-tiles.bin')))
+    tiles.tile(items[1], 0, 0, 0)
+    tiles.tile(items[0], 0, 0, 0)
+    tiles.tile(items[2], 0, 0, 0)
+    self.assertEqual([os.path.exists(tiles._path(item.jobId)) for item in items], [True, False, True])
+    # Built again when requested
+    self.assertEqual(tiles.tile(items[1], 1, 0, 0), tiles.tile(items[0], 1, 0, 0))
+    self.assertEqual([os.path.exists(tiles._path(item.jobId)) for item in items], [True, True, False])
@@ -0,0 +1,68 @@
+import io
+import numpy
+import struct
+import uuid
+from django.test import TestCase
+from PIL import Image
+from pingpongapi import jobstore, pixels, timelapse
+from pingpongapi.models import PingpongJob
+from .storage import temporary_dirs
+
+def png_chunks(data):
+  """(kind, data) of the chunks of a PNG file"""
+  offset = len(timelapse.PNG_SIGNATURE)
+  while offset < len(data):
+    length, = struct.unpack('>I', data[offset:offset + 4])
+    yield data[offset + 4:offset + 8], data[offset + 8:offset + 8 + length]
+    offset += 12 + length
+
+class TimelapseTest(TestCase):
+  """The frames of a timelapse are the images at their iterations"""
+
+  def setUp(self):
+    temporary_dirs(self, 'PINGPONG_DATA_DIR')
+    self.width, self.height = 9, 7
+    rng = numpy.random.default_rng(4)
+    positionCount = self.width*self.height
+    self.positions = rng.permutation(positionCount).astype(numpy.uint32)
+    self.colors = rng.choice(1 << 24, positionCount, replace=False).astype(numpy.uint32)
+    self.item = PingpongJob.objects.create(jobId=str(uuid.uuid4()), width=self.width, height=self.height, iteration=50,
+      storedIteration=50)
+    jobstore.write(self.item.jobId, self.width, self.height, 0, self.positions, self.colors)
+    self.iterations = timelapse.frame_iterations(50, 15)
+
+  def expected(self, iteration):
+    return pixels.render_rgba(self.width, self.height, self.positions[:iteration], self.colors[:iteration])
+
+  def test_frame_iterations(self):
+    self.assertEqual(self.iterations, [15, 30, 45, 50])
+    self.assertEqual(timelapse.frame_iterations(45, 15), [15, 30, 45])
+
+  def test_raw_frames(self):
+    frames = list(timelapse.raw_frames(self.item, self.iterations))
+    self.assertEqual(frames, [self.expected(iteration) for iteration in self.iterations])
+
+  def test_apng_frames(self):
+    data = b''.join(timelapse.apng_frames(self.item, self.iterations, 40))
+    chunks = list(png_chunks(data))
+    self.assertEqual([kind for kind, chunk in chunks], [b'IHDR', b'acTL', b'fcTL', b'IDAT'] + [b'fcTL', b'fdAT']*3 + [b'IEND'])
+    # fcTL and fdAT chunks share a single sequence
+    sequences = [struct.unpack('>I', chunk[:4])[0] for kind, chunk in chunks if kind in (b'fcTL', b'fdAT')]
+    self.assertEqual(sequences, list(range(len(sequences))))
+    image = Image.open(io.BytesIO(data))
+    self.assertEqual(image.n_frames, len(self.iterations))
+    for index, iteration in enumerate(self.iterations):
+      image.seek(index)
+      self.assertEqual(image.convert('RGBA').tobytes(), self.expected(iteration), iteration)
+
+  async def test_export(self):
+    response = await self.async_client.get(f'/pingpong/export/{self.item.jobId}/?output=raw&every=15')
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response['X-Frame-Count'], '4')
+    content = b''.join([chunk async for chunk in response.streaming_content])
+    self.assertEqual(content, b''.join(self.expected(iteration) for iteration in self.iterations))
+    response = await self.async_client.get(f'/pingpong/export/{self.item.jobId}/?every=0')
+    self.assertEqual(response.status_code, 400)
+    empty = await PingpongJob.objects.acreate(jobId=str(uuid.uuid4()), width=self.width, height=self.height, iteration=0)
+    response = await self.async_client.get(f'/pingpong/export/{empty.jobId}/')
+    self.assertEqual(response.status_code, 409)
@@ -0,0 +1,92 @@
+import io
+import numpy
+import uuid
+import zlib
+import zstandard
+from django.test import SimpleTestCase, TestCase
+from pingpongapi import jobstore, pixels
+from pingpongapi.models import PingpongJob
+from .storage import temporary_dirs
+
+def encode_records(positions, colors):
+  """Pack the records the way the agents upload them"""
+  return b''.join(position.to_bytes(3, 'little') + color.to_bytes(3, 'little') for position, color in zip(positions, colors))
+
+class DecodeTest(SimpleTestCase):
+
+  def setUp(self):
+    rng = numpy.random.default_rng(1)
+    # Larger than a read chunk, which does not end on a record boundary
+    count = pixels.READ_CHUNK_SIZE//pixels.RECORD_SIZE + 1000
+    self.positions = rng.integers(0, 1 << 24, count, dtype=numpy.uint32)
+    self.colors = rng.integers(0, 1 << 24, count, dtype=numpy.uint32)
+    self.body = encode_records(self.positions.tolist(), self.colors.tolist())
+
+  def assert_records(self, chunks):
+    self.assertGreater(len(chunks), 1)
+    self.assertTrue((numpy.concatenate([positions for positions, colors in chunks]) == self.positions).all())
+    self.assertTrue((numpy.concatenate([colors for positions, colors in chunks]) == self.colors).all())
+
+  def test_decode_records(self):
+    positions, colors = pixels.decode_records(self.body[:60])
+    self.assertTrue((positions == self.positions[:10]).all())
+    self.assertTrue((colors == self.colors[:10]).all())
+
+  def test_iter_binary_data(self):
+    self.assert_records(list(pixels.iter_binary_data(io.BytesIO(self.body))))
+
+  def test_compressed(self):
+    self.assert_records(list(pixels.iter_binary_data(io.BytesIO(zlib.compress(self.body)), 'zlib')))
+    compressed = zstandard.ZstdCompressor().compress(self.body)
+    self.assert_records(list(pixels.iter_binary_data(io.BytesIO(compressed), 'zstd')))
+
+  def test_invalid_binary_data(self):
+    for body, encoding in ((self.body[:-1], ''), (b'not zlib data', 'zlib'), (b'not zstd data', 'zstd'), (self.body, 'br')):
+      with self.assertRaises(ValueError):
+        list(pixels.iter_binary_data(io.BytesIO(body), encoding))
+
+  def test_json_data(self):
+    positions, colors = pixels.decode_json_data('[[1, 5], [2, 16777215]]')
+    self.assertEqual((positions.tolist(), colors.tolist()), ([1, 2], [5, 16777215]))
+    self.assertEqual(len(pixels.decode_json_data('[]')[0]), 0)
+    for data in ('hello', '[[1, 5], [2]]', '[[1, 5, 3]]', '[1, 5]', '[[1.5, 2]]', '[[-1, 2]]', '[[1, 16777216]]',
+        '[["1", 2]]', '[[true, false]]', '{"1": 2}'):
+      with self.assertRaises(ValueError, msg=data):
+        pixels.decode_json_data(data)
+
+class UpdateTest(TestCase):
+  """update_job replaces the data only with records which fit in the job"""
+
+  def setUp(self):
+    temporary_dirs(self, 'PINGPONG_DATA_DIR', 'PINGPONG_TILE_DIR', 'PINGPONG_KEYFRAME_DIR')
+    self.item = PingpongJob.objects.create(jobId=str(uuid.uuid4()), width=2, height=2, iteration=1, storedIteration=1)
+    jobstore.write(self.item.jobId, 2, 2, 0, numpy.array([3], dtype=numpy.uint32), numpy.array([7], dtype=numpy.uint32))
+
+  def update(self, body, contentType='application/octet-stream'):
+    return self.client.post(f'/pingpong/update/{self.item.jobId}/', body, content_type=contentType)
+
+  def assert_unchanged(self, response):
+    self.assertEqual(response.status_code, 400)
+    item = PingpongJob.objects.get(pk=self.item.jobId)
+    self.assertEqual((item.storedIteration, item.generation), (1, 0))
+    self.assertEqual([values.tolist() for values in jobstore.read(item)], [[3], [7]])
+
+  def test_binary(self):
+    response = self.update(encode_records([2, 0], [5, 6]))
+    self.assertEqual(response.status_code, 200)
+    item = PingpongJob.objects.get(pk=self.item.jobId)
+    self.assertEqual((item.storedIteration, item.generation), (2, 1))
+    self.assertEqual([values.tolist() for values in jobstore.read(item)], [[2, 0], [5, 6]])
+
+  def test_binary_outside_job(self):
+    self.assert_unchanged(self.update(encode_records([0, 4], [5, 6])))
+    self.assert_unchanged(self.update(encode_records([0, 1, 2, 3, 0], [1, 2, 3, 4, 5])))
+
+  def test_json(self):
+    response = self.update({'data': '[[1, 5], [0, 6]]'}, 'application/json')
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual([values.tolist() for values in jobstore.read(PingpongJob.objects.get(pk=self.item.jobId))], [[1, 0], [5, 6]])
+
+  def test_invalid_json(self):
+    for data in ('hello', '[[1, 5], [2]]', '[[4, 5]]', '[[0, 1], [1, 1], [2, 1], [3, 1], [0, 1]]'):
+      self.assert_unchanged(self.update({'data': data}, 'application/json'))
@@ -0,0 +1,196 @@
+import contextlib
+import numpy
+import os
+import struct
+import threading
+from django.conf import settings
+from . import jobstore, pixels, rendercache
+
+# One file per job: a header (magic, layout version, width, height and tile size of the job, generation of the data,
+# number of records applied) followed by the levels of the pyramid as raw RGBA pixels read as little endian uint32. The first level is
+# the full resolution image, each next one averages the 2x2 blocks of the previous one, until the image fits in a tile.
+# Zoom 0 is the last level.
+MAGIC = b'R3PT'
+VERSION = 2
+_HEADER = struct.Struct('<4sIIIIIQ')
+# Records drawn per pass, bounds the memory used to bring a large job up to date
+UPDATE_BATCH = 1 << 22
+# Pixels written at once when creating a blank pyramid
+_BLANK_CHUNK = 1 << 20
+
+# Updates of a job are serialized, the records stored since the last update are applied once whatever the number of
+# requests. jobId -> (lock, number of threads using it)
+_locks = {}
+_locksLock = threading.Lock()
+# The pyramids of the jobs whose tiles were the least recently requested are removed beyond PINGPONG_TILE_BUDGET bytes
+budget = rendercache.FileBudget(settings.PINGPONG_TILE_BUDGET, '-tiles.bin')
+
+def _path(jobId):
+  return os.path.join(settings.PINGPONG_TILE_DIR, f"{jobId}-tiles.bin")
+
+@contextlib.contextmanager
+def _job_lock(jobId):
+  with _locksLock:
+    lock, users = _locks.get(jobId, (None, 0))
+    if lock is None:
+      lock = threading.Lock()
+    _locks[jobId] = (lock, users + 1)
+  try:
+    with lock:
+      yield
+  finally:
+    with _locksLock:
+      lock, users = _locks[jobId]
+      if users == 1:
+        del _locks[jobId]
+      else:
+        _locks[jobId] = (lock, users - 1)
+
+def level_sizes(width, height, tileSize):
+  """(width, height) of the levels of the pyramid of a job, full resolution first"""
+  sizes = [(width, height)]
+  while sizes[-1][0] > tileSize or sizes[-1][1] > tileSize:
+    levelWidth, levelHeight = sizes[-1]
+    sizes.append(((levelWidth + 1)//2, (levelHeight + 1)//2))
+  return sizes
+
+def levels(width, height, tileSize):
+  """Zoom levels of the pyramid of a job, zoom 0 fits in a single tile"""
+  return [{
+    'zoom': zoom,
+    'width': levelWidth,
+    'height': levelHeight,
+    'columns': -(-levelWidth//tileSize),
+    'rows': -(-levelHeight//tileSize),
+  } for zoom, (levelWidth, levelHeight) in enumerate(reversed(level_sizes(width, height, tileSize)))]
+
+def _map(path, sizes, mode):
+  buf = numpy.memmap(path, dtype='<u4', mode=mode, offset=_HEADER.size)
+  views = []
+  offset = 0
+  for levelWidth, levelHeight in sizes:
+    views.append(buf[offset:offset + levelWidth*levelHeight].reshape(levelHeight, levelWidth))
+    offset += levelWidth*levelHeight
+  return buf, views
+
+def _create(path, width, height, tileSize, generation, sizes):
+  # Written next to the final file and renamed, tiles being read keep the previous file
+  os.makedirs(settings.PINGPONG_TILE_DIR, exist_ok=True)
+  remaining = sum(levelWidth*levelHeight for levelWidth, levelHeight in sizes)
+  blank = numpy.full(min(remaining, _BLANK_CHUNK), pixels.BLACK, dtype='<u4').tobytes()
+  with open(path + '.tmp', 'wb') as f:
+    f.write(_HEADER.pack(MAGIC, VERSION, width, height, tileSize, generation, 0))
+    while remaining:
+      count = min(remaining, _BLANK_CHUNK)
+      f.write(blank[:4*count])
+      remaining -= count
+  os.replace(path + '.tmp', path)
+  budget.add(path)
+
+def _applied(path, width, height, tileSize, generation):
+  """Number of records applied to the pyramid file, None if it is missing or was built for another layout or data"""
+  try:
+    with open(path, 'rb') as f:
+      header = f.read(_HEADER.size)
+  except FileNotFoundError:
+    return None
+  if len(header) < _HEADER.size:
+    return None
+  magic, version, fileWidth, fileHeight, fileTileSize, fileGeneration, applied = _HEADER.unpack(header)
+  if (magic, version, fileWidth, fileHeight, fileTileSize, fileGeneration) != (MAGIC, VERSION, width, height, tileSize, generation):
+    return None
+  return applied
+
+def _downsample(previous, level, cells):
+  """Average again the 2x2 blocks of the previous level under the given flat cells of a level
+
+  The last row/column of a level with an odd size is repeated.
+  """
+  rows, columns = numpy.divmod(cells, level.shape[1])
+  total = numpy.zeros((len(cells), 3), dtype=numpy.uint32)
+  for dy in (0, 1):
+    for dx in (0, 1):
+      rgba = previous[numpy.minimum(2*rows + dy, previous.shape[0] - 1), numpy.minimum(2*columns + dx, previous.shape[1] - 1)]
+      for channel in range(3):
+        total[:, channel] += (rgba >> (8*channel)) & 0xFF
+  total //= 4
+  level.reshape(-1)[cells] = total[:, 0] | (total[:, 1] << 8) | (total[:, 2] << 16) | pixels.BLACK
+
+def _update(item, path, sizes):
+  tileSize = settings.PINGPONG_TILE_SIZE
+  applied = _applied(path, item.width, item.height, tileSize, item.generation)
+  # Missing, or built from replaced data, start again
+  if applied is None:
+    _create(path, item.width, item.height, tileSize, item.generation, sizes)
+    applied = 0
+  # Already applied by a request holding a more recent row
+  if applied >= item.storedIteration:
+    return applied
+  buf, views = _map(path, sizes, 'r+')
+  positions, colors = jobstore.read(item)
+  for start in range(applied, item.storedIteration, UPDATE_BATCH):
+    end = min(start + UPDATE_BATCH, item.storedIteration)
+    cells = numpy.asarray(positions[start:end])
+    views[0].reshape(-1)[cells] = pixels.to_rgba(colors[start:end])
+    for previous, level in zip(views, views[1:]):
+      rows, columns = numpy.divmod(cells, previous.shape[1])
+      cells = numpy.unique((rows//2)*level.shape[1] + columns//2)
+      _downsample(previous, level, cells)
+  buf.flush()
+  del buf, views
+  # Written last, the records of an interrupted update are applied again
+  with open(path, 'r+b') as f:
+    f.write(_HEADER.pack(MAGIC, VERSION, item.width, item.height, tileSize, item.generation, item.storedIteration))
+  return item.storedIteration
+
+def update(item):
+  """Bring the pyramid of a job up to its stored records, returns the number of records applied
+
+  The pyramid is built on the first tile request of a job. Then only the records stored since the last update are
+  drawn, and only the cells they cover are averaged again on each level, so an update costs the new records whatever
+  the image size.
+  """
+  sizes = level_sizes(item.width, item.height, settings.PINGPONG_TILE_SIZE)
+  path = _path(item.jobId)
+  with _job_lock(item.jobId):
+    budget.touch(path)
+    try:
+      return _update(item, path, sizes)
+    except FileNotFoundError:
+      # Evicted by the pyramid of another job in the meantime, built again
+      return _update(item, path, sizes)
+
+def tile(item, zoom, column, row):
+  """Raw RGBA bytes of a tile of a job, tileSize pixels square and transparent beyond the image
+
+  Returns None if the tile is out of the pyramid.
+  """
+  tileSize = settings.PINGPONG_TILE_SIZE
+  sizes = level_sizes(item.width, item.height, tileSize)
+  index = len(sizes) - 1 - zoom
+  if zoom < 0 or index < 0 or column < 0 or row < 0:
+    return None
+  levelWidth, levelHeight = sizes[index]
+  if column*tileSize >= levelWidth or row*tileSize >= levelHeight:
+    return None
+  update(item)
+  try:
+    buf, views = _map(_path(item.jobId), sizes, 'r')
+  except FileNotFoundError:
+    # Evicted right after the update
+    update(item)
+    buf, views = _map(_path(item.jobId), sizes, 'r')
+  part = views[index][row*tileSize:(row + 1)*tileSize, column*tileSize:(column + 1)*tileSize]
+  image = numpy.zeros((tileSize, tileSize), dtype='<u4')
+  image[:part.shape[0], :part.shape[1]] = part
+  del buf, views, part
+  return image.tobytes()
+
+def discard(jobId):
+  """Remove the pyramid of a job whose data has been replaced"""
+  with _job_lock(jobId):
+    budget.remove(_path(jobId))
+    try:
+      os.unlink(_path(jobId))
+    except FileNotFoundError:
+      pass
@@ -0,0 +1,90 @@
+import numpy
+import struct
+import zlib
+from asgiref.sync import sync_to_async
+from . import jobstore, pixels
+
+# Timelapse outputs: content type and extension of the downloaded file
+FORMATS = {
+  'apng': ('image/apng', 'png'),
+  'raw': ('application/octet-stream', 'rgba'),
+}
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# fcTL dispose and blend operations
+_DISPOSE_NONE = 0
+_BLEND_SOURCE = 0
+_BLEND_OVER = 1
+# zlib level of the APNG frames, speed matters more than size and the frames after the first one are mostly transparent
+COMPRESSION_LEVEL = 1
+
+def frame_iterations(storedIteration, every):
+  """Iterations of the frames of a timelapse, every N iterations and at the last stored one"""
+  return list(range(every, storedIteration, every)) + [storedIteration]
+
+def batches(item, iterations):
+  """Positions and RGBA colors of the records drawn between two frames, a single linear pass over the stored records"""
+  positions, colors = jobstore.read(item, iterations[-1])
+  previous = 0
+  for iteration in iterations:
+    yield positions[previous:iteration], pixels.to_rgba(colors[previous:iteration])
+    previous = iteration
+
+def raw_frames(item, iterations):
+  """Raw RGBA bytes of the image at each frame iteration, the records are drawn in a single reused frame buffer"""
+  frame = numpy.full(item.width*item.height, pixels.BLACK, dtype='<u4')
+  for positions, rgba in batches(item, iterations):
+    frame[positions] = rgba
+    yield frame.tobytes()
+
+def _chunk(kind, data):
+  return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+def apng_frames(item, iterations, delay):
+  """Animated PNG of the image at each frame iteration, streamed frame by frame
+
+  The first frame is the whole image. Positions are only drawn once, so the next frames only hold the pixels drawn
+  since the previous frame over a transparent background and are blended over it. All the frames are compressed
+  from a single reused scanline buffer.
+  """
+  width, height = item.width, item.height
+  yield (PNG_SIGNATURE + _chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+    + _chunk(b'acTL', struct.pack('>II', len(iterations), 0)))
+  # Scanlines prefixed by their filter byte (0, none), the pixels are a uint32 view of the rest of each line
+  rows = numpy.zeros((height, 1 + 4*width), dtype=numpy.uint8)
+  frame = rows[:, 1:].view('<u4')
+  frame[:] = pixels.BLACK
+  sequence = 0
+  for index, (positions, rgba) in enumerate(batches(item, iterations)):
+    y, x = numpy.divmod(positions, width)
+    frame[y, x] = rgba
+    control = _chunk(b'fcTL', struct.pack('>IIIIIHHBB', sequence, width, height, 0, 0, delay, 1000, _DISPOSE_NONE,
+      _BLEND_SOURCE if index == 0 else _BLEND_OVER))
+    data = zlib.compress(rows, COMPRESSION_LEVEL)
+    if index == 0:
+      # The first frame is the default image of viewers without APNG support
+      yield control + _chunk(b'IDAT', data)
+      frame[:] = 0
+      sequence += 1
+    else:
+      yield control + _chunk(b'fdAT', struct.pack('>I', sequence + 1) + data)
+      frame[y, x] = 0
+      sequence += 2
+  yield _chunk(b'IEND', b'')
+
+async def stream(chunks):
+  """Serve a synchronous generator from an async view, one chunk at a time in a worker thread
+
+  Django consumes a synchronous streaming iterator whole before serving it asynchronously.
+  """
+  try:
+    while True:
+      chunk = await sync_to_async(next, thread_sensitive=False)(chunks, None)
+      if chunk is None:
+        break
+      yield chunk
+  finally:
+    try:
+      chunks.close()
+    except ValueError:
+      # Cancelled while the worker thread is generating a chunk, the generator is dropped once it returns
+      pass
@@ -19,9 +19,18 @@ schema_view = get_schema_view(
 urlpatterns = [
     path('', views.ApiOverview, name='home'),
     path('pingpong/create/', views.create_job, name='create-job'),
+    path('pingpong/create/bulk/', views.create_jobs, name='create-jobs'),
     path('pingpong/status/<str:pk>/', views.status_job, name='status-job'),
+    path('pingpong/progress/<str:pk>/', views.progress_job, name='progress-job'),
     path('pingpong/update/<str:pk>/', views.update_job, name='update-job'),
+    path('pingpong/append/<str:pk>/', views.append_job, name='append-job'),
+    path('pingpong/restore/<str:pk>/', views.restore_job, name='restore-job'),
+    path('pingpong/cancel/<str:pk>/', views.cancel_job, name='cancel-job'),
     path('pingpong/render/<str:pk>/', views.render_job, name='render-job'),
+    path('pingpong/export/<str:pk>/', views.export_job, name='export-job'),
+    path('pingpong/render/<str:pk>/tile/', views.tile_levels, name='tile-levels'),
+    path('pingpong/render/<str:pk>/tile/<int:zoom>/<int:column>/<int:row>/', views.render_tile, name='render-tile'),
+    path('pingpong/metrics/', views.metrics_api, name='metrics'),
     path('api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     re_path(r'^swagger(?P<format>\.json|\.yaml)$',
             schema_view.without_ui(cache_timeout=0), name='schema-json'),
@@ -1,155 +1,298 @@
-import struct
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.http import parse_etags
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 
 from .serializers import PingpongJobSerializer
 from .models import PingpongJob
+from . import jobmemory, jobstore, keyframes, metrics, pixels, progress, publisher, rendercache, tiles, timelapse
+from .jobmemory import remove_shm_from_resource_tracker
 import pika
+import secrets
 import uuid
 import json
-import math
-from PIL import Image
-import numpy
-import os
-from multiprocessing import resource_tracker, shared_memory
+from multiprocessing import shared_memory
+import threading
 
-def remove_shm_from_resource_tracker():
-    """Monkey-patch multiprocessing.resource_tracker so SharedMemory won't be tracked
-
-    More details at: https://bugs.python.org/issue38119
-    """
-
-    def fix_register(name, rtype):
-        if rtype == "shared_memory":
-            return
-        return resource_tracker._resource_tracker.register(self, name, rtype)
-    resource_tracker.register = fix_register
-
-    def fix_unregister(name, rtype):
-        if rtype == "shared_memory":
-            return
-        return resource_tracker._resource_tracker.unregister(self, name, rtype)
-    resource_tracker.unregister = fix_unregister
-
-    if "shared_memory" in resource_tracker._CLEANUP_FUNCS:
-        del resource_tracker._CLEANUP_FUNCS["shared_memory"]
+appendLock = threading.Lock()
+restoreLock = threading.Lock()
+# Seconds a client is asked to wait before submitting jobs rejected for lack of shared memory
+BUDGET_RETRY_AFTER = 10
+# Highest priority of a job, the agents declare their queues with the same maximum
+MAX_PRIORITY = 9
 
 @api_view(['GET'])
 def ApiOverview(request):
   api_urls = {
     'Trigger a new render': '/pingpong/create/',
+    'Trigger several renders': '/pingpong/create/bulk/',
     'Update render': '/pingpong/update/pk/',
-    'Render': '/pingpong/render/pk/',
+    'Append to render': '/pingpong/append/pk/?offset=N',
+    'Restore render SHM from the last checkpoint': '/pingpong/restore/pk/',
+    'Cancel render': '/pingpong/cancel/pk/',
+    'Progress stream (Server-Sent Events)': '/pingpong/progress/pk/',
+    'Metrics (Prometheus)': '/pingpong/metrics/',
+    'Render': '/pingpong/render/pk/?iteration=N&output=rgba|png|webp',
+    'Timelapse export': '/pingpong/export/pk/?every=N&delay=MS&output=apng|raw',
+    'Tile levels': '/pingpong/render/pk/tile/',
+    'Render tile': '/pingpong/render/pk/tile/zoom/column/row/?output=rgba|png|webp',
   }
 
   return Response(api_urls)
 
-@swagger_auto_schema(method='post', request_body=openapi.Schema(
+jobSchema = openapi.Schema(
     type=openapi.TYPE_OBJECT,
     properties={
         'width': openapi.Schema(type=openapi.TYPE_INTEGER, description='width'),
         'height': openapi.Schema(type=openapi.TYPE_INTEGER, description='height'),
+        'turn_size': openapi.Schema(type=openapi.TYPE_INTEGER, description='optional number of iterations generated by an agent per turn (ping/pong jobs)'),
+        'shards': openapi.Schema(type=openapi.TYPE_INTEGER, description='optional number of shard agents generating the image in parallel instead of the ping and pong agents'),
+        'solo': openapi.Schema(type=openapi.TYPE_BOOLEAN, description='optional, generate the image in a few vectorized steps by a single solo agent instead of the ping and pong agents'),
+        'seed': openapi.Schema(type=openapi.TYPE_INTEGER, description='optional seed of the random draws of a solo job, random by default'),
+        'priority': openapi.Schema(type=openapi.TYPE_INTEGER, description=f'optional priority of a solo or sharded job among the jobs of the same size, 0 (default) to {MAX_PRIORITY}'),
     }
-))
+)
+
+def parse_job(spec):
+  """Validate the width/height/turn_size/shards/solo/seed/priority of a job request, returns the new job or raises ValueError"""
+  if not isinstance(spec, dict) or not 'width' in spec or not 'height' in spec:
+    raise ValueError("Missing width/height in request")
+  try:
+    width = int(spec['width'])
+    height = int(spec['height'])
+  except (TypeError, ValueError):
+    raise ValueError("width and height must be integers")
+  if width < 1 or height < 1:
+    raise ValueError("width and height must be positive")
+  # Every pixel gets a distinct 24 bit color
+  if width*height > jobmemory.COLOR_COUNT:
+    raise ValueError(f"width*height must be at most {jobmemory.COLOR_COUNT}")
+  try:
+    turnSize = int(spec.get('turn_size', 1))
+  except (TypeError, ValueError):
+    turnSize = 0
+  if turnSize < 1:
+    raise ValueError("turn_size must be a positive integer")
+  try:
+    shards = int(spec.get('shards', 0))
+  except (TypeError, ValueError):
+    shards = -1
+  if shards < 0 or shards > jobmemory.MAX_SHARDS:
+    raise ValueError(f"shards must be an integer between 0 and {jobmemory.MAX_SHARDS}")
+  solo = spec.get('solo', False)
+  if solo not in (True, False, 'true', 'false'):
+    raise ValueError("solo must be a boolean")
+  solo = solo in (True, 'true')
+  if solo and shards:
+    raise ValueError("A job is either solo or sharded")
+  try:
+    seed = int(spec['seed']) if 'seed' in spec else secrets.randbits(63)
+  except (TypeError, ValueError):
+    seed = -1
+  if seed < 0 or seed >= 1 << 63:
+    raise ValueError("seed must be an integer between 0 and 2^63 - 1")
+  try:
+    priority = int(spec.get('priority', 0))
+  except (TypeError, ValueError):
+    priority = -1
+  if priority < 0 or priority > MAX_PRIORITY:
+    raise ValueError(f"priority must be an integer between 0 and {MAX_PRIORITY}")
+  # The ping and pong queues stay FIFO, see job_messages
+  if priority and not solo and not shards:
+    raise ValueError("priority only applies to solo and sharded jobs")
+  return {
+    # Generate a random uid
+    'jobId': str(uuid.uuid4()),
+    'width': width,
+    'height': height,
+    'iteration': 0,
+    'turnSize': turnSize,
+    'storedIteration': 0,
+    'shards': shards,
+    'solo': solo,
+    'seed': seed,
+    'priority': priority,
+  }
+
+def job_size(job):
+  """Size class of a job, its messages are only routed to the agents of that size class"""
+  return 'small' if job['width']*job['height'] <= settings.PINGPONG_SMALL_JOB_MAX else 'large'
+
+def job_messages(job):
+  """Messages triggering the agents of a job, as (routing key, body, priority)"""
+  size = job_size(job)
+  if job['shards']:
+    # One message per shard, picked up by the shard agents
+    return [(f'pingpong.shard.{size}', json.dumps(dict(job, shard=shard)), job['priority']) for shard in range(job['shards'])]
+  if job['solo']:
+    return [(f'pingpong.solo.{size}', json.dumps(job), job['priority'])]
+  # The ping and pong queues are FIFO, both agents have to take the jobs in the same order
+  return [(f'pingpong.{size}', json.dumps(job), None)]
+
+def budget_exceeded(error, jobCount):
+  metrics.inc('r3p_api_jobs_rejected_total', jobCount)
+  response = Response({"status": "fail", "message": f"Not enough shared memory left: {error}"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+  # Running jobs give their segments back as they complete
+  response['Retry-After'] = str(BUDGET_RETRY_AFTER)
+  return response
+
+@swagger_auto_schema(method='post', request_body=jobSchema)
 @api_view(['POST'])
+@metrics.timed
 def create_job(request):
-  if not 'width' in request.data or not 'height' in request.data:
-    return Response({"status": "fail", "message": "Missing width/height in request"}, status=status.HTTP_400_BAD_REQUEST)
-
-  # Generate a random uid
-  jobId = uuid.uuid4()
-  height = int(request.data['height'])
-  width = int(request.data['width'])
+  try:
+    job = parse_job(request.data)
+  except ValueError as e:
+    return Response({"status": "fail", "message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
   # Have to patch the resource tracker to make shm work properly
   remove_shm_from_resource_tracker()
-  bufferSize = height*width*4 #uint32
-  shmPos = shared_memory.SharedMemory(create=True, name=f"{str(jobId)}-pos", size=bufferSize)
-  posBuf = shmPos.buf
-  print(f"{str(jobId)}-pos")
-  print(shmPos.name)
-  for n in range(bufferSize):
-    posBuf[n] = 0
-  shmPos.close()
-
-  shmCol = shared_memory.SharedMemory(create=True, name=f"{str(jobId)}-col", size=bufferSize)
-  colBuf = shmCol.buf
-  for n in range(bufferSize):
-    colBuf[n] = 0
-  shmCol.close()
-
-  bitmaskSize = height*width
-  shmPosMask = shared_memory.SharedMemory(create=True, name=f"{str(jobId)}-posMask", size=bitmaskSize)
-  posMaskBuf = shmPosMask.buf
-  for n in range(bitmaskSize):
-    posMaskBuf[n] = 1
-  shmPosMask.close()
-
-  colmaskSize = 256*256*256
-  shmColMask = shared_memory.SharedMemory(create=True, name=f"{str(jobId)}-colMask", size=colmaskSize)
-  colMaskBuf = shmColMask.buf
-  for n in range(colmaskSize):
-    colMaskBuf[n] = 1
-  shmColMask.close()
-
-  # First 4 is the current iteration, 5th is the current status (ping/pong/finished), 6th is a lock for the update
-  statusBufSize = 6
-  shmStatus = shared_memory.SharedMemory(create=True, name=f"{str(jobId)}-status", size=statusBufSize)
-  statusBuf = shmStatus.buf
-  for n in range(statusBufSize):
-    statusBuf[n] = 0
-  shmStatus.close()
-
-  job = {
-    'jobId': str(jobId),
-    'width': request.data['width'],
-    'height': request.data['height'],
-    'iteration': 0,
-    'data': '[]',
-  }
+  try:
+    jobmemory.manager.acquire(job['jobId'], job['width'], job['height'], job['turnSize'], job['shards'])
+  except jobmemory.BudgetExceeded as e:
+    return budget_exceeded(e, 1)
+
   serializer = PingpongJobSerializer(data=job)
   if serializer.is_valid():
-    routing_key = 'pingpong'
-    host = os.getenv('RABBITMQ_HOST', 'localhost')
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
-    channel = connection.channel()
-    channel.exchange_declare(exchange='pingpongtopic', exchange_type='topic')
-    channel.basic_publish(
-      exchange='pingpongtopic', routing_key=routing_key, body=json.dumps(job))
-    connection.close()
-    serializer.save()
+    # Stored before being published, the agents may report back (append) as soon as the message is out
+    item = serializer.save()
+    try:
+      publisher.pool.publish(job_messages(job))
+    except pika.exceptions.AMQPError as e:
+      item.delete()
+      jobmemory.manager.release(job['jobId'], job['width'], job['height'])
+      return Response({"status": "fail", "message": f"Unable to publish the job: {e!r}"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
     return Response({"status": "success", "message": serializer.data}, status=status.HTTP_201_CREATED)
   else:
+    jobmemory.manager.release(job['jobId'], job['width'], job['height'])
+    return Response({"status": "fail", "message": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+@swagger_auto_schema(method='post', operation_description="Create several jobs at once, either all of them or none",
+  request_body=openapi.Schema(type=openapi.TYPE_OBJECT, properties={'jobs': openapi.Schema(type=openapi.TYPE_ARRAY, items=jobSchema)}))
+@api_view(['POST'])
+@metrics.timed
+def create_jobs(request):
+  specs = request.data.get('jobs') if isinstance(request.data, dict) else None
+  if not isinstance(specs, list) or not specs:
+    return Response({"status": "fail", "message": "Expected a non empty jobs array"}, status=status.HTTP_400_BAD_REQUEST)
+  if len(specs) > settings.PINGPONG_BULK_MAX_JOBS:
+    return Response({"status": "fail", "message": f"At most {settings.PINGPONG_BULK_MAX_JOBS} jobs per request"}, status=status.HTTP_400_BAD_REQUEST)
+  # Validate all the jobs before allocating anything
+  jobs = []
+  for index, spec in enumerate(specs):
+    try:
+      jobs.append(parse_job(spec))
+    except ValueError as e:
+      return Response({"status": "fail", "message": f"jobs[{index}]: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+  serializer = PingpongJobSerializer(data=jobs, many=True)
+  if not serializer.is_valid():
     return Response({"status": "fail", "message": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
 
+  remove_shm_from_resource_tracker()
+  try:
+    jobmemory.manager.acquire_all([(job['jobId'], job['width'], job['height'], job['turnSize'], job['shards']) for job in jobs])
+  except jobmemory.BudgetExceeded as e:
+    return budget_exceeded(e, len(jobs))
+  # Stored before being published, the agents of the first jobs may report back before the last ones are published
+  PingpongJob.objects.bulk_create([PingpongJob(**data) for data in serializer.validated_data])
+  try:
+    publisher.pool.publish([message for job in jobs for message in job_messages(job)])
+  except pika.exceptions.AMQPError as e:
+    PingpongJob.objects.filter(pk__in=[job['jobId'] for job in jobs]).delete()
+    for job in jobs:
+      jobmemory.manager.release(job['jobId'], job['width'], job['height'])
+    return Response({"status": "fail", "message": f"Unable to publish the jobs: {e!r}"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+  return Response({"status": "success", "jobIds": [job['jobId'] for job in jobs], "message": serializer.data}, status=status.HTTP_201_CREATED)
+
 @api_view(['GET'])
+@metrics.timed
 def status_job(request, pk):
   # Retrieve the item
   item = PingpongJob.objects.get(pk=pk)
   # Look into the SHM if still running
   try:
-    shmStatus = shared_memory.SharedMemory(create=False, name=f"{item.jobId}-status", size=6)
-    buf = shmStatus.buf
-    # Lock the SHM to avoid being cleared
-    buf[5] = 1
-    iteration = struct.unpack('I', buf[0:4])[0]
-    data = {}
-    data['iteration'] = iteration
-    serializer = PingpongJobSerializer(instance=item, data=data, partial=True)
-    if serializer.is_valid():
-      serializer.save()
-      buf[5] = 0
-      return Response(serializer.data, status=status.HTTP_200_OK)
+    shmStatus = shared_memory.SharedMemory(create=False, name=f"{item.jobId}-status")
+    # Lock free reads, the agents never wait for the restapi
+    header = jobmemory.read_status(shmStatus.buf)
+    iteration = jobmemory.read_iteration(shmStatus.buf)
+    shmStatus.close()
+    # Torn header (the agent died while updating it), the database row is the last known status
+    if header is not None and iteration is not None:
+      data = {}
+      # Never go back (job restored from an older checkpoint)
+      data['iteration'] = max(iteration, item.iteration)
+      serializer = PingpongJobSerializer(instance=item, data=data, partial=True)
+      if serializer.is_valid():
+        serializer.save()
+        running = {key: header[key] for key in ('startTime', 'handoffTime', 'rate')}
+        return Response(dict(serializer.data, **running), status=status.HTTP_200_OK)
   except:
-    item = PingpongJob.objects.get(pk=pk)
-    serializer = PingpongJobSerializer(instance=item)
-    return Response(serializer.data, status=status.HTTP_200_OK)
+    pass
+  item = PingpongJob.objects.get(pk=pk)
+  serializer = PingpongJobSerializer(instance=item)
+  return Response(serializer.data, status=status.HTTP_200_OK)
+
+async def progress_job(request, pk):
+  """Stream the progress of a job as Server-Sent Events instead of polling the status
 
-@swagger_auto_schema(method='post', request_body=openapi.Schema(
+  Plain async Django view, DRF views are synchronous and would hold a worker thread per client.
+  """
+  try:
+    item = await PingpongJob.objects.aget(pk=pk)
+  except PingpongJob.DoesNotExist:
+    return JsonResponse({"status": "fail", "message": f"Unknown job {pk}"}, status=status.HTTP_404_NOT_FOUND)
+  response = StreamingHttpResponse(progress.stream(item), content_type='text/event-stream')
+  response['Cache-Control'] = 'no-cache'
+  # Disable the buffering of reverse proxies
+  response['X-Accel-Buffering'] = 'no'
+  return response
+
+async def export_job(request, pk):
+  """Stream a timelapse of the stored records of a job, a frame every N iterations
+
+  Plain async Django view like progress_job, so the frames are streamed as they are encoded instead of being
+  collected first. The raw output is the concatenated RGBA bytes of the frames.
+  """
+  try:
+    item = await PingpongJob.objects.aget(pk=pk)
+  except PingpongJob.DoesNotExist:
+    return JsonResponse({"status": "fail", "message": f"Unknown job {pk}"}, status=status.HTTP_404_NOT_FOUND)
+  if item.storedIteration == 0:
+    return JsonResponse({"status": "fail", "message": f"No data stored for job {pk} yet"}, status=status.HTTP_409_CONFLICT)
+  format = request.GET.get('output', 'apng')
+  if format not in timelapse.FORMATS:
+    return JsonResponse({"status": "fail", "message": f"Invalid output, expected one of {', '.join(timelapse.FORMATS)}"}, status=status.HTTP_400_BAD_REQUEST)
+  try:
+    every = int(request.GET.get('every', -(-item.storedIteration//settings.PINGPONG_TIMELAPSE_FRAMES)))
+    delay = int(request.GET.get('delay', 40))
+  except ValueError:
+    every = delay = 0
+  if every < 1 or not 0 < delay < 1 << 16:
+    return JsonResponse({"status": "fail", "message": "every must be a positive integer and delay a number of milliseconds below 65536"}, status=status.HTTP_400_BAD_REQUEST)
+  iterations = timelapse.frame_iterations(item.storedIteration, every)
+  if len(iterations) > settings.PINGPONG_TIMELAPSE_MAX_FRAMES:
+    return JsonResponse({"status": "fail", "message": f"At most {settings.PINGPONG_TIMELAPSE_MAX_FRAMES} frames, every must be at least {-(-item.storedIteration//settings.PINGPONG_TIMELAPSE_MAX_FRAMES)}"}, status=status.HTTP_400_BAD_REQUEST)
+
+  if format == 'raw':
+    chunks = timelapse.raw_frames(item, iterations)
+  else:
+    chunks = timelapse.apng_frames(item, iterations, delay)
+  contentType, extension = timelapse.FORMATS[format]
+  response = StreamingHttpResponse(timelapse.stream(chunks), content_type=contentType)
+  response['Content-Disposition'] = f'attachment; filename="{item.jobId}-timelapse.{extension}"'
+  response['X-Frame-Count'] = str(len(iterations))
+  if format == 'raw':
+    response['Content-Length'] = str(len(iterations)*item.width*item.height*4)
+    response['X-Frame-Width'] = str(item.width)
+    response['X-Frame-Height'] = str(item.height)
+  return response
+
+@swagger_auto_schema(method='post', operation_description="Either a JSON body or an application/octet-stream body of packed 24 bit "
+    "position/color records, optionally compressed (Content-Encoding: zlib or zstd)", request_body=openapi.Schema(
     type=openapi.TYPE_OBJECT,
     properties={
         'iteration': openapi.Schema(type=openapi.TYPE_INTEGER, description='iteration'),
@@ -157,37 +300,246 @@ def status_job(request, pk):
     }
 ))
 @api_view(['POST'])
+@metrics.timed
 def update_job(request, pk):
-  if not 'iteration' in request.data and not 'data' in request.data:
+  binary = request.content_type.split(';')[0].strip() == 'application/octet-stream'
+  if not binary and not 'iteration' in request.data and not 'data' in request.data:
     return Response({"status": "fail", "message": "You need to provided either iteration or data (or both)"}, status=status.HTTP_400_BAD_REQUEST)
 
   # Retrieve the item
-  item = PingpongJob.objects.get(pk=pk)
-  serializer = PingpongJobSerializer(instance=item, data=request.data, partial=True)
+  try:
+    item = PingpongJob.objects.get(pk=pk)
+  except PingpongJob.DoesNotExist:
+    return Response({"status": "fail", "message": f"Unable to update job {pk}"}, status=status.HTTP_404_NOT_FOUND)
+  records = None
+  if binary:
+    # Binary upload, each chunk of records is written to the new data file as it is read out of the request body
+    try:
+      chunks = pixels.iter_binary_data(request.stream, request.META.get('HTTP_CONTENT_ENCODING', ''))
+      records = jobstore.replace_chunks(item.jobId, item.width, item.height,
+        pixels.iter_checked_records(chunks, 0, item.width*item.height))
+    except ValueError as e:
+      return Response({"status": "fail", "message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    data = {'iteration': records, 'storedIteration': records}
+  else:
+    data = {'iteration': request.data['iteration']} if 'iteration' in request.data else {}
+    positions = None
+    if 'data' in request.data:
+      try:
+        positions, colors = pixels.decode_json_data(request.data['data'])
+        pixels.check_records(positions, 0, item.width*item.height)
+      except ValueError as e:
+        return Response({"status": "fail", "message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+      data['storedIteration'] = len(positions)
+
+  serializer = PingpongJobSerializer(instance=item, data=data, partial=True)
   if serializer.is_valid():
+    if not binary and positions is not None:
+      jobstore.replace(item.jobId, item.width, item.height, positions, colors)
+      records = len(positions)
+    if records is not None:
+      # The cached renders and the ETags of the previous data are stale
+      item.generation += 1
     serializer.save()
+    if records is not None:
+      keyframes.discard(item.jobId)
+      tiles.discard(item.jobId)
+      metrics.inc('r3p_api_records_total', records, view='update_job')
     return Response({"status": "success", "message": serializer.data}, status=status.HTTP_200_OK)
   else:
     return Response({"status": "fail", "message": f"Unable to update job {pk}"}, status=status.HTTP_404_NOT_FOUND)
 
-@swagger_auto_schema(method='get', manual_parameters=[openapi.Parameter('iteration', openapi.IN_QUERY, required=False, description="optional iteration number", type=openapi.TYPE_INTEGER)])
+@swagger_auto_schema(method='post', operation_description="Append an application/octet-stream body of packed 24 bit position/color "
+    "records (optionally compressed, Content-Encoding: zlib or zstd) to the data of the job, starting at the given iteration",
+    manual_parameters=[openapi.Parameter('offset', openapi.IN_QUERY, required=True, description="iteration of the first record", type=openapi.TYPE_INTEGER)])
+@api_view(['POST'])
+@metrics.timed
+def append_job(request, pk):
+  if request.content_type.split(';')[0].strip() != 'application/octet-stream':
+    return Response({"status": "fail", "message": "Expected an application/octet-stream body"}, status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+  try:
+    offset = int(request.query_params['offset'])
+    if offset < 0:
+      raise ValueError
+  except (KeyError, ValueError):
+    return Response({"status": "fail", "message": "Missing or invalid offset"}, status=status.HTTP_400_BAD_REQUEST)
+  # Checked before reading the body, the data has to stay contiguous
+  try:
+    item = PingpongJob.objects.get(pk=pk)
+  except PingpongJob.DoesNotExist:
+    return Response({"status": "fail", "message": f"Unknown job {pk}"}, status=status.HTTP_404_NOT_FOUND)
+  if item.cancelled:
+    return Response({"status": "fail", "message": f"Job {pk} has been cancelled"}, status=status.HTTP_410_GONE)
+  if offset > item.storedIteration:
+    return Response({"status": "fail", "message": f"Data is only stored up to iteration {item.storedIteration}", "iteration": item.storedIteration}, status=status.HTTP_409_CONFLICT)
+  generation = item.generation
+  # Each chunk of records is written at its iteration as it is read out of the request body, the records already
+  # stored (retried or overlapping checkpoints) are skipped. A chunk which does not fit in the job is rejected before
+  # it is written, the records written before it are past the stored iteration and do not count.
+  try:
+    chunks = pixels.iter_binary_data(request.stream, request.META.get('HTTP_CONTENT_ENCODING', ''))
+    end = jobstore.write_chunks(item.jobId, item.width, item.height, offset,
+      pixels.iter_checked_records(chunks, offset, item.width*item.height), item.storedIteration)
+  except ValueError as e:
+    return Response({"status": "fail", "message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+  # Appends of a job come from both agents, serialize the read-modify-write of the row
+  with appendLock:
+    try:
+      item = PingpongJob.objects.get(pk=pk)
+    except PingpongJob.DoesNotExist:
+      return Response({"status": "fail", "message": f"Unknown job {pk}"}, status=status.HTTP_404_NOT_FOUND)
+    if item.cancelled:
+      return Response({"status": "fail", "message": f"Job {pk} has been cancelled"}, status=status.HTTP_410_GONE)
+    # Data replaced (update) while the body was read, the records may not be in the current file
+    if item.generation != generation:
+      return Response({"status": "fail", "message": f"Data of job {pk} has been replaced", "iteration": item.storedIteration}, status=status.HTTP_409_CONFLICT)
+    # The stored iteration only grows, the records from the one checked above up to the end have all been written
+    if end > item.storedIteration:
+      metrics.inc('r3p_api_records_total', end - item.storedIteration, view='append_job')
+      item.storedIteration = end
+      item.iteration = max(item.iteration, item.storedIteration)
+      item.save()
+      # All the data is stored, the SHM is not needed anymore
+      if item.storedIteration == item.width*item.height:
+        jobmemory.manager.release(item.jobId, item.width, item.height)
+  return Response({"status": "success", "iteration": item.storedIteration}, status=status.HTTP_200_OK)
+
+@api_view(['POST'])
+def restore_job(request, pk):
+  # Retrieve the item, agents drop the messages of unknown jobs
+  try:
+    item = PingpongJob.objects.get(pk=pk)
+  except PingpongJob.DoesNotExist:
+    return Response({"status": "fail", "message": f"Unknown job {pk}"}, status=status.HTTP_404_NOT_FOUND)
+  if item.storedIteration == item.width*item.height:
+    return Response({"status": "success", "finished": True}, status=status.HTTP_200_OK)
+  if item.cancelled:
+    return Response({"status": "fail", "message": f"Job {pk} has been cancelled"}, status=status.HTTP_410_GONE)
+
+  # Both agents get the message redelivered, only the first one rebuilds the SHM
+  with restoreLock:
+    try:
+      shmStatus = shared_memory.SharedMemory(create=False, name=f"{item.jobId}-status")
+      shmStatus.close()
+    except FileNotFoundError:
+      remove_shm_from_resource_tracker()
+      positions, colors = jobstore.read(item)
+      jobmemory.create_segments(item.jobId, item.width, item.height, item.turnSize, positions, colors, item.shards)
+  return Response({"status": "success", "finished": False}, status=status.HTTP_200_OK)
+
+@swagger_auto_schema(method='post', operation_description="Stop a job before completion, its agents stop at the end of their "
+    "current turn and the data stored so far is kept")
+@api_view(['POST'])
+@metrics.timed
+def cancel_job(request, pk):
+  # Serialised with the appends, a job is either complete or cancelled
+  with appendLock:
+    try:
+      item = PingpongJob.objects.get(pk=pk)
+    except PingpongJob.DoesNotExist:
+      return Response({"status": "fail", "message": f"Unknown job {pk}"}, status=status.HTTP_404_NOT_FOUND)
+    if item.storedIteration == item.width*item.height:
+      return Response({"status": "fail", "message": f"Job {pk} is already complete"}, status=status.HTTP_409_CONFLICT)
+    if not item.cancelled:
+      item.cancelled = True
+      item.save(update_fields=['cancelled'])
+      remove_shm_from_resource_tracker()
+      # Flagged before the release, the agents keep the unlinked status segment mapped
+      jobmemory.cancel_status(item.jobId)
+      jobmemory.manager.release(item.jobId, item.width, item.height)
+      metrics.inc('r3p_api_jobs_cancelled_total')
+  return Response({"status": "success", "message": PingpongJobSerializer(instance=item).data}, status=status.HTTP_200_OK)
+
+@swagger_auto_schema(method='get', manual_parameters=[
+  openapi.Parameter('iteration', openapi.IN_QUERY, required=False, description="optional iteration number", type=openapi.TYPE_INTEGER),
+  openapi.Parameter('output', openapi.IN_QUERY, required=False, description="rgba (raw RGBA bytes, default), png or webp", type=openapi.TYPE_STRING),
+  openapi.Parameter('generation', openapi.IN_QUERY, required=False, description="optional generation of the data (see status), the render is immutable if it is the current one", type=openapi.TYPE_INTEGER)])
 @api_view(['GET'])
+@metrics.timed
 def render_job(request, pk):
   # Retrieve the item
   item = PingpongJob.objects.get(pk=pk)
-  serializer = PingpongJobSerializer(instance=item)
-  coords = json.loads(serializer.data['data'])
-  imarray = numpy.zeros((serializer.data['width'], serializer.data['height'], 3))
-  for coord in coords:
-    x = coord[0] % serializer.data['width']
-    y = math.floor(coord[0]/serializer.data['width'])
-    Blue =  coord[1] & 255
-    Green = (coord[1] >> 8) & 255
-    Red =   (coord[1] >> 16) & 255
-    imarray[x, y, 0] = Red
-    imarray[x, y, 1] = Green
-    imarray[x, y, 2] = Blue
-  im = Image.fromarray(imarray.astype('uint8')).convert('RGBA')
-  response = HttpResponse(content_type='application/octet-stream')
-  response.write(im.tobytes())
-  return response
\ No newline at end of file
+  # Not named format, DRF reserves it to pick the renderer of the response
+  format = request.query_params.get('output', 'rgba')
+  if format not in rendercache.FORMATS:
+    return Response({"status": "fail", "message": f"Invalid output, expected one of {', '.join(rendercache.FORMATS)}"}, status=status.HTTP_400_BAD_REQUEST)
+  # Only apply the first N values of the data array
+  iteration = item.storedIteration
+  immutable = item.storedIteration == item.width*item.height
+  if 'iteration' in request.query_params:
+    try:
+      iteration = max(int(request.query_params['iteration']), 0)
+    except ValueError:
+      return Response({"status": "fail", "message": "Invalid iteration"}, status=status.HTTP_400_BAD_REQUEST)
+    # The stored data is append only, the image at a stored iteration never changes
+    immutable = immutable or iteration <= item.storedIteration
+    iteration = min(iteration, item.storedIteration)
+  # Unless it is replaced (update), only a URL pinned to the current generation of the data can be cached for good
+  immutable = immutable and request.query_params.get('generation') == str(item.generation)
+
+  key = (item.jobId, item.generation, iteration, format)
+  etag = rendercache.etag(*key)
+  if etag in parse_etags(request.headers.get('If-None-Match', '')):
+    response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+  else:
+    content = rendercache.cache.get(key)
+    metrics.inc('r3p_api_render_cache_total', result='hit' if content is not None else 'miss')
+    if content is None:
+      if item.storedIteration == item.width*item.height:
+        # Complete jobs render from their keyframes instead of decoding the whole data
+        rgba = keyframes.render(item, iteration)
+      else:
+        rgba = pixels.render_rgba(item.width, item.height, *jobstore.read(item, iteration))
+      content = rendercache.encode(item.width, item.height, rgba, format)
+      rendercache.cache.put(key, content)
+      metrics.observe('r3p_api_render_bytes', len(content), output=format)
+    response = HttpResponse(content, content_type=rendercache.FORMATS[format][0])
+  response['ETag'] = etag
+  # The latest render of a running job changes as data is appended, clients have to revalidate it
+  response['Cache-Control'] = 'public, max-age=31536000, immutable' if immutable else 'no-cache'
+  return response
+
+@swagger_auto_schema(method='get', operation_description="Zoom levels of the tile pyramid of a job, zoom 0 fits in a single tile")
+@api_view(['GET'])
+@metrics.timed
+def tile_levels(request, pk):
+  try:
+    item = PingpongJob.objects.get(pk=pk)
+  except PingpongJob.DoesNotExist:
+    return Response({"status": "fail", "message": f"Unknown job {pk}"}, status=status.HTTP_404_NOT_FOUND)
+  tileSize = settings.PINGPONG_TILE_SIZE
+  return Response({"tileSize": tileSize, "levels": tiles.levels(item.width, item.height, tileSize)}, status=status.HTTP_200_OK)
+
+@swagger_auto_schema(method='get', operation_description="Tile of the latest stored image of a job, tileSize pixels square and "
+    "transparent beyond the image", manual_parameters=[
+  openapi.Parameter('output', openapi.IN_QUERY, required=False, description="rgba (raw RGBA bytes, default), png or webp", type=openapi.TYPE_STRING)])
+@api_view(['GET'])
+@metrics.timed
+def render_tile(request, pk, zoom, column, row):
+  try:
+    item = PingpongJob.objects.get(pk=pk)
+  except PingpongJob.DoesNotExist:
+    return Response({"status": "fail", "message": f"Unknown job {pk}"}, status=status.HTTP_404_NOT_FOUND)
+  format = request.query_params.get('output', 'rgba')
+  if format not in rendercache.FORMATS:
+    return Response({"status": "fail", "message": f"Invalid output, expected one of {', '.join(rendercache.FORMATS)}"}, status=status.HTTP_400_BAD_REQUEST)
+
+  etag = rendercache.etag(item.jobId, item.generation, f"{item.storedIteration}-{zoom}-{column}-{row}", format)
+  if etag in parse_etags(request.headers.get('If-None-Match', '')):
+    response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+  else:
+    # The pyramid of the job is brought up to the stored records first, the tile is a slice of one of its levels
+    rgba = tiles.tile(item, zoom, column, row)
+    if rgba is None:
+      return Response({"status": "fail", "message": f"No tile {zoom}/{column}/{row}"}, status=status.HTTP_404_NOT_FOUND)
+    tileSize = settings.PINGPONG_TILE_SIZE
+    response = HttpResponse(rendercache.encode(tileSize, tileSize, rgba, format), content_type=rendercache.FORMATS[format][0])
+  response['ETag'] = etag
+  immutable = item.storedIteration == item.width*item.height and request.query_params.get('generation') == str(item.generation)
+  response['Cache-Control'] = 'public, max-age=31536000, immutable' if immutable else 'no-cache'
+  return response
+
+def metrics_api(request):
+  """Prometheus text exposition of the restapi metrics"""
+  return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')
@@ -9,8 +9,17 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'restapi.settings')
 
 application = get_asgi_application()
+# uvicorn does not serve the static files of the browsable API, swagger and admin like runserver does
+if settings.DEBUG:
+    application = ASGIStaticFilesHandler(application)
+
+# Only the server processes reclaim the leaked SHM segments, not the management commands
+from pingpongapi import janitor
+janitor.start()
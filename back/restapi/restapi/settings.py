@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
+import os
+import tempfile
 from pathlib import Path
 from corsheaders.defaults import default_headers
 
@@ -135,6 +137,53 @@ CORS_ORIGIN_WHITELIST = (
 
 ALLOWED_HOSTS = ['127.0.0.1', 'localhost', 'r3prestapi']
 
+# Number of pre-initialised SHM segments kept per size class for new jobs
+PINGPONG_SHM_POOL_SIZE = int(os.getenv('PINGPONG_SHM_POOL_SIZE', 2))
+# Jobs of at most PINGPONG_SPARSE_COLORS_MAX positions (ping/pong and solo) use a sparse color free list sized by the
+# image instead of the dense 64MB one
+PINGPONG_SPARSE_COLORS_MAX = int(os.getenv('PINGPONG_SPARSE_COLORS_MAX', 1 << 20))
+# Jobs of at most PINGPONG_SMALL_JOB_MAX positions are routed to the agents of the small jobs, the other ones to the
+# agents of the large jobs, so small interactive jobs never queue behind long renders
+PINGPONG_SMALL_JOB_MAX = int(os.getenv('PINGPONG_SMALL_JOB_MAX', 512*512))
+# Bytes of /dev/shm the job segments may use, new jobs are rejected beyond it (0: 80% of the size of /dev/shm)
+PINGPONG_SHM_BUDGET = int(os.getenv('PINGPONG_SHM_BUDGET', 0))
+# Seconds between two sweeps of the SHM janitor, and seconds without progress after which the segments of a job no
+# agent is attached to are reclaimed (the job is restored from its last checkpoint if an agent picks it up again)
+PINGPONG_SHM_JANITOR_INTERVAL = float(os.getenv('PINGPONG_SHM_JANITOR_INTERVAL', 60))
+PINGPONG_SHM_LEASE = float(os.getenv('PINGPONG_SHM_LEASE', 3600))
+
+# Number of RabbitMQ channels kept open to publish the jobs, concurrent job creations beyond it wait for a channel
+PINGPONG_PUBLISHER_POOL_SIZE = int(os.getenv('PINGPONG_PUBLISHER_POOL_SIZE', 4))
+
+# Directory of the position/color records of the jobs, one file per job
+PINGPONG_DATA_DIR = os.getenv('PINGPONG_DATA_DIR', os.path.join(BASE_DIR, 'jobdata'))
+
+# Maximum number of jobs created by one bulk request
+PINGPONG_BULK_MAX_JOBS = int(os.getenv('PINGPONG_BULK_MAX_JOBS', 500))
+
+# Byte budgets of the render cache, renders evicted from memory are spilled to disk (disabled when 0)
+PINGPONG_RENDER_CACHE_MEMORY = int(os.getenv('PINGPONG_RENDER_CACHE_MEMORY', 256*1024*1024))
+PINGPONG_RENDER_CACHE_DISK = int(os.getenv('PINGPONG_RENDER_CACHE_DISK', 0))
+PINGPONG_RENDER_CACHE_DIR = os.getenv('PINGPONG_RENDER_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'r3p-render-cache'))
+
+# Complete jobs keep a snapshot of their image every PINGPONG_KEYFRAME_INTERVAL iterations to render any iteration quickly
+PINGPONG_KEYFRAME_INTERVAL = int(os.getenv('PINGPONG_KEYFRAME_INTERVAL', 4*1024*1024))
+PINGPONG_KEYFRAME_DIR = os.getenv('PINGPONG_KEYFRAME_DIR', os.path.join(tempfile.gettempdir(), 'r3p-keyframes'))
+# Byte budget of the keyframes, the ones of the least recently rendered jobs are removed beyond it
+PINGPONG_KEYFRAME_BUDGET = int(os.getenv('PINGPONG_KEYFRAME_BUDGET', 2*1024*1024*1024))
+# Timelapse exports have PINGPONG_TIMELAPSE_FRAMES frames by default and at most PINGPONG_TIMELAPSE_MAX_FRAMES
+PINGPONG_TIMELAPSE_FRAMES = int(os.getenv('PINGPONG_TIMELAPSE_FRAMES', 100))
+PINGPONG_TIMELAPSE_MAX_FRAMES = int(os.getenv('PINGPONG_TIMELAPSE_MAX_FRAMES', 1000))
+# Jobs keep a pyramid of downsampled images in PINGPONG_TILE_DIR from their first tile request, tiles are PINGPONG_TILE_SIZE pixels square
+PINGPONG_TILE_SIZE = int(os.getenv('PINGPONG_TILE_SIZE', 256))
+PINGPONG_TILE_DIR = os.getenv('PINGPONG_TILE_DIR', os.path.join(tempfile.gettempdir(), 'r3p-tiles'))
+# Byte budget of the pyramids, the ones of the jobs whose tiles were the least recently requested are removed beyond it
+PINGPONG_TILE_BUDGET = int(os.getenv('PINGPONG_TILE_BUDGET', 1024*1024*1024))
+
+# Seconds between two samples of the progress of a streamed job, and between two keepalives of an idle stream
+PINGPONG_PROGRESS_INTERVAL = float(os.getenv('PINGPONG_PROGRESS_INTERVAL', 0.25))
+PINGPONG_PROGRESS_KEEPALIVE = float(os.getenv('PINGPONG_PROGRESS_KEEPALIVE', 15))
+
 CORS_ALLOW_HEADERS = list(default_headers) + [
     "Access-Control-Allow-Origin",
 ]
\ No newline at end of file
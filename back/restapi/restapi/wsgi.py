@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'restapi.settings')
 
 application = get_wsgi_application()
+
+# Only the server processes reclaim the leaked SHM segments, not the management commands
+from pingpongapi import janitor
+janitor.start()
@@ -0,0 +1,95 @@
+import React from "react";
+import { JobModel } from "./JobModel";
+
+interface Props {
+  progressUrl: string;
+  job: JobModel;
+  onJobCompletion: (job: JobModel) => void;
+}
+
+interface State {
+  progress: number;
+  rate: number;
+  cancelled: boolean;
+  error?: string;
+}
+
+export class ProgressBarStream extends React.Component<Props, State> {
+  state: State = { progress: 0, rate: 0, cancelled: false };
+  private source?: EventSource;
+
+  componentDidMount() {
+    this.subscribe();
+  }
+
+  componentDidUpdate(prevProps: Props) {
+    // Subscribe to the new job if the jobid has changed
+    if(this.props.job.jobId !== prevProps.job.jobId)
+    {
+      this.subscribe();
+    }
+  }
+
+  componentWillUnmount() {
+    this.close();
+  }
+
+  private close() {
+    this.source?.close();
+    this.source = undefined;
+  }
+
+  private subscribe() {
+    this.close();
+    if (this.props.job.jobId === '') {
+      return;
+    }
+
+    this.setState({ progress: 0, rate: 0, cancelled: false, error: undefined });
+    const job = this.props.job;
+    const source = new EventSource(`${this.props.progressUrl}/${job.jobId}/`);
+    source.onmessage = (event) => {
+      const status = JSON.parse(event.data);
+      const progress = status.iteration / status.total * 100;
+      this.setState({ progress, rate: status.rate });
+      // The server ends the stream once the job is complete or cancelled, close it before EventSource reconnects
+      if (status.cancelled) {
+        this.close();
+        this.setState({ cancelled: true });
+      } else if (status.iteration === status.total) {
+        this.close();
+        this.props.onJobCompletion({ ...job, completed: true });
+      }
+    };
+    source.addEventListener('failed', () => {
+      // The server can not sample the progress anymore, reconnecting would not help
+      this.close();
+      this.setState({ error: `Unable to retrieve progress for jobId ${job.jobId}` });
+    });
+    source.onerror = () => {
+      // EventSource reconnects by itself, only report the streams closed for good
+      if (source.readyState === EventSource.CLOSED) {
+        this.setState({ error: `Unable to retrieve progress for jobId ${job.jobId}` });
+      }
+    };
+    this.source = source;
+  }
+
+  render() {
+    const progress = `${this.state.progress.toFixed(1)}%`;
+    const style = {
+      width: progress,
+    };
+    return (
+      <div className="w-64 flex flex-col items-center justify-between">
+        <div className="text-sm font-bold text-gray-700 pb-2">Progress Bar with streaming:</div>
+        <div className="w-full bg-gray-200 rounded-full">
+          {this.state.progress !== undefined && <div className="bg-blue-500 text-xs font-medium text-blue-100 text-center p-0.5 leading-none rounded-full" style={style}> {progress}</div>}
+        </div>
+        <div className="text-xs text-gray-700 pt-1">{Math.round(this.state.rate)} iterations/s</div>
+        {this.state.cancelled && <div className="text-xs text-gray-700 pt-1">Cancelled</div>}
+        {this.state.error !== undefined && <div className="error-message">{this.state.error}</div>}
+      </div>
+    );
+  }
+}
@@ -1,6 +1,6 @@
 import { useState } from 'react';
 import { NewRenderForm } from './NewRenderForm';
-import { ProgressBarPolling } from './ProgressBarPolling';
+import { ProgressBarStream } from './ProgressBarStream';
 import { PingPongCanvas } from './PingPongCanvas';
 
 export default function Home() {
@@ -10,7 +10,7 @@ export default function Home() {
   return (
     <main className="flex min-h-screen flex-col items-center justify-between p-24">
       <NewRenderForm onSubmit={setJob} renderImageUrl={`${baseBackendURL}/create/`} />
-      <ProgressBarPolling job={job} onJobCompletion={setJob} pollingInterval={1000} statusUrl={`${baseBackendURL}/status`}/>
+      <ProgressBarStream job={job} onJobCompletion={setJob} progressUrl={`${baseBackendURL}/progress`}/>
       <PingPongCanvas job={job} uiUrl={`${baseBackendURL}/render`}/>
     </main>
   )